@@ -0,0 +1,112 @@
+"""
+Async counterparts of the tree methods, for use from async views, e.g.::
+
+    children = await node.aget_children()
+    await node.amove_to(target, "last-child")
+    async for descendant, depth, parent_pk in node.aiter_subtree():
+        ...
+
+They're reached through the ``a``-prefixed methods on ``NestedIntervalsModel`` and
+``NestedIntervalsManager``, which hand back the coroutines from this module.
+
+The Django versions this package supports have no async ORM, so each read is evaluated on a
+worker thread. Unlike wrapping the sync methods in ``sync_to_async``, which queues every call
+on the one thread that sync code shares, reads run on threads (and database connections) of
+their own, so concurrent requests read in parallel, and ``aiter_subtree`` fetches each chunk
+while the previous one is being consumed. Nodes and querysets that have their results
+prefetched (see ``prefetch_descendants`` and ``with_ancestors``) are served without leaving
+the event loop at all. As the reads use connections of their own, they only see data that has
+been committed.
+
+Writes (inserting, moving and rebalancing) read neighbours and update intervals inside one
+transaction, which Django can't run from async code, so each is handed to a worker thread as a
+whole, rather than one call per query.
+
+Needs Python 3.6+ and asgiref (which Django 3.0+ depends on).
+"""
+from __future__ import unicode_literals
+import asyncio
+
+from asgiref.sync import sync_to_async
+from django.db.models.query import QuerySet
+
+from .models import _walk_subtree
+
+
+async def _in_thread(func, *args):
+    # (a worker thread of its own, with its own database connections, rather than the one
+    # thread that sync code shares)
+    return await sync_to_async(func, thread_sensitive=False)(*args)
+
+
+async def alist(iterable):
+    """
+    Evaluates a queryset, or an async iterator such as ``aiter_subtree()``, from async code,
+    and returns its results as a list.
+    """
+    if isinstance(iterable, QuerySet):
+        if iterable._result_cache is not None:
+            return list(iterable._result_cache)
+        return await _in_thread(list, iterable)
+    return [item async for item in iterable]
+
+
+async def afirst(queryset):
+    """
+    Returns the first result of ``queryset`` (which must be ordered), or ``None``.
+    """
+    results = await alist(queryset[:1])
+    return results[0] if results else None
+
+
+async def aget_parent(node):
+    # the parent only needs a query if it comes from the database
+    if node._new_parent is not False or not node._is_saved() or node.level == 0:
+        return node.parent
+    return await afirst(node._get_parent_queryset())
+
+
+async def aget_ancestors(node, ascending=False, include_self=False):
+    return await alist(node.get_ancestors(ascending=ascending, include_self=include_self))
+
+
+async def aget_children(node):
+    return await alist(node.get_children())
+
+
+async def aget_descendants(node, include_self=False, max_depth=None):
+    return await alist(node.get_descendants(include_self=include_self, max_depth=max_depth))
+
+
+async def aiter_subtree(node, chunk_size=1000):
+    """
+    The async counterpart of ``NestedIntervalsModel.iter_subtree``, awaiting each chunk.
+    """
+    yield node, 0, None
+
+    chunks = node._tree_manager._iter_chunks_in_tree_order(node.get_descendants(), chunk_size)
+    stack = [(node.right, node.pk)]
+    # (the next chunk is read while the current one is consumed)
+    next_chunk = asyncio.ensure_future(_in_thread(next, chunks, None))
+    try:
+        while True:
+            chunk = await next_chunk
+            if chunk is None:
+                return
+            next_chunk = asyncio.ensure_future(_in_thread(next, chunks, None))
+            for item in _walk_subtree(stack, chunk):
+                yield item
+    finally:
+        next_chunk.cancel()
+
+
+async def ainsert_node(manager, node, target, position="last-child", save=False):
+    return await _in_thread(manager.insert_node, node, target, position, save)
+
+
+async def amove_node(manager, node, target, position="last-child"):
+    return await _in_thread(manager.move_node, node, target, position)
+
+
+async def arebalance_tree(manager, tree_id):
+    return await _in_thread(manager.rebalance_tree, tree_id)
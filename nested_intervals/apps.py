@@ -6,3 +6,7 @@ from django.apps import AppConfig
 class NestedIntervalsConfig(AppConfig):
     name = "nested_intervals"
     verbose_name = "nested_intervals"
+
+    def ready(self):
+        # connect the signal receivers, and register the lookups
+        from . import cache, lookups  # noqa
@@ -0,0 +1,182 @@
+"""
+Caching of ancestor and descendant reads, for trees that are read far more often than they
+change (breadcrumbs, navigation menus, ...).
+
+Results are cached as the field values of the nodes, keyed by the tree's version (see
+``NestedIntervalsManager.get_tree_version``), so any change to a tree makes its old entries
+unreachable. There are two tiers: a least-recently-used cache in the memory of each process,
+and the Django cache named by ``NESTED_INTERVALS_CACHE`` (if any), which also holds the
+current version of each tree so processes don't have to ask the database for it. Each process
+also remembers the versions it has read for ``NESTED_INTERVALS_LOCAL_VERSION_TIMEOUT``
+seconds, and those of the trees it changes itself as soon as the change is committed.
+"""
+from __future__ import unicode_literals
+import threading
+import time
+from collections import OrderedDict
+
+from django.core.cache import caches
+from django.dispatch import receiver
+
+from .conf import CACHE, CACHE_MAX_NODES, CACHE_TIMEOUT, LOCAL_CACHE_SIZE, LOCAL_VERSION_TIMEOUT
+from .routers import _get_tree_key
+from .signals import tree_changed
+
+_tree_cache = None
+_tree_cache_lock = threading.Lock()
+
+
+def get_tree_cache():
+    """
+    Returns the shared ``TreeCache``, set up from the ``NESTED_INTERVALS_CACHE*`` settings.
+    """
+    global _tree_cache
+    with _tree_cache_lock:
+        if _tree_cache is None:
+            _tree_cache = TreeCache()
+        return _tree_cache
+
+
+class TreeCache(object):
+    """
+    A two-tier cache of lists of nodes, keyed by tree version.
+    """
+
+    def __init__(self, alias=CACHE, timeout=CACHE_TIMEOUT, local_size=LOCAL_CACHE_SIZE, max_nodes=CACHE_MAX_NODES,
+                 version_timeout=LOCAL_VERSION_TIMEOUT):
+        self.alias = alias
+        self.timeout = timeout
+        self.local_size = local_size
+        self.max_nodes = max_nodes
+        self.version_timeout = version_timeout
+        self._local = OrderedDict()
+        # version key -> (version, time it's trusted until)
+        self._local_versions = {}
+        self._lock = threading.Lock()
+        self.reset_stats()
+
+    @property
+    def backend(self):
+        return caches[self.alias] if self.alias else None
+
+    def reset_stats(self):
+        """
+        Resets the hit and miss counters in ``stats``. ``local_hits`` counts the hits that
+        were served from the local memory tier (which are also counted in ``hits``).
+        """
+        with self._lock:
+            self.stats = {"hits": 0, "local_hits": 0, "misses": 0}
+
+    def _count(self, *names):
+        with self._lock:
+            for name in names:
+                self.stats[name] += 1
+
+    def _version_key(self, model, tree_id):
+        return "nested_intervals:version:%s:%s" % _get_tree_key(model, tree_id)
+
+    def get_version(self, model, tree_id):
+        """
+        Returns the current version of the tree, from the local memory or the shared cache if
+        it's there.
+        """
+        version_key = self._version_key(model, tree_id)
+        with self._lock:
+            version, expires = self._local_versions.get(version_key, (None, 0))
+        if version is not None and time.time() < expires:
+            return version
+        backend = self.backend
+        version = backend.get(version_key) if backend is not None else None
+        if version is None:
+            version = model.objects.get_tree_version(tree_id)
+            if backend is not None:
+                # (add, rather than set, so a newer version set after a change isn't overwritten)
+                backend.add(version_key, version, self.timeout)
+        self._store_version_locally(version_key, version)
+        return version
+
+    def set_version(self, model, tree_id, version):
+        version_key = self._version_key(model, tree_id)
+        self._store_version_locally(version_key, version)
+        backend = self.backend
+        if backend is not None:
+            backend.set(version_key, version, self.timeout)
+
+    def _store_version_locally(self, version_key, version):
+        if not self.version_timeout:
+            return
+        now = time.time()
+        with self._lock:
+            if len(self._local_versions) >= self.local_size:
+                # forget the versions that aren't trusted any more
+                for key, (_, expires) in list(self._local_versions.items()):
+                    if expires <= now:
+                        del self._local_versions[key]
+            current, expires = self._local_versions.get(version_key, (None, 0))
+            if current is not None and current > version and now < expires:
+                # a change committed in the meantime
+                return
+            self._local_versions[version_key] = (version, now + self.version_timeout)
+
+    def get_nodes(self, queryset, tree_id, key):
+        """
+        Returns the nodes of ``queryset`` (all in the tree with the given ``tree_id``) as a list,
+        from the cache if they were cached under ``key`` at the tree's current version.
+        """
+        model = queryset.model
+        version = self.get_version(model, tree_id)
+        cache_key = "nested_intervals:nodes:%s:%s:%s:%s" % (
+            _get_tree_key(model, tree_id) + (version, ":".join(str(part) for part in key)))
+
+        with self._lock:
+            rows = self._local.pop(cache_key, None)
+            if rows is not None:
+                # (re-inserted, to mark it as the most recently used)
+                self._local[cache_key] = rows
+        if rows is not None:
+            self._count("hits", "local_hits")
+        else:
+            backend = self.backend
+            rows = backend.get(cache_key) if backend is not None else None
+            if rows is not None:
+                self._count("hits")
+            else:
+                self._count("misses")
+                rows = self._fetch(queryset)
+                if rows is None:
+                    # too big to cache
+                    return list(queryset)
+                if backend is not None:
+                    backend.set(cache_key, rows, self.timeout)
+            self._store_locally(cache_key, rows)
+
+        field_names, values = rows
+        return [model.from_db(queryset.db, field_names, row) for row in values]
+
+    def _fetch(self, queryset):
+        field_names = [field.attname for field in queryset.model._meta.concrete_fields]
+        values = list(queryset.values_list(*field_names)[:self.max_nodes + 1])
+        if len(values) > self.max_nodes:
+            return None
+        return field_names, values
+
+    def _store_locally(self, cache_key, rows):
+        if not self.local_size:
+            return
+        with self._lock:
+            self._local[cache_key] = rows
+            while len(self._local) > self.local_size:
+                self._local.popitem(last=False)
+
+    def clear_local(self):
+        """
+        Empties the local memory tier.
+        """
+        with self._lock:
+            self._local.clear()
+            self._local_versions.clear()
+
+
+@receiver(tree_changed)
+def _update_cached_version(sender, tree_id, version, **kwargs):
+    get_tree_cache().set_version(sender, tree_id, version)
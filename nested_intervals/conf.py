@@ -1,3 +1,45 @@
 from django.conf import settings
 
-DECIMAL_PLACES = getattr(settings, "NESTED_INTERVALS_DECIMAL_PLACES", 30)
\ No newline at end of file
+DECIMAL_PLACES = getattr(settings, "NESTED_INTERVALS_DECIMAL_PLACES", 30)
+
+# when True, an insertion that runs out of room only re-spaces the smallest enclosing subtree,
+# and the full rebalance of the tree is handed off to the rebalance executor after commit
+DEFERRED_REBALANCE = getattr(settings, "NESTED_INTERVALS_DEFERRED_REBALANCE", False)
+
+REBALANCE_EXECUTOR = getattr(
+    settings,
+    "NESTED_INTERVALS_REBALANCE_EXECUTOR",
+    "nested_intervals.rebalancing.ThreadPoolRebalanceExecutor",
+)
+
+REBALANCE_THREADS = getattr(settings, "NESTED_INTERVALS_REBALANCE_THREADS", 1)
+
+INTERVAL_UPDATE_BATCH_SIZE = getattr(settings, "NESTED_INTERVALS_INTERVAL_UPDATE_BATCH_SIZE", 150)
+
+# compute layouts for rebalancing with NumPy, if it's installed
+USE_NUMPY = getattr(settings, "NESTED_INTERVALS_USE_NUMPY", True)
+
+# the Django cache (alias) that get_cached_ancestors/get_cached_descendants results are shared
+# through; when None, they're only cached in the local memory of each process
+CACHE = getattr(settings, "NESTED_INTERVALS_CACHE", None)
+
+CACHE_TIMEOUT = getattr(settings, "NESTED_INTERVALS_CACHE_TIMEOUT", 3600)
+
+# the number of results kept in the local memory tier (least recently used first out)
+LOCAL_CACHE_SIZE = getattr(settings, "NESTED_INTERVALS_LOCAL_CACHE_SIZE", 1000)
+
+# how long (in seconds) a process trusts the version of a tree it has read; changes made by the
+# process itself are seen straight away, those made by others after at most this long
+LOCAL_VERSION_TIMEOUT = getattr(settings, "NESTED_INTERVALS_LOCAL_VERSION_TIMEOUT", 1)
+
+# results with more nodes than this aren't cached
+CACHE_MAX_NODES = getattr(settings, "NESTED_INTERVALS_CACHE_MAX_NODES", 1000)
+
+# the database aliases that nested_intervals.routers.TreeReplicaRouter sends tree reads to
+READ_REPLICAS = getattr(settings, "NESTED_INTERVALS_READ_REPLICAS", [])
+
+# how long (in seconds) a thread keeps reading a tree it changed from the primary
+PRIMARY_READ_WINDOW = getattr(settings, "NESTED_INTERVALS_PRIMARY_READ_WINDOW", 5)
+
+# the database aliases that nested_intervals.routers.TreeShardRouter spreads trees across
+TREE_SHARDS = getattr(settings, "NESTED_INTERVALS_TREE_SHARDS", [])
@@ -0,0 +1,95 @@
+"""
+Array-based computation of tree layouts, using NumPy when it's installed (and enabled with
+``NESTED_INTERVALS_USE_NUMPY``), with a pure Python fallback.
+
+Layouts are computed as integer positions: laying out ``n`` nodes evenly gives their ``2n``
+left and right values consecutive positions ``0 .. 2n-1``, in the order they're reached by a
+walk of the tree. For the ``i``-th node in tree order, at depth ``d`` below the first node's
+level, whose last descendant is the ``e``-th node, that's ``2i - d`` for the left value and
+``2e + 1 - d`` for the right value. Positions are exact, so they can then be scaled to
+decimal values without any rounding creeping in.
+"""
+from __future__ import unicode_literals
+
+from .conf import USE_NUMPY
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# with more distinct levels than this, the vectorized search for subtree ends (one pass per
+# level) stops paying off, and the single pass of the pure Python version is used instead
+MAX_VECTORIZED_LEVELS = 256
+
+
+def numpy_available():
+    """
+    Returns ``True`` if layouts will be computed with NumPy.
+    """
+    return numpy is not None and USE_NUMPY
+
+
+def get_layout_positions(levels):
+    """
+    Takes the levels of a list of nodes in tree order (a subtree, or consecutive siblings and
+    their descendants) and returns the ``(lefts, rights)`` positions of the nodes when laid out
+    evenly, as two sequences of integers (NumPy arrays, if NumPy is being used).
+    """
+    if numpy_available():
+        levels = numpy.asarray(levels, dtype=numpy.int64)
+        if len(numpy.unique(levels)) <= MAX_VECTORIZED_LEVELS:
+            return _get_layout_positions_numpy(levels)
+        levels = levels.tolist()
+    return _get_layout_positions_python(levels)
+
+
+def _get_layout_positions_numpy(levels):
+    count = len(levels)
+    if not count:
+        return numpy.zeros(0, dtype=numpy.int64), numpy.zeros(0, dtype=numpy.int64)
+
+    # the last descendant of each node is the node just before the next node (if any) at the
+    # same level or above, which is found with a binary search per level
+    ends = numpy.empty(count, dtype=numpy.int64)
+    for level in numpy.unique(levels):
+        nodes = numpy.flatnonzero(levels == level)
+        stops = numpy.append(numpy.flatnonzero(levels <= level), count)
+        ends[nodes] = stops[numpy.searchsorted(stops, nodes, side="right")] - 1
+
+    depths = levels - levels[0]
+    lefts = 2 * numpy.arange(count, dtype=numpy.int64) - depths
+    rights = 2 * ends + 1 - depths
+    return lefts, rights
+
+
+def _get_layout_positions_python(levels):
+    lefts = []
+    rights = []
+    # positions of the nodes that haven't been closed yet
+    stack = []
+    position = 0
+    for index, level in enumerate(levels):
+        # close off any nodes that this one isn't nested inside of
+        while stack and levels[stack[-1]] >= level:
+            rights[stack.pop()] = position
+            position += 1
+        lefts.append(position)
+        rights.append(None)
+        stack.append(index)
+        position += 1
+    while stack:
+        rights[stack.pop()] = position
+        position += 1
+    return lefts, rights
+
+
+def get_evenly_spaced_bounds(levels, left, increment):
+    """
+    Returns the ``(left, right)`` decimal values of the nodes with the given ``levels`` (in tree
+    order), laid out so that consecutive values are ``increment`` apart, starting from ``left``.
+    """
+    lefts, rights = get_layout_positions(levels)
+    if numpy is not None and isinstance(lefts, numpy.ndarray):
+        lefts, rights = lefts.tolist(), rights.tolist()
+    return [(left + increment * start, left + increment * end) for start, end in zip(lefts, rights)]
@@ -17,4 +17,11 @@ class IntervalTooSmall(Exception):
     """
     The interval sizes resulting from an insertion would be too small to represent
     given the current number of decimal places. The calling code will need to rebalance.
-    """
\ No newline at end of file
+    """
+
+
+class RebalanceConflict(Exception):
+    """
+    An online rebalance kept being interrupted by concurrent changes to the tree,
+    and gave up before swapping in the new intervals.
+    """
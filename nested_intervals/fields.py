@@ -0,0 +1,74 @@
+"""
+Denormalized aggregates over each node's subtree, stored on the node itself, e.g.::
+
+    class Category(NestedIntervalsModel):
+        item_count = models.PositiveIntegerField(default=0)
+        descendant_count = DescendantCountField()
+        total_items = SubtreeSumField("item_count")
+
+They're kept up to date by ``NestedIntervalsManager.insert_node`` and ``move_node``,
+``save()`` and ``delete()``, each of which adjusts the ancestors of the affected node with
+one ``UPDATE``, so reading them is free. Bulk changes that bypass those (e.g. ``update()`` or
+``delete()`` on a ``QuerySet``) need to be followed by
+``NestedIntervalsManager.rebuild_subtree_aggregates``.
+"""
+from __future__ import unicode_literals
+
+from django.db import models
+
+
+class SubtreeAggregateField(object):
+    """
+    Base class for fields holding an aggregate over the subtree of each node.
+    """
+
+    def get_initial_value(self, node):
+        """
+        Returns the value of the field for ``node`` when it has no descendants.
+        """
+        raise NotImplementedError("Subclasses of SubtreeAggregateField must implement get_initial_value()")
+
+    def get_subtree_value(self, node):
+        """
+        Returns how much the subtree rooted at ``node`` adds to the field of each of its ancestors.
+        """
+        raise NotImplementedError("Subclasses of SubtreeAggregateField must implement get_subtree_value()")
+
+
+class DescendantCountField(SubtreeAggregateField, models.PositiveIntegerField):
+    """
+    The number of descendants of the node.
+    """
+
+    def __init__(self, *args, **kwargs):
+        kwargs.setdefault("default", 0)
+        kwargs.setdefault("editable", False)
+        super(DescendantCountField, self).__init__(*args, **kwargs)
+
+    def get_initial_value(self, node):
+        return 0
+
+    def get_subtree_value(self, node):
+        return getattr(node, self.attname) + 1
+
+
+class SubtreeSumField(SubtreeAggregateField, models.BigIntegerField):
+    """
+    The sum of the integer field ``source`` over the node and all of its descendants.
+    """
+
+    def __init__(self, source, *args, **kwargs):
+        self.source = source
+        kwargs.setdefault("default", 0)
+        kwargs.setdefault("editable", False)
+        super(SubtreeSumField, self).__init__(*args, **kwargs)
+
+    def deconstruct(self):
+        name, path, args, kwargs = super(SubtreeSumField, self).deconstruct()
+        return name, path, [self.source] + list(args), kwargs
+
+    def get_initial_value(self, node):
+        return getattr(node, self.source) or 0
+
+    def get_subtree_value(self, node):
+        return getattr(node, self.attname)
@@ -0,0 +1,320 @@
+"""
+An in-memory index of the structure of trees, for answering structural questions
+(ancestors, descendants, children, ...) without going to the database.
+"""
+from __future__ import unicode_literals
+from array import array
+from bisect import bisect_left
+
+from django.utils import six
+
+
+def _make_array(typecode, values):
+    values = list(values)
+    try:
+        return array(typecode, values)
+    except ValueError:
+        # Python 2 has no "q" arrays, and "l" ones are the widest it has
+        return _make_array("l", values) if typecode == "q" else values
+    except (TypeError, OverflowError):
+        # e.g. UUID primary keys
+        return values
+
+
+def _get_tree_layout(rows):
+    """
+    Takes the ``(pk, left, right, level)`` rows of one tree, ordered by ``left``, and returns
+    lists of the pks, left and right ranks, levels and parent positions of the nodes, in tree
+    order. Rather than the left and right values themselves, the position of each value in the
+    sorted list of all of the tree's left and right values is used, so they fit in plain
+    integer arrays and compare exactly.
+    """
+    pks, lefts, rights, levels, parents = [], [], [], [], []
+    # (position, right) pairs for the nodes that haven't been closed yet
+    stack = []
+    rank = 0
+    for pk, left, right, level in rows:
+        while stack and stack[-1][1] < left:
+            rights[stack.pop()[0]] = rank
+            rank += 1
+        position = len(pks)
+        pks.append(pk)
+        lefts.append(rank)
+        rights.append(None)
+        levels.append(level)
+        parents.append(stack[-1][0] if stack else -1)
+        stack.append((position, right))
+        rank += 1
+    while stack:
+        rights[stack.pop()[0]] = rank
+        rank += 1
+    return pks, lefts, rights, levels, parents
+
+
+class _TreeSegment(object):
+    """
+    The nodes of one tree, in tree order, as parallel arrays.
+    """
+
+    def __init__(self, rows, state):
+        pks, lefts, rights, levels, parents = _get_tree_layout(rows)
+        self.pks = _make_array("q", pks)
+        self.lefts = array("l", lefts)
+        self.rights = array("l", rights)
+        self.levels = array("l", levels)
+        self.parents = array("l", parents)
+        self.state = state
+
+    def __len__(self):
+        return len(self.pks)
+
+    def subtree_end(self, position):
+        # the position just past the last descendant of the node at ``position``
+        return bisect_left(self.lefts, self.rights[position], position + 1)
+
+
+class TreeQueryMixin(object):
+    """
+    Structural queries over trees held as parallel arrays in tree order. Subclasses implement
+    ``_locate(pk)``, returning the node's segment (which has ``pks``, ``lefts``, ``rights``,
+    ``levels`` and ``parents`` sequences and a ``subtree_end(position)`` method) and position.
+    """
+
+    def _locate(self, pk):
+        raise NotImplementedError("Subclasses of TreeQueryMixin must implement _locate()")
+
+    def level(self, pk):
+        """
+        Returns the level of the node (0 for a root node).
+        """
+        segment, position = self._locate(pk)
+        return segment.levels[position]
+
+    def parent(self, pk):
+        """
+        Returns the pk of the node's parent, or ``None`` for a root node.
+        """
+        segment, position = self._locate(pk)
+        parent = segment.parents[position]
+        return None if parent < 0 else segment.pks[parent]
+
+    def ancestors(self, pk, ascending=False, include_self=False):
+        """
+        Returns a list of the pks of the node's ancestors, root first (unless ``ascending``).
+        """
+        segment, position = self._locate(pk)
+        ancestors = [pk] if include_self else []
+        position = segment.parents[position]
+        while position >= 0:
+            ancestors.append(segment.pks[position])
+            position = segment.parents[position]
+        if not ascending:
+            ancestors.reverse()
+        return ancestors
+
+    def descendants(self, pk, include_self=False):
+        """
+        Returns a list of the pks of the node's descendants, in tree order.
+        """
+        segment, position = self._locate(pk)
+        start = position if include_self else position + 1
+        return list(segment.pks[start:segment.subtree_end(position)])
+
+    def descendant_count(self, pk):
+        """
+        Returns the number of descendants the node has.
+        """
+        segment, position = self._locate(pk)
+        return segment.subtree_end(position) - position - 1
+
+    def children(self, pk):
+        """
+        Returns a list of the pks of the node's children, in order.
+        """
+        segment, position = self._locate(pk)
+        end = segment.subtree_end(position)
+        children = []
+        child = position + 1
+        while child < end:
+            children.append(segment.pks[child])
+            child = segment.subtree_end(child)
+        return children
+
+    def is_descendant_of(self, pk, other, include_self=False):
+        """
+        Returns ``True`` if the node ``pk`` is a descendant of the node ``other``.
+        """
+        segment, position = self._locate(pk)
+        other_segment, other_position = self._locate(other)
+        if segment is not other_segment:
+            return False
+        if position == other_position:
+            return include_self
+        return (segment.lefts[other_position] < segment.lefts[position]
+                and segment.rights[position] < segment.rights[other_position])
+
+    def is_ancestor_of(self, pk, other, include_self=False):
+        """
+        Returns ``True`` if the node ``pk`` is an ancestor of the node ``other``.
+        """
+        return self.is_descendant_of(other, pk, include_self=include_self)
+
+
+class TreeIndex(TreeQueryMixin):
+    """
+    A read-only, in-memory index of the structure of the trees of a nested intervals
+    ``model`` (or just of the trees with the given ``tree_ids``), loaded with one ordered
+    query (per database, when the trees are spread across several). Nodes are identified by their primary keys.
+
+    Each tree is held as compact parallel arrays of primary keys, interval positions, levels
+    and parent positions, in tree order, so descendants are a contiguous slice found by
+    bisecting on the left values, and ancestors are found by following parent positions.
+    Nodes are looked up by bisecting a sorted array of all of the primary keys, which need to
+    be unique across all of the databases when the trees are spread across several.
+
+    Call ``refresh()`` to bring the index up to date with the database; only the trees whose
+    versions (see ``NestedIntervalsManager.get_tree_version``) have changed since they were
+    loaded are read again.
+    """
+
+    def __init__(self, model, tree_ids=None):
+        self.model = model
+        self.tree_ids = None if tree_ids is None else set(self._to_tree_id(tree_id) for tree_id in tree_ids)
+        self._segments = {}
+        self._lookup = None
+        self.refresh()
+
+    def _to_tree_id(self, tree_id):
+        return self.model._meta.get_field("tree_id").to_python(tree_id)
+
+    def _get_querysets(self, tree_ids=None):
+        # a queryset for each database the trees are in (see NestedIntervalsManager.get_databases)
+        if tree_ids is None:
+            tree_ids = self.tree_ids
+        querysets = []
+        for manager, ids in self.model.objects._group_by_database(tree_ids):
+            queryset = manager.all()
+            if ids is not None:
+                queryset = queryset.filter(tree_id__in=ids)
+            querysets.append(queryset)
+        return querysets
+
+    def _get_tree_states(self, tree_ids=None):
+        # the versions of the trees that currently exist
+        roots = [
+            tree_id for queryset in self._get_querysets(tree_ids)
+            for tree_id in queryset.filter(level=0).values_list("tree_id", flat=True)
+        ]
+        versions = self.model.objects.get_tree_versions(self.tree_ids if tree_ids is None else tree_ids)
+        return dict((tree_id, versions.get(tree_id, 0)) for tree_id in roots)
+
+    def refresh(self):
+        """
+        Reloads the trees that have been changed, added or removed since they were
+        loaded, leaving the others as they are. Returns the ids of the reloaded trees.
+        """
+        states = self._get_tree_states()
+        for tree_id in set(self._segments) - set(states):
+            self._drop_tree(tree_id)
+        changed = [
+            tree_id for tree_id, state in six.iteritems(states)
+            if tree_id not in self._segments or self._segments[tree_id].state != state
+        ]
+        self._load_trees(changed, states)
+        return changed
+
+    def refresh_tree(self, tree_id):
+        """
+        Reloads the tree with the given ``tree_id`` if it has changed since it was loaded.
+        Returns ``True`` if it was reloaded.
+        """
+        tree_id = self._to_tree_id(tree_id)
+        states = self._get_tree_states([tree_id])
+        if tree_id not in states:
+            self._drop_tree(tree_id)
+            return False
+        if tree_id in self._segments and self._segments[tree_id].state == states[tree_id]:
+            return False
+        self._load_trees([tree_id], states)
+        return True
+
+    def _drop_tree(self, tree_id):
+        if self._segments.pop(tree_id, None) is not None:
+            self._lookup = None
+
+    def _load_trees(self, tree_ids, states):
+        if not tree_ids:
+            return
+        by_tree = dict((tree_id, []) for tree_id in tree_ids)
+        for queryset in self._get_querysets(tree_ids):
+            rows = queryset.order_by("tree_id", "left").values_list("tree_id", "pk", "left", "right", "level")
+            for tree_id, pk, left, right, level in rows.iterator():
+                by_tree[tree_id].append((pk, left, right, level))
+        for tree_id, tree_rows in six.iteritems(by_tree):
+            self._drop_tree(tree_id)
+            self._segments[tree_id] = _TreeSegment(tree_rows, states[tree_id])
+        self._lookup = None
+
+    def _get_lookup(self):
+        # the sorted pks of all of the nodes in the index, with the tree (as an index into the
+        # list of tree ids) and position in the tree of each, rebuilt when next needed after
+        # trees have been loaded or dropped
+        if self._lookup is None:
+            tree_ids = list(self._segments)
+            pks, slots, positions = [], [], []
+            for slot, tree_id in enumerate(tree_ids):
+                segment = self._segments[tree_id]
+                pks.extend(segment.pks)
+                slots.extend([slot] * len(segment))
+                positions.extend(range(len(segment)))
+            order = sorted(range(len(pks)), key=pks.__getitem__)
+            self._lookup = (
+                _make_array("q", [pks[i] for i in order]),
+                array("l", [slots[i] for i in order]),
+                array("l", [positions[i] for i in order]),
+                tree_ids,
+            )
+        return self._lookup
+
+    def _find(self, pk):
+        # the tree_id and position of the node, or None if it isn't in the index
+        pks, slots, positions, tree_ids = self._get_lookup()
+        try:
+            index = bisect_left(pks, pk)
+        except TypeError:
+            # a pk of another type altogether
+            return None
+        if index == len(pks) or pks[index] != pk:
+            return None
+        return tree_ids[slots[index]], positions[index]
+
+    def _locate(self, pk):
+        found = self._find(pk)
+        if found is None:
+            raise self.model.DoesNotExist("There is no node with pk %r in the index." % (pk,))
+        return self._segments[found[0]], found[1]
+
+    def __len__(self):
+        return len(self._get_lookup()[0])
+
+    def __contains__(self, pk):
+        return self._find(pk) is not None
+
+    def get_tree_ids(self):
+        """
+        Returns the ids of the trees in the index.
+        """
+        return list(self._segments)
+
+    def tree_id(self, pk):
+        """
+        Returns the ``tree_id`` of the tree the node is in.
+        """
+        self._locate(pk)
+        return self._find(pk)[0]
+
+    def root(self, tree_id):
+        """
+        Returns the pk of the root node of the tree with the given ``tree_id``.
+        """
+        return self._segments[self._to_tree_id(tree_id)].pks[0]
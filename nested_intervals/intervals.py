@@ -4,10 +4,14 @@ from decimal import getcontext
 from django.db.models.query import F
 
 from .conf import DECIMAL_PLACES
+from .engine import get_evenly_spaced_bounds
 from .exceptions import IntervalTooSmall
 
 getcontext().prec = DECIMAL_PLACES
 
+# the smallest gap between two bounds that can still be stored at the configured precision
+MIN_INCREMENT = Decimal("10") ** -DECIMAL_PLACES
+
 
 def get_range_conversion_f_expression_generator(old_left, old_right, new_left, new_right):
     old_size = old_right - old_left
@@ -16,6 +20,10 @@ def get_range_conversion_f_expression_generator(old_left, old_right, new_left, n
     def f_expression_generator(field):
         return (((F(field) - old_left) * new_size) / old_size) + new_left
 
+    def rescale(value):
+        return (((value - old_left) * new_size) / old_size) + new_left
+
+    f_expression_generator.rescale = rescale
     return f_expression_generator
 
 
@@ -32,7 +40,53 @@ def _calculate_sub_interval(outerleft, outerright, count):
     return result
 
 
-def get_interval_for_insertion_relative_to(target, position, count=1):
+def get_evenly_spaced_intervals(nodes, left, increment):
+    """
+    Lays out the given ``(pk, level)`` pairs, which must be in tree order, so that consecutive
+    left/right values are exactly ``increment`` apart, starting from ``left``.
+
+    Returns a dict mapping each pk to its new ``(left, right)`` pair.
+    """
+    if increment < MIN_INCREMENT:
+        raise IntervalTooSmall("The interval has gotten too small! Oh noes!")
+
+    pks = [pk for pk, _ in nodes]
+    bounds = get_evenly_spaced_bounds([level for _, level in nodes], left, increment)
+    return dict(zip(pks, bounds))
+
+
+class _DatabaseNeighbours(object):
+    # looks up the nodes an insertion goes between with the target's own queries
+
+    @staticmethod
+    def first_child(node):
+        return node.get_children().first()
+
+    @staticmethod
+    def last_child(node):
+        return node.get_children().last()
+
+    @staticmethod
+    def previous_sibling(node):
+        return node.get_previous_sibling()
+
+    @staticmethod
+    def next_sibling(node):
+        return node.get_next_sibling()
+
+    @staticmethod
+    def parent(node):
+        return node.parent
+
+
+def get_interval_for_insertion_relative_to(target, position, count=1, neighbours=None):
+    """
+    Returns the interval for inserting ``count`` nodes relative to ``target``. The nodes it
+    goes between are looked up through ``neighbours`` (e.g. a ``TreeBatch``), if given, or else
+    with the target's own queries; only their ``left`` and ``right`` values are used.
+    """
+    if neighbours is None:
+        neighbours = _DatabaseNeighbours
     if position not in ["first-child", "last-child", "left", "right"]:
         raise ValueError('An invalid position was given: %s.' % position)
 
@@ -47,29 +101,29 @@ def get_interval_for_insertion_relative_to(target, position, count=1):
 
     if position == "first-child":
         # compute inserting to the left of the first child
-        first_child = target.get_children().first()
+        first_child = neighbours.first_child(target)
         if first_child:
             return _calculate_sub_interval(target.left, first_child.left, count)
         else:
             return _calculate_sub_interval(target.left, target.right, count)
     elif position == "last-child":
         # compute inserting to the right of the last child
-        last_child = target.get_children().last()
+        last_child = neighbours.last_child(target)
         if last_child:
             return _calculate_sub_interval(last_child.right, target.right, count)
         else:
             return _calculate_sub_interval(target.left, target.right, count)
     elif position == "left":
         # compute inserting to the left of the target
-        previous = target.get_previous_sibling()
+        previous = neighbours.previous_sibling(target)
         if previous:
             return _calculate_sub_interval(previous.right, target.left, count)
         else:
-            return _calculate_sub_interval(target.parent.left, target.left, count)
+            return _calculate_sub_interval(neighbours.parent(target).left, target.left, count)
     elif position == "right":
         # compute inserting to the right of the target
-        nxt = target.get_next_sibling()
+        nxt = neighbours.next_sibling(target)
         if nxt:
             return _calculate_sub_interval(target.right, nxt.left, count)
         else:
-            return _calculate_sub_interval(target.right, target.parent.right, count)
+            return _calculate_sub_interval(target.right, neighbours.parent(target).right, count)
@@ -0,0 +1,66 @@
+"""
+Expressions and lookups for filtering on the subtree of a node in the same query, e.g. across
+a relation to a nested intervals model::
+
+    Item.objects.filter(category__descendant_of=node)
+    Item.objects.filter(category__ancestor_of=node)
+    Item.objects.filter(category__in=Descendants(node, include_self=True))
+
+They compile into a subquery on ``tree_id`` and interval containment, so the database can
+use its ``(tree_id, left)`` index rather than being handed a long list of primary keys.
+"""
+from __future__ import unicode_literals
+
+from django.db.models import ForeignObject, Lookup, Subquery
+
+
+class Descendants(Subquery):
+    """
+    A subquery of the ``field`` (the primary key, by default) of the descendants of ``node``,
+    down to ``max_depth`` levels below it if given, for use with ``__in``.
+    """
+
+    def __init__(self, node, include_self=False, max_depth=None, field="pk", **kwargs):
+        queryset = node._get_descendants_queryset(include_self, max_depth)
+        super(Descendants, self).__init__(queryset.order_by().values(field), **kwargs)
+
+
+class Ancestors(Subquery):
+    """
+    A subquery of the ``field`` (the primary key, by default) of the ancestors of ``node``,
+    for use with ``__in``.
+    """
+
+    def __init__(self, node, include_self=False, field="pk", **kwargs):
+        queryset = node._get_ancestors_queryset(False, include_self)
+        super(Ancestors, self).__init__(queryset.order_by().values(field), **kwargs)
+
+
+class _SubtreeLookup(Lookup):
+    prepare_rhs = False
+    expression = None
+
+    def get_prep_lookup(self):
+        field = self.lhs.output_field
+        if not isinstance(self.rhs, field.related_model) or not hasattr(self.rhs, "_get_descendants_queryset"):
+            raise ValueError(
+                "The %s lookup needs a %s instance from a nested intervals model." % (
+                    self.lookup_name, field.related_model.__name__))
+        return self.expression(self.rhs, field=field.target_field.name)
+
+    def as_sql(self, compiler, connection):
+        lhs, lhs_params = self.process_lhs(compiler, connection)
+        rhs, rhs_params = compiler.compile(self.rhs.resolve_expression(compiler.query))
+        return "%s IN %s" % (lhs, rhs), list(lhs_params) + list(rhs_params)
+
+
+@ForeignObject.register_lookup
+class DescendantOf(_SubtreeLookup):
+    lookup_name = "descendant_of"
+    expression = Descendants
+
+
+@ForeignObject.register_lookup
+class AncestorOf(_SubtreeLookup):
+    lookup_name = "ancestor_of"
+    expression = Ancestors
@@ -0,0 +1,19 @@
+from __future__ import unicode_literals
+
+from django.apps import apps
+from django.core.management.base import CommandError
+
+from nested_intervals.models import NestedIntervalsModel
+
+
+def get_tree_model(label):
+    """
+    Returns the nested intervals model with the given ``app_label.ModelName`` label.
+    """
+    try:
+        model = apps.get_model(label)
+    except (LookupError, ValueError) as e:
+        raise CommandError(str(e))
+    if not issubclass(model, NestedIntervalsModel):
+        raise CommandError("%s is not a nested intervals model." % label)
+    return model
@@ -0,0 +1,28 @@
+from __future__ import unicode_literals
+import io
+
+from django.core.management.base import BaseCommand
+
+from nested_intervals.serialization import export_tree
+
+from ._utils import get_tree_model
+
+
+class Command(BaseCommand):
+    help = "Exports a tree of a nested intervals model as JSON lines."
+
+    def add_arguments(self, parser):
+        parser.add_argument("model", help="The model to export from, as app_label.ModelName.")
+        parser.add_argument("tree_id", help="The tree_id of the tree to export.")
+        parser.add_argument(
+            "-o", "--output", default=None,
+            help="The file to write the tree to (defaults to standard output).",
+        )
+
+    def handle(self, *args, **options):
+        model = get_tree_model(options["model"])
+        if options["output"]:
+            with io.open(options["output"], "w", encoding="utf-8") as stream:
+                export_tree(model, options["tree_id"], stream)
+        else:
+            export_tree(model, options["tree_id"], self.stdout)
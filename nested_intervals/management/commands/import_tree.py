@@ -0,0 +1,36 @@
+from __future__ import unicode_literals
+import io
+import sys
+
+from django.core.management.base import BaseCommand, CommandError
+
+from nested_intervals.serialization import import_tree
+
+from ._utils import get_tree_model
+
+
+class Command(BaseCommand):
+    help = "Imports a tree exported with export_tree as a new tree."
+
+    def add_arguments(self, parser):
+        parser.add_argument("model", help="The model to import into, as app_label.ModelName.")
+        parser.add_argument(
+            "-i", "--input", default=None,
+            help="The file to read the tree from (defaults to standard input).",
+        )
+        parser.add_argument(
+            "--batch-size", type=int, default=500,
+            help="The number of nodes to create at a time.",
+        )
+
+    def handle(self, *args, **options):
+        model = get_tree_model(options["model"])
+        try:
+            if options["input"]:
+                with io.open(options["input"], encoding="utf-8") as stream:
+                    root = import_tree(model, stream, batch_size=options["batch_size"])
+            else:
+                root = import_tree(model, sys.stdin, batch_size=options["batch_size"])
+        except ValueError as e:
+            raise CommandError(str(e))
+        self.stdout.write("Imported the tree %s (root node %s)." % (root.tree_id, root.pk))
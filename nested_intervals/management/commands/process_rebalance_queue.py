@@ -0,0 +1,24 @@
+from __future__ import unicode_literals
+
+from django.core.management.base import BaseCommand
+
+from nested_intervals.rebalancing import process_pending_rebalances
+
+
+class Command(BaseCommand):
+    help = "Rebalances the trees queued by DatabaseQueueRebalanceExecutor."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--limit", type=int, default=None,
+            help="The maximum number of trees to rebalance in this run.",
+        )
+        parser.add_argument(
+            "--database", action="append", dest="databases", default=None,
+            help="A database whose queue to process (can be repeated); by default, every "
+                 "database that trees are kept in.",
+        )
+
+    def handle(self, *args, **options):
+        processed = process_pending_rebalances(limit=options["limit"], databases=options["databases"])
+        self.stdout.write("Rebalanced %d tree(s)." % processed)
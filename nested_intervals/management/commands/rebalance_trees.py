@@ -0,0 +1,67 @@
+from __future__ import unicode_literals
+
+from django.core.management.base import BaseCommand
+
+from ._utils import get_tree_model
+
+
+class Command(BaseCommand):
+    help = "Rebalances the trees of a nested intervals model, optionally in parallel."
+
+    def add_arguments(self, parser):
+        parser.add_argument("model", help="The model to rebalance, as app_label.ModelName.")
+        parser.add_argument(
+            "--tree-id", action="append", dest="tree_ids", default=None,
+            help="Only rebalance the tree with this tree_id (may be given more than once).",
+        )
+        parser.add_argument(
+            "--workers", type=int, default=1,
+            help="The number of trees to rebalance at the same time.",
+        )
+        parser.add_argument(
+            "--processes", action="store_true", default=False,
+            help="Use worker processes rather than threads.",
+        )
+        parser.add_argument(
+            "--min-headroom", type=int, default=None,
+            help="Only rebalance trees with fewer than this many decimal places of headroom left.",
+        )
+        parser.add_argument(
+            "--dry-run", action="store_true", default=False,
+            help="Report which trees would be rebalanced, without changing anything.",
+        )
+
+    def handle(self, *args, **options):
+        model = get_tree_model(options["model"])
+
+        results = model.objects.rebalance_trees(
+            tree_ids=options["tree_ids"],
+            workers=options["workers"],
+            use_processes=options["processes"],
+            min_headroom=options["min_headroom"],
+            dry_run=options["dry_run"],
+        )
+
+        if options["dry_run"]:
+            action = "would rebalance"
+        else:
+            action = "rebalanced"
+        total_rows = 0
+        total_time = 0
+        for result in results:
+            total_rows += result.rows
+            total_time += result.duration
+            self.stdout.write("%s\theadroom=%d\t%s\trows=%d\t%.3fs" % (
+                result.tree_id,
+                result.headroom,
+                action if result.rebalanced else "skipped",
+                result.rows,
+                result.duration,
+            ))
+        self.stdout.write("%d of %d tree(s) %s, %d row(s) in %.3fs." % (
+            len([result for result in results if result.rebalanced]),
+            len(results),
+            action,
+            total_rows,
+            total_time,
+        ))
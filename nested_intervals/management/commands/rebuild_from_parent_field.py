@@ -0,0 +1,43 @@
+from __future__ import unicode_literals
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from ._utils import get_tree_model
+
+
+class Command(BaseCommand):
+    help = "Rebuilds the nested intervals fields of a model from an adjacency list (parent) column."
+
+    def add_arguments(self, parser):
+        parser.add_argument("model", help="The model to rebuild, as app_label.ModelName.")
+        parser.add_argument("field", help="The name of the field holding each node's parent.")
+        parser.add_argument(
+            "--order-by", action="append", dest="order_by", default=None,
+            help="The field to order siblings by (may be given more than once; defaults to pk).",
+        )
+        parser.add_argument(
+            "--batch-size", type=int, default=None,
+            help="The number of nodes to write per batch of UPDATE statements.",
+        )
+
+    def handle(self, *args, **options):
+        model = get_tree_model(options["model"])
+
+        kwargs = {}
+        if options["order_by"]:
+            kwargs["order_by"] = options["order_by"]
+        if options["batch_size"]:
+            kwargs["batch_size"] = options["batch_size"]
+
+        start = time.time()
+        try:
+            count = model.objects.rebuild_from_parent_field(options["field"], **kwargs)
+        except ValueError as e:
+            raise CommandError(str(e))
+
+        self.stdout.write("Rebuilt %d node(s) in %d tree(s) in %.3fs." % (
+            count,
+            len(model.objects._get_tree_ids()),
+            time.time() - start,
+        ))
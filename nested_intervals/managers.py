@@ -3,17 +3,175 @@ A custom manager for working with trees of objects.
 """
 from __future__ import unicode_literals
 import functools
+import inspect
+import random
+import threading
 import uuid
+from bisect import bisect_left
+from collections import namedtuple
+from contextlib import contextmanager
 
-from django.db import models, connections, router, transaction
-from django.db.models import F
+from django.core.exceptions import ImproperlyConfigured
+from django.db import IntegrityError, models, connections, router, transaction
+from django.db.models import Case, F, Func, IntegerField, Max, OuterRef, Q, Subquery, Value, When
+from django.db.models.fields import AutoField
+from django.db.models.functions import Coalesce
 
 from decimal import Decimal
 
-from .exceptions import InvalidMove, IntervalTooSmall
+from .conf import DECIMAL_PLACES, DEFERRED_REBALANCE, INTERVAL_UPDATE_BATCH_SIZE
+from .exceptions import InvalidMove, IntervalTooSmall, RebalanceConflict
+from .fields import SubtreeAggregateField
 from .querysets import NestedIntervalsQuerySet
+from .rebalancing import rebalance_trees_in_pool, schedule_rebalance
+from .routers import reading_from_primary, record_tree_write
+from .signals import tree_changed
 
-from .intervals import get_interval_for_insertion_relative_to, get_range_conversion_f_expression_generator
+from .intervals import (
+    get_evenly_spaced_intervals,
+    get_interval_for_insertion_relative_to,
+    get_range_conversion_f_expression_generator,
+)
+
+
+# the tree_batch() in progress in each thread, per tree model
+_tree_batches = threading.local()
+
+
+# the interval of a node, as kept by a TreeBatch
+_NodeBounds = namedtuple("_NodeBounds", ["pk", "left", "right"])
+
+
+class TreeBatch(object):
+    """
+    The trees that need rebalancing, and the trees whose versions need bumping, once a
+    ``tree_batch()`` is done.
+
+    It also keeps a view of the families (the interval of a node and those of its children) that
+    insertions and moves in the batch have gone into, so the ones that follow next to them find
+    their neighbours without querying the database (see ``get_interval_for_insertion_relative_to``).
+    Insertions add the new node to the view; any other change to a tree forgets its families.
+    """
+
+    def __init__(self):
+        self.rebalance_tree_ids = []
+        self.changed_tree_ids = []
+        # (tree_id, pk) -> (bounds of the node, bounds of its children in order)
+        self._families = {}
+        # (tree_id, pk) -> pk of the parent, for the children in the families
+        self._parents = {}
+        # (node, target, position) of the nodes inserted in the batch, until they're in the view
+        self._inserted = []
+
+    def _add(self, tree_ids, tree_id):
+        if tree_id not in tree_ids:
+            tree_ids.append(tree_id)
+
+    def _get_family(self, node):
+        self._add_inserted_nodes()
+        key = (node.tree_id, node.pk)
+        if key not in self._families:
+            children = [_NodeBounds(*values) for values in node.get_children().values_list("pk", "left", "right")]
+            self._families[key] = (_NodeBounds(node.pk, node.left, node.right), children)
+            for child in children:
+                self._parents[(node.tree_id, child.pk)] = node.pk
+        return self._families[key]
+
+    def _get_parent_family(self, node):
+        self._add_inserted_nodes()
+        parent_pk = self._parents.get((node.tree_id, node.pk))
+        if parent_pk is None:
+            return self._get_family(node.parent)
+        return self._families[(node.tree_id, parent_pk)]
+
+    def _get_sibling(self, node, offset):
+        children = self._get_parent_family(node)[1]
+        index = [child.pk for child in children].index(node.pk) + offset
+        return children[index] if 0 <= index < len(children) else None
+
+    def first_child(self, node):
+        children = self._get_family(node)[1]
+        return children[0] if children else None
+
+    def last_child(self, node):
+        children = self._get_family(node)[1]
+        return children[-1] if children else None
+
+    def previous_sibling(self, node):
+        return self._get_sibling(node, -1)
+
+    def next_sibling(self, node):
+        return self._get_sibling(node, 1)
+
+    def parent(self, node):
+        return self._get_parent_family(node)[0]
+
+    def _node_inserted(self, node, target, position):
+        # (added to the view once it has been saved, e.g. by the save() that inserted it)
+        self._inserted.append((node, target, position))
+
+    def _add_inserted_nodes(self):
+        inserted, self._inserted = self._inserted, []
+        for node, target, position in inserted:
+            if node._state.adding:
+                self._inserted.append((node, target, position))
+                continue
+            if target is not None:
+                parent_pk = target.pk if "child" in position else self._parents.get((target.tree_id, target.pk))
+                family = self._families.get((node.tree_id, parent_pk))
+                if family is not None:
+                    children = family[1]
+                    bounds = _NodeBounds(node.pk, node.left, node.right)
+                    children.insert(bisect_left([child.left for child in children], node.left), bounds)
+                    self._parents[(node.tree_id, node.pk)] = parent_pk
+            self._families[(node.tree_id, node.pk)] = (_NodeBounds(node.pk, node.left, node.right), [])
+
+    def _forget_tree(self, tree_id):
+        self._inserted = [inserted for inserted in self._inserted if inserted[0].tree_id != tree_id]
+        for mapping in (self._families, self._parents):
+            for key in [key for key in mapping if key[0] == tree_id]:
+                del mapping[key]
+
+
+def tree_atomic(tree_arg):
+    """
+    Like ``transaction.atomic``, on the database of the tree given by the decorated method's
+    ``tree_arg`` argument (a node or a ``tree_id``), but without a savepoint of its own inside a
+    ``tree_batch()``. Tree reads made inside it go to the primary database (see
+    ``nested_intervals.routers``).
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def _fn(self, *args, **kwargs):
+            tree = inspect.getcallargs(func, self, *args, **kwargs)[tree_arg]
+            using = self._get_connection(tree_id=getattr(tree, "tree_id", tree)).alias
+            with transaction.atomic(using=using, savepoint=self._get_tree_batch() is None), reading_from_primary():
+                return func(self, *args, **kwargs)
+        return _fn
+    return decorator
+
+
+@contextmanager
+def _atomic_on(aliases):
+    # a transaction on each of the databases with the given aliases
+    if not aliases:
+        yield
+        return
+    with transaction.atomic(using=aliases[0]):
+        with _atomic_on(aliases[1:]):
+            yield
+
+
+def _aio():
+    # (imported when first used, as it needs Python 3 and asgiref)
+    from . import aio
+    return aio
+
+
+class _AggregateRow(object):
+    # the values of one node needed for rebuilding its subtree aggregates
+    def __init__(self, values):
+        self.__dict__.update(values)
 
 
 class NestedIntervalsManager(models.Manager.from_queryset(NestedIntervalsQuerySet)):
@@ -27,17 +185,20 @@ class NestedIntervalsManager(models.Manager.from_queryset(NestedIntervalsQuerySe
         """
         return super(NestedIntervalsManager, self).get_queryset(*args, **kwargs).order_by("tree_id", "left")
 
-    def get_queryset_descendants(self, queryset, include_self=False):
+    def get_queryset_descendants(self, queryset, include_self=False, max_depth=None):
         """
         Returns a queryset containing the descendants of all nodes in the
         given queryset.
 
         If ``include_self=True``, nodes in ``queryset`` will also
         be included in the result.
+
+        If ``max_depth`` is given, only the descendants down to that many
+        levels below each node are included.
         """
         qs = queryset.none()
         for node in queryset.all():
-            qs = qs | node.get_descendants(include_self=include_self)
+            qs = qs | node._get_descendants_queryset(include_self, max_depth)
         return qs.distinct()
 
     def get_queryset_ancestors(self, queryset, include_self=False):
@@ -53,10 +214,161 @@ class NestedIntervalsManager(models.Manager.from_queryset(NestedIntervalsQuerySe
             qs = qs | node.get_ancestors(include_self=include_self)
         return qs.distinct()
 
+    def add_related_count(self, queryset, rel_model, rel_field, count_attr, cumulative=True):
+        """
+        Adds a related item count to a given ``QuerySet`` using its
+        ``annotate`` method, as one query.
+
+        ``rel_model``
+           A connecting model which has a relation to this model.
+
+        ``rel_field``
+           The name of the field in ``rel_model`` which holds the
+           relation.
+
+        ``count_attr``
+           The name of an attribute which should be added to each item in
+           this ``QuerySet``, containing a count of how many instances
+           of ``rel_model`` are related to it through ``rel_field``.
+
+        ``cumulative``
+           If ``True``, the count will be for each item and all of its
+           descendants, otherwise it will be for each item itself.
+        """
+        if cumulative:
+            # the related rows attached anywhere within each node's interval
+            related = rel_model._default_manager.filter(**{
+                "%s__tree_id" % rel_field: OuterRef("tree_id"),
+                "%s__left__gte" % rel_field: OuterRef("left"),
+                "%s__left__lte" % rel_field: OuterRef("right"),
+            })
+        else:
+            related = rel_model._default_manager.filter(**{"%s__pk" % rel_field: OuterRef("pk")})
+        # an aggregate without any grouping, so the subquery gives a single count
+        counts = related.order_by().annotate(
+            _count=Func(F("pk"), function="COUNT", output_field=IntegerField()),
+        ).values("_count")
+        return queryset.annotate(**{count_attr: Subquery(counts, output_field=IntegerField())})
+
+    def _get_tree_model(self):
+        # the model whose table holds the tree fields, which is a parent model with multi-table
+        # inheritance
+        return self.model._meta.get_field("tree_id").model
+
+    def _get_tree_label(self):
+        # trees (and their batches, versions and queued rebalances) are shared by models whose
+        # tree fields live in the same table, i.e. proxies and multi-table inheritance children
+        return self._get_tree_model()._meta.label_lower
+
+    def _get_tree_batch(self):
+        return getattr(_tree_batches, "batches", {}).get(self._get_tree_label())
+
+    @contextmanager
+    def tree_batch(self):
+        """
+        A context manager for making many changes to the trees of this model at once, e.g.::
+
+            with Category.objects.tree_batch():
+                for name in names:
+                    Category.objects.create(name=name, parent=parent)
+
+        The changes are made in one transaction, without a savepoint for each of them (so an
+        error aborts the whole batch). Insertions that run out of room only re-space the
+        smallest subtree they need to, and each tree that ran out of room is rebalanced once,
+        when the batch is done. Tree versions are bumped (and ``tree_changed`` sent) once per
+        changed tree, rather than once per change. Insertions next to nodes that earlier ones
+        went among find their neighbours in the batch's view of the tree (see ``TreeBatch``),
+        rather than querying for them. Nested batches join the outer one.
+
+        When the trees are spread across several databases, the batch has a transaction on each.
+        """
+        if self._get_tree_batch() is not None:
+            yield self._get_tree_batch()
+            return
+        batches = _tree_batches.__dict__.setdefault("batches", {})
+        batch = TreeBatch()
+        with _atomic_on(self.get_databases()), reading_from_primary():
+            batches[self._get_tree_label()] = batch
+            try:
+                yield batch
+                for tree_id in batch.rebalance_tree_ids:
+                    if self._for_tree(tree_id).filter(tree_id=tree_id, level=0).exists():
+                        self.rebalance_tree(tree_id)
+            finally:
+                del batches[self._get_tree_label()]
+            for tree_id in batch.changed_tree_ids:
+                self._bump_tree_version(tree_id)
+
     def _get_connection(self, **hints):
-        return connections[router.db_for_write(self.model, **hints)]
+        hints = dict(self._hints, **hints)
+        return connections[self._db or router.db_for_write(self.model, **hints)]
+
+    def _refresh_from_primary(self, node, fields=None):
+        # re-reads ``node`` after its tree has been written to, from the database that was
+        # written to rather than the one (perhaps a lagging replica) it was read from
+        node.refresh_from_db(using=self._get_connection(tree_id=node.tree_id).alias, fields=fields)
+
+    def _for_tree(self, tree_id):
+        """
+        Returns a copy of this manager whose queries go to the database of the tree with the
+        given ``tree_id``.
+        """
+        return self.db_manager(hints={"tree_id": tree_id})
+
+    def _get_shard_router(self):
+        for database_router in router.routers:
+            if hasattr(database_router, "get_shards"):
+                return database_router
+        return None
+
+    def _get_shards(self):
+        shard_router = self._get_shard_router()
+        return shard_router.get_shards(self.model) if shard_router else None
+
+    def get_databases(self):
+        """
+        Returns the aliases of the databases the trees of this model are spread across: the
+        shards of the first router with a ``get_shards()`` method (see
+        ``nested_intervals.routers.TreeShardRouter``), or else just the one writes go to.
+        """
+        shards = self._get_shards() if self._db is None else None
+        return shards or [self._get_connection().alias]
+
+    def _get_from_any_database(self, **kwargs):
+        # like get(), but looking in every database the trees are spread across
+        databases = self.get_databases()
+        if len(databases) == 1:
+            return self.get(**kwargs)
+        for alias in databases[:-1]:
+            try:
+                return self.db_manager(alias).get(**kwargs)
+            except self.model.DoesNotExist:
+                pass
+        return self.db_manager(databases[-1]).get(**kwargs)
+
+    def _group_by_database(self, tree_ids=None):
+        """
+        Returns ``(manager, tree_ids)`` pairs, for each database that any of the trees with the
+        given ``tree_ids`` are in, with a manager for that database and the ids of its trees. If
+        ``tree_ids`` is ``None``, there's a pair for every database, with ``None`` for the ids.
+        """
+        if tree_ids is None:
+            return [(self.db_manager(alias), None) for alias in self.get_databases()]
+        groups = {}
+        for tree_id in tree_ids:
+            groups.setdefault(self._get_connection(tree_id=tree_id).alias, []).append(tree_id)
+        return [(self.db_manager(alias), ids) for alias, ids in groups.items()]
+
+    def _get_interval_tolerance(self):
+        """
+        Returns how far apart interval values read back from the database may be from the
+        stored ones, for comparing them loosely.
+        """
+        if self._get_connection().vendor == "sqlite":
+            # SQLite stores decimals as floats, and hands them back rounded
+            return Decimal("1e-15")
+        return Decimal("0")
 
-    @transaction.atomic
     def insert_node(self, node, target, position='last-child', save=False):
         """
         Sets up the tree state for ``node`` (which has not yet been
@@ -72,14 +384,18 @@ class NestedIntervalsManager(models.Manager.from_queryset(NestedIntervalsQuerySe
 
         if node._is_saved():
             raise ValueError('Cannot insert a node which has already been saved.')
+        tree_id = self._new_tree_id() if target is None else target.tree_id
+        return self._insert_node(node, target, position, save, tree_id)
 
+    @tree_atomic("tree_id")
+    def _insert_node(self, node, target, position, save, tree_id):
         # it's a new node, and hence doesn't have any kids, so we can just set the node's fields
         if target is None:
             # if it has no target, we just make a new singleton tree
             node.level = 0
             node.left = Decimal("0")
             node.right = Decimal("1")
-            node.tree_id = uuid.uuid4()
+            node.tree_id = tree_id
         else:
             # if it has a target, insert it into the appropriate place relative to the target
             interval = self.get_interval_for_insertion_relative_to_with_rebalance(target, position=position)
@@ -90,23 +406,130 @@ class NestedIntervalsManager(models.Manager.from_queryset(NestedIntervalsQuerySe
                 node.level = target.level
             node.tree_id = target.tree_id
 
+        for field in self._get_aggregate_fields():
+            setattr(node, field.attname, field.get_initial_value(node))
+        self._attach_subtree_aggregates(node, target, position)
+
         node._nested_intervals_fields_have_changed = True
+        batch = self._get_tree_batch()
+        if batch is not None:
+            # (bumping the version would have the batch forget the tree, rather than add the node)
+            batch._add(batch.changed_tree_ids, node.tree_id)
+        else:
+            self._bump_tree_version(node.tree_id)
 
         if save:
             node.save(nested_intervals_update_in_progress=True)
+        if batch is not None:
+            batch._node_inserted(node, target, position)
         return node
 
+    def _new_tree_id(self, database=None):
+        """
+        Returns a ``tree_id`` for a new tree (one kept in ``database``, if given).
+
+        The id of a new tree decides which database it goes to (see
+        ``nested_intervals.routers.TreeShardRouter``), so it's allocated before anything is
+        written to the tree.
+        """
+        return self._new_tree_ids(1, database)[0]
+
+    def _new_tree_ids(self, count, database=None):
+        """
+        Returns a list of ``count`` ids for new trees: random UUIDs, or if the model's ``tree_id``
+        is an integer field (e.g. ``tree_id = models.BigIntegerField()``), the next numbers from
+        the model's counter.
+
+        If the trees are spread across several databases, the ids are of trees kept in
+        ``database`` if it's given. Integer ids are then counted per database, in the database
+        itself, and new trees without a ``database`` go to a random one.
+        """
+        shards = self._get_shards()
+        uuids = self.model._meta.get_field("tree_id").get_internal_type() == "UUIDField"
+        if not shards:
+            return [uuid.uuid4() for _ in range(count)] if uuids else self._allocate_tree_ids(count)
+        if uuids:
+            tree_ids = []
+            while len(tree_ids) < count:
+                tree_id = uuid.uuid4()
+                if database not in shards or router.db_for_write(self.model, tree_id=tree_id) == database:
+                    tree_ids.append(tree_id)
+            return tree_ids
+        if database not in shards:
+            database = random.choice(shards)
+        stride, offset = self._get_shard_router().get_tree_id_sequence(self.model, database)
+        return self._allocate_tree_ids(count, database, stride, offset)
+
+    def _allocate_tree_ids(self, count, database=None, stride=1, offset=0):
+        # counts out the ``n * stride + offset`` ids in the counter in ``database`` (or in the
+        # database writes go to)
+        from .models import TreeIdCounter
+        model = self._get_tree_model()
+        alias = database or self._get_connection().alias
+        counters = TreeIdCounter.objects.using(alias).filter(model=model._meta.label_lower)
+        with transaction.atomic(using=alias, savepoint=False):
+            if not counters.update(value=F("value") + count):
+                # carry on from any trees created before the counter was
+                start = (model._default_manager.using(alias).aggregate(start=Max("tree_id"))["start"] or 0) // stride
+                try:
+                    with transaction.atomic(using=alias):
+                        TreeIdCounter.objects.using(alias).create(model=model._meta.label_lower, value=start + count)
+                except IntegrityError:
+                    # created by someone else in the meantime
+                    counters.update(value=F("value") + count)
+            last = counters.values_list("value", flat=True).get()
+        return [n * stride + offset for n in range(last - count + 1, last + 1)]
+
     def get_interval_for_insertion_relative_to_with_rebalance(self, target, position, count=1):
+        """
+        Returns the interval for inserting ``count`` nodes relative to ``target``, making room
+        first if the intervals have gotten too tight. If room had to be made, the returned
+        interval will have ``"rebalanced"`` set to ``True``, and ``target`` will be refreshed.
+
+        Normally the whole tree is rebalanced right away. With ``NESTED_INTERVALS_DEFERRED_REBALANCE``
+        enabled, only the smallest enclosing subtree that has enough room is re-spaced, and the
+        full rebalance of the tree is handed to the rebalance executor after commit. Inside a
+        ``tree_batch()``, the full rebalance happens when the batch is done instead.
+        """
+        batch = self._get_tree_batch()
         try:
-            interval = get_interval_for_insertion_relative_to(target, position=position, count=count)
+            return get_interval_for_insertion_relative_to(target, position=position, count=count, neighbours=batch)
         except IntervalTooSmall:
+            pass
+
+        if batch is not None:
+            # make just enough room for now, and rebalance the whole tree once the batch is done
+            interval = self._respace_for_insertion(target, position, count)
+            batch._add(batch.rebalance_tree_ids, target.tree_id)
+        elif DEFERRED_REBALANCE:
+            interval = self._respace_for_insertion(target, position, count)
+            schedule_rebalance(self.model, target.tree_id)
+        else:
             # if needed due to the intervals getting too tight, rebalance the tree to make room
             self.rebalance_tree(target.tree_id)
-            target.refresh_from_db()
-            interval = get_interval_for_insertion_relative_to(target, position=position)
+            self._refresh_from_primary(target)
+            interval = get_interval_for_insertion_relative_to(target, position=position, count=count)
+        interval["rebalanced"] = True
         return interval
 
-    @transaction.atomic
+    def _respace_for_insertion(self, target, position, count):
+        """
+        Re-spaces the subtree the insertion will happen in, moving up the tree
+        until there is enough room for it.
+        """
+        container = target if "child" in position else target.parent
+        while True:
+            try:
+                self.rebalance_subtree(container)
+                self._refresh_from_primary(target)
+                return get_interval_for_insertion_relative_to(
+                    target, position=position, count=count, neighbours=self._get_tree_batch())
+            except IntervalTooSmall:
+                if container.is_root_node():
+                    raise
+                container = container.parent
+
+    @tree_atomic("node")
     def move_node(self, node, target, position='last-child'):
         """
         Moves ``node`` relative to a given ``target`` node as specified
@@ -124,6 +547,18 @@ class NestedIntervalsManager(models.Manager.from_queryset(NestedIntervalsQuerySe
         self._move_node(node, target, position)
         node.save(nested_intervals_update_in_progress=True)
 
+    def ainsert_node(self, node, target, position='last-child', save=False):
+        """
+        Async counterpart of ``insert_node``. See ``nested_intervals.aio``.
+        """
+        return _aio().ainsert_node(self, node, target, position, save)
+
+    def amove_node(self, node, target, position='last-child'):
+        """
+        Async counterpart of ``move_node``. See ``nested_intervals.aio``.
+        """
+        return _aio().amove_node(self, node, target, position)
+
     def _move_node(self, node, target, position='last-child'):
 
         # first check that we're not making any circular loops
@@ -138,14 +573,24 @@ class NestedIntervalsManager(models.Manager.from_queryset(NestedIntervalsQuerySe
             elif target and node.is_ancestor_of(target):
                 raise InvalidMove('A node may not be made a sibling of any of its descendants.')
 
+        if target is not None and self._get_connection(tree_id=target.tree_id) != self._get_connection(tree_id=node.tree_id):
+            raise InvalidMove("A node may not be moved to a tree in another database.")
+
+        # take the subtree's aggregates off its current ancestors
+        self._detach_subtree_aggregates(node)
+
         # first, calculate what we're going to need to change
         descendant_count = node.get_descendant_count()
         interval = self.get_interval_for_insertion_relative_to_with_rebalance(target, position=position, count=descendant_count+1)
+        if interval.get("rebalanced"):
+            # making room may have shifted the node we're moving, too
+            self._refresh_from_primary(node, ["left", "right"])
         converter = get_range_conversion_f_expression_generator(node.left, node.right, interval["left"], interval["right"])
         new_tree_id = None
         if target is None:
             level_offset = -node.level
-            new_tree_id = uuid.uuid4()
+            # (keeping the new tree in the same database)
+            new_tree_id = self._new_tree_id(self._get_connection(tree_id=node.tree_id).alias)
         else:
             if position in ["left", "right"]:
                 level_offset = target.level - node.level
@@ -163,65 +608,716 @@ class NestedIntervalsManager(models.Manager.from_queryset(NestedIntervalsQuerySe
                 updates["tree_id"] = new_tree_id
             if level_offset:
                 updates["level"] = F("level") + level_offset
+            updates.update(self._shadow_interval_resets())
             node.get_descendants().update(**updates)
 
         # update the current node itself
+        self._bump_tree_version(node.tree_id)
         node.left, node.right = interval["left"], interval["right"]
         node.level += level_offset
         if new_tree_id:
             node.tree_id = new_tree_id
+            self._bump_tree_version(new_tree_id)
+        self._attach_subtree_aggregates(node, target, position)
 
         node._nested_intervals_fields_have_changed = True
 
+    def copy_node(self, node, target, position='last-child', field_overrides=None, respace=False, batch_size=5000):
+        """
+        Copies ``node`` and all of its descendants to a position relative to ``target``, as for
+        ``insert_node`` (a ``target`` of ``None`` makes the copy the root of a new tree). Returns
+        a dict mapping the pks of the copied nodes to the pks of their copies.
+
+        Room for the whole copy is made once, and the copies get the intervals of the originals
+        rescaled into it or, if ``respace`` is ``True``, evenly spaced afresh.
+
+        ``field_overrides`` maps field names to the values to give the copies instead of those
+        of the originals: plain values, expressions evaluated against each original (e.g.
+        ``Concat("name", Value(" (copy)"))``), or callables called with each original node. Fields
+        with ``auto_now`` or ``auto_now_add`` are stamped with the current time instead.
+
+        Where it can, the copies are made with one ``INSERT ... SELECT``; otherwise (when
+        respacing, with callable overrides, primary keys that the database doesn't generate, or
+        a copy into another database), with ``bulk_create`` in batches of ``batch_size``.
+        """
+        if self.model._meta.parents:
+            raise ValueError("Can't copy the nodes of a multi-table inherited model.")
+        tree_id = self._new_tree_id() if target is None else target.tree_id
+        return self._copy_node(node, target, position, field_overrides, respace, batch_size, tree_id)
+
+    @tree_atomic("tree_id")
+    def _copy_node(self, node, target, position, field_overrides, respace, batch_size, tree_id):
+        opts = self.model._meta
+        overrides = dict(self._shadow_interval_resets())
+        for name, value in (field_overrides or {}).items():
+            field = opts.get_field(name)
+            if field.is_relation and isinstance(value, models.Model):
+                value = value.pk
+            overrides[field.attname] = value
+
+        count = node._get_descendants_queryset(True).count()
+        interval = self.get_interval_for_insertion_relative_to_with_rebalance(target, position=position, count=count)
+        if interval.get("rebalanced"):
+            # making room may have shifted the node being copied, too
+            self._refresh_from_primary(node, ["left", "right"])
+        if target is None:
+            level_offset = -node.level
+        else:
+            level_offset = target.level + (1 if "child" in position else 0) - node.level
+        converter = get_range_conversion_f_expression_generator(node.left, node.right, interval["left"], interval["right"])
+        originals = node._get_descendants_queryset(True).order_by("left", "level")
+        original_pks = list(originals.values_list("pk", flat=True))
+
+        alias = self._get_connection(tree_id=tree_id).alias
+        pk_field = opts.pk
+        fields = [field for field in opts.concrete_fields if field is not pk_field]
+        set_based = (
+            not respace and isinstance(pk_field, AutoField) and pk_field.attname not in overrides and
+            alias == self._get_connection(tree_id=node.tree_id).alias and
+            not any(callable(value) for value in overrides.values())
+        )
+        if set_based:
+            self._insert_copies(originals, fields, alias, overrides, converter, level_offset, tree_id)
+        else:
+            self._bulk_create_copies(
+                originals, fields, alias, overrides, converter, level_offset, tree_id,
+                interval if respace else None, batch_size)
+
+        # the copies are laid out just like the originals, so they come back in the same order
+        tolerance = self._get_interval_tolerance()
+        copy_pks = self.db_manager(alias).filter(
+            tree_id=tree_id,
+            left__gte=interval["left"] - tolerance,
+            left__lte=interval["right"] + tolerance,
+            level__gte=node.level + level_offset,
+        ).order_by("left", "level").values_list("pk", flat=True)
+        pk_map = dict(zip(original_pks, copy_pks))
+
+        aggregate_fields = self._get_aggregate_fields()
+        if any(field.attname in overrides or getattr(field, "source", None) in overrides for field in aggregate_fields):
+            self.rebuild_subtree_aggregates([tree_id])
+        elif aggregate_fields:
+            self._attach_subtree_aggregates(self.db_manager(alias).get(pk=pk_map[node.pk]), target, position)
+        self._bump_tree_version(tree_id)
+        return pk_map
+
+    def _insert_copies(self, originals, fields, alias, overrides, converter, level_offset, tree_id):
+        # copies the ``originals`` with one INSERT ... SELECT, the values of the copies being
+        # computed from the originals by the database
+        def get_value(field):
+            if getattr(field, "auto_now", False) or getattr(field, "auto_now_add", False):
+                # stamped with the current time, just as bulk_create does
+                return Value(field.pre_save(self.model(), add=True), output_field=field)
+            elif field.attname in overrides:
+                value = overrides[field.attname]
+                return value if hasattr(value, "resolve_expression") else Value(value, output_field=field)
+            elif field.attname in ("left", "right"):
+                return converter(field.attname)
+            elif field.attname == "level":
+                return F("level") + level_offset
+            elif field.attname == "tree_id":
+                return Value(tree_id, output_field=field)
+            return F(field.attname)
+
+        queryset = originals.order_by()
+        names = []
+        for index, field in enumerate(fields):
+            names.append("_copy_%d" % index)
+            queryset = queryset.annotate(**{names[-1]: get_value(field)})
+        select, params = queryset.values_list(*names).query.get_compiler(using=alias).as_sql()
+
+        connection = connections[alias]
+        qn = connection.ops.quote_name
+        sql = "INSERT INTO %s (%s) %s" % (
+            qn(self.model._meta.db_table), ", ".join(qn(field.column) for field in fields), select)
+        with connection.cursor() as cursor:
+            cursor.execute(sql, params)
+
+    def _bulk_create_copies(self, originals, fields, alias, overrides, converter, level_offset, tree_id,
+                            interval, batch_size):
+        # copies the ``originals`` with bulk_create, laying them out evenly spaced in ``interval``
+        # if it's given, or else rescaling their intervals with ``converter``
+        expressions = sorted(name for name, value in overrides.items() if hasattr(value, "resolve_expression"))
+        for name in expressions:
+            originals = originals.annotate(**{"_copy_%s" % name: overrides[name]})
+        originals = list(originals)
+        if interval is not None:
+            bounds = get_evenly_spaced_intervals(
+                [(original.pk, original.level) for original in originals], interval["left"], interval["increment"])
+
+        copies = []
+        for original in originals:
+            copy = self.model(**dict((field.attname, getattr(original, field.attname)) for field in fields))
+            for name, value in overrides.items():
+                if name in expressions:
+                    value = getattr(original, "_copy_%s" % name)
+                elif callable(value):
+                    value = value(original)
+                setattr(copy, name, value)
+            if interval is not None:
+                copy.left, copy.right = bounds[original.pk]
+            else:
+                # (the same arithmetic as the converter's expressions, done in Python)
+                copy.left, copy.right = (converter.rescale(original.left), converter.rescale(original.right))
+            copy.level = original.level + level_offset
+            copy.tree_id = tree_id
+            if copy.pk is None and not isinstance(copy._meta.pk, AutoField):
+                raise ValueError(
+                    "Copies of %s need a value for %s in field_overrides." % (self.model.__name__, copy._meta.pk.name))
+            copies.append(copy)
+        self.db_manager(alias).bulk_create(copies, batch_size=batch_size)
+
+    def _get_aggregate_fields(self):
+        return [field for field in self.model._meta.concrete_fields if isinstance(field, SubtreeAggregateField)]
+
+    def _adjust_subtree_aggregates(self, queryset, node, sign):
+        # adds (or, with a ``sign`` of -1, subtracts) the aggregates of ``node``'s subtree to the
+        # nodes in ``queryset``, with one ``UPDATE``
+        fields = self._get_aggregate_fields()
+        if fields:
+            queryset.update(**dict(
+                (field.attname, F(field.attname) + sign * field.get_subtree_value(node)) for field in fields
+            ))
+
+    def _attach_subtree_aggregates(self, node, target, position):
+        # adds the aggregates of ``node``'s subtree to its ancestors at its new position
+        if target is not None:
+            ancestors = target._get_ancestors_queryset(False, "child" in position)
+            self._adjust_subtree_aggregates(ancestors, node, 1)
+
+    def _detach_subtree_aggregates(self, node):
+        # takes the aggregates of ``node``'s subtree (as stored) off its current ancestors
+        fields = self._get_aggregate_fields()
+        if fields:
+            self._refresh_from_primary(node, [field.attname for field in fields])
+            self._adjust_subtree_aggregates(node._get_ancestors_queryset(False, False), node, -1)
+
+    def _update_source_aggregates(self, node, update_fields=None):
+        """
+        Applies any changes to the source fields of ``node``'s subtree aggregates (e.g. of a
+        ``SubtreeSumField``) that are about to be saved to the node and its ancestors.
+        """
+        fields = [
+            field for field in self._get_aggregate_fields()
+            if getattr(field, "source", None) and (update_fields is None or field.source in update_fields)
+        ]
+        if not fields:
+            return
+        stored = self._for_tree(node.tree_id).filter(pk=node.pk).values(*set(
+            [field.source for field in fields] + [field.attname for field in fields])).get()
+        deltas = {}
+        for field in fields:
+            delta = (getattr(node, field.source) or 0) - (stored[field.source] or 0)
+            setattr(node, field.attname, stored[field.attname] + delta)
+            if delta:
+                deltas[field.attname] = F(field.attname) + delta
+        if deltas:
+            node._get_ancestors_queryset(False, True).update(**deltas)
+
+    def rebuild_subtree_aggregates(self, tree_ids=None):
+        """
+        Recalculates the subtree aggregate fields (see ``nested_intervals.fields``) of all of the
+        nodes in the trees with the given ``tree_ids`` (or in all trees) from scratch, in one
+        pass over the nodes in tree order. Returns the number of nodes that were updated.
+        """
+        fields = self._get_aggregate_fields()
+        if not fields:
+            return 0
+        if self._db is None and len(self.get_databases()) > 1:
+            return sum(
+                manager.rebuild_subtree_aggregates(ids) for manager, ids in self._group_by_database(tree_ids))
+        sources = sorted(set(field.source for field in fields if getattr(field, "source", None)))
+        queryset = self.all()
+        if tree_ids is not None:
+            queryset = queryset.filter(tree_id__in=tree_ids)
+        rows = queryset.order_by("tree_id", "left").values_list("pk", "tree_id", "right", "left", *sources)
+
+        values = {}
+        # the nodes that haven't been closed yet, whose aggregates are still being added up
+        stack = []
+
+        def close():
+            node = stack.pop()
+            values[node.pk] = tuple(getattr(node, field.attname) for field in fields)
+            if stack:
+                parent = stack[-1]
+                for field in fields:
+                    setattr(parent, field.attname, getattr(parent, field.attname) + field.get_subtree_value(node))
+
+        for row in rows.iterator():
+            node = _AggregateRow(zip(("pk", "tree_id", "right", "left") + tuple(sources), row))
+            while stack and (stack[-1].tree_id != node.tree_id or stack[-1].right < node.left):
+                close()
+            for field in fields:
+                setattr(node, field.attname, field.get_initial_value(node))
+            stack.append(node)
+        while stack:
+            close()
+
+        self._update_many(values, [field.name for field in fields])
+        return len(values)
+
     def root_node(self, tree_id):
         """
         Returns the root node of the tree with the given id.
         """
-        return self.filter(tree_id=tree_id, level=0).get()
+        return self._for_tree(tree_id).filter(tree_id=tree_id, level=0).get()
 
     def root_nodes(self):
         """
         Creates a ``QuerySet`` containing root nodes.
+
+        When the trees are spread across several databases, this only covers one of them (e.g.
+        ``db_manager(alias).root_nodes()``); see ``iter_root_nodes`` for the roots of them all.
         """
         return self.filter(level=0)
 
+    def iter_root_nodes(self):
+        """
+        Yields the root nodes of all of the trees, from every database they're spread across
+        (see ``get_databases``), one database at a time.
+        """
+        for alias in self.get_databases():
+            for root in self.db_manager(alias).root_nodes().iterator():
+                yield root
+
+    def _get_tree_ids(self):
+        # the ids of all of the trees, from every database
+        return [
+            tree_id for alias in self.get_databases()
+            for tree_id in self.db_manager(alias).filter(level=0).values_list("tree_id", flat=True)
+        ]
+
+    def get_tree_version(self, tree_id):
+        """
+        Returns the version of the tree with the given ``tree_id``, which goes up every time the
+        tree is changed (by inserting, moving, rebalancing or deleting nodes). Trees that have
+        never been changed this way are at version 0.
+        """
+        from .models import TreeVersion
+        versions = TreeVersion.objects.using(self._get_connection(tree_id=tree_id).alias).filter(
+            model=self._get_tree_label(), tree_id=self._tree_key(tree_id))
+        return versions.values_list("version", flat=True).first() or 0
+
+    def get_tree_versions(self, tree_ids=None):
+        """
+        Returns a dict of the versions of the trees with the given ``tree_ids`` (or of all trees
+        that have a version), keyed by ``tree_id``. See ``get_tree_version``.
+        """
+        from .models import TreeVersion
+        to_python = self.model._meta.get_field("tree_id").to_python
+        if tree_ids is not None:
+            tree_ids = list(tree_ids)
+        result = {}
+        for manager, ids in self._group_by_database(tree_ids):
+            versions = TreeVersion.objects.using(manager._db).filter(model=self._get_tree_label())
+            if ids is not None:
+                versions = versions.filter(tree_id__in=[self._tree_key(tree_id) for tree_id in ids])
+            result.update((to_python(tree_id), version) for tree_id, version in versions.values_list("tree_id", "version"))
+        for tree_id in tree_ids or ():
+            result.setdefault(to_python(tree_id), 0)
+        return result
+
+    def _tree_key(self, tree_id):
+        return str(self.model._meta.get_field("tree_id").to_python(tree_id))
+
+    def _bump_tree_version(self, tree_id):
+        """
+        Increments the version of the tree with the given ``tree_id``, and sends ``tree_changed``
+        once the current transaction has been committed. Inside a ``tree_batch()``, that's put off
+        until the batch is done, so the version goes up only once.
+        """
+        record_tree_write(self.model, tree_id)
+        batch = self._get_tree_batch()
+        if batch is not None:
+            batch._add(batch.changed_tree_ids, tree_id)
+            batch._forget_tree(tree_id)
+            return None
+        from .models import TreeVersion
+        alias = self._get_connection(tree_id=tree_id).alias
+        key = dict(model=self._get_tree_label(), tree_id=self._tree_key(tree_id))
+        versions = TreeVersion.objects.using(alias).filter(**key)
+        with transaction.atomic(using=alias, savepoint=False):
+            if not versions.update(version=F("version") + 1):
+                try:
+                    with transaction.atomic(using=alias):
+                        TreeVersion.objects.using(alias).create(version=1, **key)
+                except IntegrityError:
+                    # created by someone else in the meantime
+                    versions.update(version=F("version") + 1)
+            version = versions.values_list("version", flat=True).get()
+        self._send_tree_changed(tree_id, version, alias)
+        return version
+
+    def _create_tree_versions(self, tree_ids):
+        """
+        Sets the versions of the given brand new trees to 1, in bulk.
+        """
+        from .models import TreeVersion
+        label = self._get_tree_label()
+        for manager, ids in self._group_by_database(tree_ids):
+            TreeVersion.objects.using(manager._db).bulk_create([
+                TreeVersion(model=label, tree_id=self._tree_key(tree_id), version=1) for tree_id in ids
+            ], batch_size=INTERVAL_UPDATE_BATCH_SIZE)
+            for tree_id in ids:
+                self._send_tree_changed(tree_id, 1, manager._db)
+
+    def _send_tree_changed(self, tree_id, version, alias):
+        transaction.on_commit(
+            lambda: tree_changed.send(sender=self.model, tree_id=tree_id, version=version),
+            using=alias,
+        )
+
     def rebalance_all_trees(self):
         """
-        Rebalances all trees in the database table to have evenly spaced intervals.
+        Rebalances all trees in the database table (in every database, if the trees are spread
+        across several) to have evenly spaced intervals.
         """
 
-        tree_ids = self.root_nodes().values_list('tree_id', flat=True)
+        tree_ids = self._get_tree_ids()
 
         for tree_id in tree_ids:
             self.rebalance_tree(tree_id)
 
-    @transaction.atomic
+    def rebalance_trees(self, tree_ids=None, workers=1, use_processes=False, min_headroom=None, dry_run=False):
+        """
+        Rebalances the trees with the given ``tree_ids`` (or all trees), spread across a pool of
+        ``workers`` threads (or processes, if ``use_processes`` is ``True``), each of which uses
+        its own database connection. On SQLite, which only allows one writer at a time, the
+        trees are rebalanced one after another (except for a ``dry_run``).
+
+        If ``min_headroom`` is given, only trees with fewer than that many decimal places of
+        headroom left (see ``get_tree_headroom``) are rebalanced. If ``dry_run`` is ``True``,
+        nothing is written, but the trees that would have been rebalanced are still reported.
+
+        Returns a list of ``TreeRebalanceResult`` tuples, one per tree, in the order the trees
+        were given.
+        """
+        if tree_ids is None:
+            tree_ids = self._get_tree_ids()
+        return rebalance_trees_in_pool(
+            self.model, list(tree_ids), workers=workers, use_processes=use_processes,
+            min_headroom=min_headroom, dry_run=dry_run,
+        )
+
+    def get_tree_headroom(self, tree_id):
+        """
+        Returns the number of decimal places left before the tightest gap between any two
+        left/right values in the tree with the given ``tree_id`` can no longer be split.
+        A freshly balanced tree has close to ``NESTED_INTERVALS_DECIMAL_PLACES`` of headroom.
+        """
+        values = []
+        for left, right in self._for_tree(tree_id).filter(tree_id=tree_id).values_list("left", "right"):
+            values.append(left)
+            values.append(right)
+        if not values:
+            raise self.model.DoesNotExist("There is no tree with tree_id %s." % tree_id)
+        values.sort()
+        smallest_gap = min(b - a for a, b in zip(values, values[1:]))
+        if not smallest_gap:
+            return 0
+        return max(DECIMAL_PLACES + smallest_gap.adjusted(), 0)
+
+    @tree_atomic("tree_id")
     def rebalance_tree(self, tree_id):
         """
         Rebalances the tree with given ``tree_id`` in database table to have evenly spaced intervals.
+
+        Returns the number of nodes that were updated.
         """
 
-        root = self.root_node(tree_id)
-        nodes = root.get_descendants(include_self=True)
-        interval = get_interval_for_insertion_relative_to(None, "last-child", count=nodes.count())
-        self._rebalance_helper(root, interval["left"], interval["increment"])
-
-    def _rebalance_helper(self, node, left, increment):
-        
-        # if there are no children, the right value is the left value plus the increment
-        right = left + increment
-        
-        # recurse down into the children to update them
-        for child in node.get_children():
-            right = self._rebalance_helper(child, right, increment)
-
-        # update the left and right values for this node
-        self.filter(pk=node.pk).update(
-            left=left,
-            right=right,
-        )
+        # (to make sure the tree exists)
+        self.root_node(tree_id)
+        manager = self._for_tree(tree_id)
+        # on backends that round decimals, a crowded parent and child can come back with the
+        # same left value, so order by level as well to keep the parent first
+        nodes = list(manager.filter(tree_id=tree_id).order_by("left", "level").values_list("pk", "level"))
+        interval = get_interval_for_insertion_relative_to(None, "last-child", count=len(nodes))
+        bounds = get_evenly_spaced_intervals(nodes, interval["left"], interval["increment"])
+        manager._update_many(bounds, ("left", "right"))
+        self._bump_tree_version(tree_id)
+        return len(nodes)
+
+    def arebalance_tree(self, tree_id):
+        """
+        Async counterpart of ``rebalance_tree``. See ``nested_intervals.aio``.
+        """
+        return _aio().arebalance_tree(self, tree_id)
+
+    @tree_atomic("node")
+    def rebalance_subtree(self, node):
+        """
+        Rebalances the descendants of ``node`` to be evenly spaced within its own interval,
+        leaving the rest of the tree untouched.
+
+        Raises ``IntervalTooSmall`` if ``node``'s interval is too small to hold them all.
+        """
+        descendants = list(node.get_descendants().values_list("pk", "level"))
+        if not descendants:
+            return
+        increment = (node.right - node.left) / (Decimal("2") * len(descendants) + Decimal("1"))
+        bounds = get_evenly_spaced_intervals(descendants, node.left + increment, increment)
+        self._for_tree(node.tree_id)._bulk_update_intervals(bounds)
+        self._bump_tree_version(node.tree_id)
+
+    def rebuild_from_parent_field(self, field_name, order_by=("pk",), batch_size=5000):
+        """
+        Rebuilds the nested intervals fields of every node from an adjacency list column,
+        e.g. the ``parent`` foreign key left over from an MPTT or treebeard schema, called
+        ``field_name``. Nodes with no parent become the roots of new trees.
+
+        The ``(pk, parent)`` pairs are read in one pass, ordered by ``order_by`` (which also
+        decides the order of siblings), the forest is laid out evenly spaced in memory, and
+        the results are written back with batches of ``batch_size`` parameterized ``UPDATE``
+        statements.
+
+        Raises ``ValueError`` (before anything is written) if a node's parent doesn't exist,
+        or if some of the nodes form a cycle. Returns the number of nodes that were updated.
+
+        When the trees are spread across several databases, the nodes in each are rebuilt on
+        their own, into trees whose ids keep them in the same database.
+        """
+        if self._db is None and len(self.get_databases()) > 1:
+            return sum(
+                self.db_manager(alias).rebuild_from_parent_field(field_name, order_by, batch_size)
+                for alias in self.get_databases()
+            )
+        with transaction.atomic(using=self._get_connection().alias):
+            return self._rebuild_from_parent_field(field_name, order_by, batch_size)
+
+    def _rebuild_from_parent_field(self, field_name, order_by, batch_size):
+        field = self.model._meta.get_field(field_name)
+        if field.is_relation:
+            key_name = field.target_field.attname
+        else:
+            key_name = self.model._meta.pk.attname
+
+        pks = {}
+        children = {}
+        roots = []
+        for pk, key, parent in self.order_by(*order_by).values_list("pk", key_name, field.attname).iterator():
+            pks[key] = pk
+            if parent is None:
+                roots.append(pk)
+            else:
+                children.setdefault(parent, []).append(pk)
+
+        # key the children lists by the parents' pks, checking for missing parents
+        for parent, kids in children.items():
+            if parent not in pks:
+                raise ValueError("Node %s has a parent (%s) that doesn't exist." % (kids[0], parent))
+        if key_name != self.model._meta.pk.attname:
+            children = dict((pks[parent], kids) for parent, kids in children.items())
+
+        values = {}
+        tree_ids = self._new_tree_ids(len(roots), self._get_connection().alias)
+        for root, tree_id in zip(roots, tree_ids):
+            nodes = []
+            stack = [(root, 0)]
+            while stack:
+                pk, level = stack.pop()
+                nodes.append((pk, level))
+                stack.extend((child, level + 1) for child in reversed(children.get(pk, ())))
+            interval = get_interval_for_insertion_relative_to(None, "last-child", count=len(nodes))
+            bounds = get_evenly_spaced_intervals(nodes, interval["left"], interval["increment"])
+            for pk, level in nodes:
+                values[pk] = (tree_id, level) + bounds[pk]
+
+        if len(values) != len(pks):
+            raise ValueError("%d node(s) aren't connected to a root node." % (len(pks) - len(values)))
+
+        self._update_many(values, ("tree_id", "level", "left", "right"), batch_size)
+        self._create_tree_versions(tree_ids)
+        self.rebuild_subtree_aggregates()
+        return len(values)
+
+    def _bulk_update_intervals(self, bounds, batch_size=INTERVAL_UPDATE_BATCH_SIZE):
+        """
+        Writes the ``(left, right)`` pairs in the ``bounds`` dict (keyed by pk) back to the
+        database, using one ``UPDATE`` query per batch of nodes.
+        """
+        output_field = models.DecimalField(max_digits=DECIMAL_PLACES+1, decimal_places=DECIMAL_PLACES)
+        items = list(bounds.items())
+        for start in range(0, len(items), batch_size):
+            batch = items[start:start+batch_size]
+            self.filter(pk__in=[pk for pk, _ in batch]).update(
+                left=Case(*[When(pk=pk, then=Value(left)) for pk, (left, _) in batch], output_field=output_field),
+                right=Case(*[When(pk=pk, then=Value(right)) for pk, (_, right) in batch], output_field=output_field),
+                **self._shadow_interval_resets()
+            )
+
+    def _update_many(self, values, field_names, batch_size=5000):
+        """
+        Writes the tuples of values for ``field_names`` in the ``values`` dict (keyed by pk)
+        back to the database, with one parameterized ``UPDATE`` statement run ``executemany``
+        style per batch of nodes. Much cheaper than ``_bulk_update_intervals`` per row, for
+        when most of the table is being written.
+        """
+        opts = self._get_tree_model()._meta
+        fields = [opts.get_field(name) for name in field_names]
+        connection = self._get_connection()
+        qn = connection.ops.quote_name
+
+        assignments = ["%s = %%s" % qn(field.column) for field in fields]
+        assignments.extend("%s = NULL" % qn(opts.get_field(name).column) for name in self._shadow_interval_resets())
+        sql = "UPDATE %s SET %s WHERE %s = %%s" % (qn(opts.db_table), ", ".join(assignments), qn(opts.pk.column))
+
+        items = list(values.items())
+        with connection.cursor() as cursor:
+            for start in range(0, len(items), batch_size):
+                cursor.executemany(sql, [
+                    [field.get_db_prep_value(value, connection) for field, value in zip(fields, row)]
+                    + [opts.pk.get_db_prep_value(pk, connection)]
+                    for pk, row in items[start:start+batch_size]
+                ])
+
+    def _iter_chunks_in_tree_order(self, queryset, chunk_size, *fields):
+        """
+        Yields the nodes in ``queryset`` (which must all be in the same tree) in tree order, in
+        lists of up to ``chunk_size`` nodes. Each chunk is fetched with its own query, paginated
+        on ``(left, level, pk)``, so no cursor is held open in between.
+
+        If ``fields`` are given, ``(pk, left, *fields)`` tuples are returned instead of nodes.
+        """
+        last = None
+        while True:
+            chunk = list(self._get_chunk_queryset(queryset, chunk_size, last, *fields))
+            if chunk:
+                yield chunk
+            if len(chunk) < chunk_size:
+                return
+            last = chunk[-1]
+
+    def _get_chunk_queryset(self, queryset, chunk_size, last, *fields):
+        """
+        Returns a query for the chunk of ``queryset`` (in tree order) after ``last``, the final
+        node (or tuple, if ``fields`` are given) of the previous chunk, or for the first chunk
+        if it's ``None``. See ``_iter_chunks_in_tree_order``.
+        """
+        if last is not None:
+            if fields:
+                last_pk, last_left = last[:2]
+            else:
+                last_pk, last_left = last.pk, last.left
+            # compare with the last node's values as stored (the left value read back may have
+            # been rounded, and so tie with, or come after, the ones it's actually between)
+            stored = self.model._default_manager.filter(pk=last_pk)
+            left = Coalesce(
+                Subquery(stored.values("left")[:1]), Value(last_left), output_field=self.model._meta.get_field("left"))
+            level = Subquery(stored.values("level")[:1])
+            # (every alternative below implies left__gte, but databases can't tell, so it's spelled
+            # out for the (tree_id, left) index to start the chunk at the last node)
+            queryset = queryset.filter(left__gte=left).filter(
+                Q(left__gt=left) | Q(left=left, level__gt=level) | Q(left=left, level=level, pk__gt=last_pk))
+        queryset = queryset.order_by("left", "level", "pk")
+        if fields:
+            queryset = queryset.values_list("pk", "left", *fields)
+        return queryset[:chunk_size]
+
+    def _has_shadow_intervals(self):
+        field_names = [field.name for field in self.model._meta.get_fields()]
+        return "shadow_left" in field_names and "shadow_right" in field_names
+
+    def _shadow_interval_resets(self):
+        """
+        Returns the updates needed to flag nodes as changed to an online rebalance in progress.
+        """
+        if self._has_shadow_intervals():
+            return {"shadow_left": None, "shadow_right": None}
+        return {}
+
+    def rebalance_tree_online(self, tree_id, batch_size=1000, max_attempts=3):
+        """
+        Rebalances the tree with the given ``tree_id`` without holding locks on the whole tree
+        for the duration, for use on trees too big for ``rebalance_tree``. The model needs to
+        include ``nested_intervals.models.OnlineRebalanceMixin``.
+
+        The new intervals are written to the shadow columns in batches of ``batch_size`` nodes,
+        each in its own transaction, and then swapped into ``left``/``right`` in one final
+        ``UPDATE``. Nodes that were changed in the meantime have their shadow columns cleared;
+        if any are found, the pass is repeated, up to ``max_attempts`` times before raising
+        ``RebalanceConflict``.
+
+        Returns the number of nodes that were updated.
+        """
+        if not self._has_shadow_intervals():
+            raise ImproperlyConfigured(
+                "%s needs to include OnlineRebalanceMixin to be rebalanced online." % self.model.__name__)
+
+        manager = self._for_tree(tree_id)
+        for attempt in range(max_attempts):
+            manager._write_shadow_intervals(tree_id, batch_size)
+            count = manager._swap_shadow_intervals(tree_id)
+            if count is not None:
+                return count
+
+        raise RebalanceConflict("The tree %s kept changing during the rebalance." % tree_id)
+
+    def _write_shadow_intervals(self, tree_id, batch_size):
+        # lay out the nodes as they're read, in tree order and in batches, just as rebalance_tree
+        # would: consecutive left/right values are one increment apart
+        count = self.filter(tree_id=tree_id).count()
+        interval = get_interval_for_insertion_relative_to(None, "last-child", count=count)
+        increment = interval["increment"]
+
+        stack = []
+        pending = []
+        position = [0]
+
+        def close():
+            pk, left, right, new_left = stack.pop()
+            pending.append((pk, left, right, new_left, interval["left"] + increment * position[0]))
+            position[0] += 1
+
+        for nodes in self._iter_chunks_in_tree_order(self.filter(tree_id=tree_id), batch_size, "right"):
+            for pk, left, right in nodes:
+                while stack and stack[-1][2] < left:
+                    close()
+                stack.append((pk, left, right, interval["left"] + increment * position[0]))
+                position[0] += 1
+            self._write_shadow_batch(pending)
+            del pending[:]
+
+        while stack:
+            close()
+        self._write_shadow_batch(pending)
+
+    def _write_shadow_batch(self, nodes):
+        # only nodes whose intervals are still the same as when they were read get shadow values,
+        # the rest are marked as changed (by setting them to NULL)
+        output_field = models.DecimalField(max_digits=DECIMAL_PLACES+1, decimal_places=DECIMAL_PLACES)
+        tolerance = self._get_interval_tolerance()
+        batch_size = INTERVAL_UPDATE_BATCH_SIZE // 2
+        for start in range(0, len(nodes), batch_size):
+            batch = nodes[start:start+batch_size]
+            unchanged = [
+                Q(pk=pk, left__range=(left - tolerance, left + tolerance), right__range=(right - tolerance, right + tolerance))
+                for pk, left, right, _, _ in batch
+            ]
+            with transaction.atomic(using=self._get_connection().alias):
+                self.filter(pk__in=[node[0] for node in batch]).update(
+                    shadow_left=Case(*[
+                        When(condition, then=Value(node[3])) for condition, node in zip(unchanged, batch)
+                    ], output_field=output_field),
+                    shadow_right=Case(*[
+                        When(condition, then=Value(node[4])) for condition, node in zip(unchanged, batch)
+                    ], output_field=output_field),
+                )
 
-        return right + increment
+    def _swap_shadow_intervals(self, tree_id):
+        # only nodes with shadow values are swapped, so a node added (or changed) and committed
+        # at any point before the UPDATE is never given a NULL interval; if there are any such
+        # nodes, the swap is rolled back
+        alias = self._get_connection().alias
+        with transaction.atomic(using=alias):
+            nodes = self.filter(tree_id=tree_id)
+            count = nodes.filter(shadow_left__isnull=False).update(
+                left=F("shadow_left"), right=F("shadow_right"), shadow_left=None, shadow_right=None)
+            if count != nodes.count():
+                transaction.set_rollback(True, using=alias)
+                return None
+            self._bump_tree_version(tree_id)
+            return count
 
 
 # TODO: when inserting nodes and their descendants, we're just scaling their left/right values, which might lead to "too small" intervals
@@ -0,0 +1,26 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('nested_intervals', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TreeVersion',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('model', models.CharField(max_length=100)),
+                ('tree_id', models.CharField(max_length=64)),
+                ('version', models.BigIntegerField(default=0)),
+            ],
+            options={
+                'unique_together': {('model', 'tree_id')},
+            },
+        ),
+    ]
@@ -1,16 +1,19 @@
 from __future__ import unicode_literals
 from functools import reduce, wraps
 
-from django.db import models, transaction
+from django.db import models, router, transaction
 from django.db.models.base import ModelBase
 from django.db.models.fields import AutoField
-from django.db.models.query import F, Q
+from django.db.models import Subquery
+from django.db.models.query import F
 
 from django.utils import six
 
 from .conf import DECIMAL_PLACES
 from .exceptions import InvalidMove
-from .managers import NestedIntervalsManager
+from .fields import SubtreeAggregateField
+from .managers import NestedIntervalsManager, _aio
+from .routers import reading_from_primary
 
 def raise_if_unsaved(func):
     @wraps(func)
@@ -24,7 +27,53 @@ def raise_if_unsaved(func):
     return _fn
 
 
-class NestedIntervalsModel(models.Model):
+def _walk_subtree(stack, nodes):
+    """
+    Yields ``(node, depth, parent_pk)`` for ``nodes``, the next ones of a subtree in tree order,
+    given ``stack``, the ``(right, pk)`` pairs of the current node's ancestors within the
+    subtree, which is kept up to date for the nodes that follow.
+    """
+    for node in nodes:
+        while stack and stack[-1][0] < node.left:
+            stack.pop()
+        yield node, len(stack), stack[-1][1] if stack else None
+        stack.append((node.right, node.pk))
+
+
+# the composite indexes added to tree models by default, for looking up and ranging over a
+# tree's nodes by left value (descendants, ancestors, and ordering), by level (children, siblings
+# and roots), and by right value (ancestors and families)
+DEFAULT_TREE_INDEXES = (
+    ("tree_id", "left"),
+    ("tree_id", "level", "left"),
+    ("tree_id", "right"),
+)
+
+
+class NestedIntervalsModelBase(ModelBase):
+    """
+    Metaclass for tree models, which adds indexes on the tree fields to each concrete model
+    (alongside those in its ``Meta.indexes``), as listed in its ``tree_indexes`` attribute.
+    Set ``tree_indexes`` on a model to change them, or to ``()`` to leave them out.
+    """
+
+    def __new__(meta, class_name, bases, class_dict):
+        cls = super(NestedIntervalsModelBase, meta).__new__(meta, class_name, bases, class_dict)
+        opts = cls._meta
+        # the tree fields live on the table of the first concrete model, with multi-table inheritance
+        if not opts.abstract and not opts.proxy and opts.get_field("left").model is cls:
+            existing = set(tuple(index.fields) for index in opts.indexes)
+            for fields in cls.tree_indexes:
+                if tuple(fields) not in existing:
+                    index = models.Index(fields=list(fields))
+                    index.set_name_with_model(cls)
+                    opts.indexes.append(index)
+            # migrations only pick up indexes declared in Meta
+            opts.original_attrs["indexes"] = opts.indexes
+        return cls
+
+
+class NestedIntervalsModel(six.with_metaclass(NestedIntervalsModelBase, models.Model)):
     """
     Base class for tree models.
     """
@@ -32,10 +81,14 @@ class NestedIntervalsModel(models.Model):
     left = models.DecimalField(max_digits=DECIMAL_PLACES+1, decimal_places=DECIMAL_PLACES)
     right = models.DecimalField(max_digits=DECIMAL_PLACES+1, decimal_places=DECIMAL_PLACES)
     level = models.PositiveIntegerField()
+    # random UUIDs by default; override with e.g. ``tree_id = models.BigIntegerField()`` for
+    # compact, sequential ids allocated from a counter (see ``TreeIdCounter``)
     tree_id = models.UUIDField()
 
     objects = NestedIntervalsManager()
 
+    tree_indexes = DEFAULT_TREE_INDEXES
+
     # holds False if the parent hasn't been changed, otherwise the new value
     _new_parent = False
 
@@ -66,12 +119,20 @@ class NestedIntervalsModel(models.Model):
         if self.level == 0:
             return None
         # otherwise, compute a parent value from the database
-        return self._tree_manager.filter(
+        return self._get_parent_queryset().first()
+
+    def _get_tree_queryset(self):
+        # the structural reads of this tree, which routers can tell apart by their hints
+        # (see nested_intervals.routers)
+        return self._tree_manager.db_manager(hints={"tree_read": True, "tree_id": self.tree_id}).all()
+
+    def _get_parent_queryset(self):
+        return self._get_tree_queryset().filter(
             left__lt=self.left,
             right__gt=self.right,
             level=self.level-1,
             tree_id=self.tree_id,
-        ).first()
+        )
 
     @parent.setter
     def parent(self, newparent):
@@ -87,12 +148,22 @@ class NestedIntervalsModel(models.Model):
 
     @parent_id.setter
     def parent_id(self, newparent_id):
-        self.parent = self._tree_manager.get(id=newparent_id)
+        self.parent = self._tree_manager._get_from_any_database(id=newparent_id)
 
     @property
     def children(self):
         return self.get_children()
 
+    @property
+    def ancestors_cached(self):
+        """
+        The ancestors of this model instance, as a list, root first. Loaded by
+        ``with_ancestors()`` for whole querysets, or otherwise when first used.
+        """
+        if getattr(self, "_prefetched_ancestors", None) is None:
+            self._prefetched_ancestors = list(self._get_ancestors_queryset(False, False))
+        return self._prefetched_ancestors
+
     @raise_if_unsaved
     def get_ancestors(self, ascending=False, include_self=False):
         """
@@ -106,13 +177,26 @@ class NestedIntervalsModel(models.Model):
 
         If ``include_self`` is ``True``, the ``QuerySet`` will also
         include this model instance.
+
+        If the ancestors were fetched with ``with_ancestors``, no database
+        query is required.
         """
+        queryset = self._get_ancestors_queryset(ascending, include_self)
+        prefetched = getattr(self, "_prefetched_ancestors", None)
+        if prefetched is not None:
+            nodes = prefetched + ([self] if include_self else [])
+            if ascending:
+                nodes.reverse()
+            return self._with_result_cache(queryset, nodes)
+        return queryset
+
+    def _get_ancestors_queryset(self, ascending, include_self):
         if self.is_root_node():
             if include_self:
                 # Filter on pk for efficiency.
-                return self._tree_manager.filter(pk=self.pk)
+                return self._get_tree_queryset().filter(pk=self.pk)
             else:
-                return self._tree_manager.none()
+                return self._get_tree_queryset().none()
         else:
             
             if ascending:
@@ -120,22 +204,24 @@ class NestedIntervalsModel(models.Model):
             else:
                 order_by = 'left'
 
+            # plain range conditions, so the database can scan an index on (tree_id, left); the
+            # node itself is told apart by its level, as its own values may not compare equal
+            # once they've been rounded (see ``_get_interval_tolerance``)
             if include_self:
-                return self._tree_manager.filter(
-                    Q(
-                        left__lte=self.left,
-                        right__gte=self.right,
-                        tree_id=self.tree_id,
-                    ) | Q(
-                        pk=self.pk,
-                    )
+                tolerance = self._tree_manager._get_interval_tolerance()
+                return self._get_tree_queryset().filter(
+                    tree_id=self.tree_id,
+                    left__lte=self.left + tolerance,
+                    right__gte=self.right - tolerance,
+                    level__lte=self.level,
                 ).order_by(order_by)
             else:
-                return self._tree_manager.filter(
+                return self._get_tree_queryset().filter(
+                    tree_id=self.tree_id,
                     left__lt=self.left,
                     right__gt=self.right,
-                    tree_id=self.tree_id,
-                ).exclude(pk=self.pk).order_by(order_by)
+                    level__lt=self.level,
+                ).order_by(order_by)
 
     @raise_if_unsaved
     def get_family(self):
@@ -143,7 +229,14 @@ class NestedIntervalsModel(models.Model):
         Returns a ``QuerySet`` containing the ancestors, the model itself
         and the descendants, in tree order.
         """
-        return self.get_ancestors(include_self=True) | self.get_descendants()
+        # the intervals that overlap this one are exactly those of its ancestors, itself and its
+        # descendants, which needs just one range condition
+        tolerance = self._tree_manager._get_interval_tolerance()
+        return self._get_tree_queryset().filter(
+            tree_id=self.tree_id,
+            left__lte=self.right + tolerance,
+            right__gte=self.left - tolerance,
+        )
 
     @raise_if_unsaved
     def get_children(self):
@@ -157,36 +250,83 @@ class NestedIntervalsModel(models.Model):
         a leaf node (it has no children).
 
         If called from a template where the tree has been walked by the
-        ``cache_tree_children`` filter, no database query is required.
+        ``cache_tree_children`` filter, or the descendants were fetched with
+        ``prefetch_descendants`` or ``get_cached_trees``, no database query
+        is required.
         """
 
-        return self.get_descendants().filter(level=self.level+1)
+        children = self._get_tree_queryset().filter(
+            tree_id=self.tree_id,
+            level=self.level+1,
+            left__gt=self.left,
+            left__lt=self.right,
+        )
+        prefetched = self._get_prefetched_descendants(max_depth=1)
+        if prefetched is not None:
+            return self._with_result_cache(children, [node for node in prefetched if node.level == self.level+1])
+        return children
+
+    def _get_prefetched_descendants(self, max_depth=None):
+        # returns the descendants cached by ``prefetch_descendants``, if they go deep enough
+        prefetched = getattr(self, "_prefetched_descendants", None)
+        if prefetched is None:
+            return None
+        prefetched_depth, nodes = prefetched
+        if prefetched_depth is not None and (max_depth is None or max_depth > prefetched_depth):
+            return None
+        return nodes
+
+    def _with_result_cache(self, queryset, nodes):
+        # makes ``queryset`` return the given nodes without querying the database (any further
+        # filtering of it will still query the database, as usual)
+        queryset._result_cache = list(nodes)
+        queryset._prefetch_done = True
+        queryset._tree_prefetch_done = True
+        return queryset
 
     @raise_if_unsaved
-    def get_descendants(self, include_self=False):
+    def get_descendants(self, include_self=False, max_depth=None):
         """
         Creates a ``QuerySet`` containing descendants of this model
         instance, in tree order.
 
         If ``include_self`` is ``True``, the ``QuerySet`` will also
         include this model instance.
+
+        If ``max_depth`` is given, only the descendants down to that many
+        levels below this model instance are included (so ``max_depth=1``
+        gives the children).
+
+        If the descendants were fetched with ``prefetch_descendants`` or
+        ``get_cached_trees``, no database query is required.
         """
+        queryset = self._get_descendants_queryset(include_self, max_depth)
+        prefetched = self._get_prefetched_descendants(max_depth)
+        if prefetched is not None:
+            if max_depth is not None:
+                prefetched = [node for node in prefetched if node.level <= self.level + max_depth]
+            return self._with_result_cache(queryset, ([self] if include_self else []) + prefetched)
+        return queryset
+
+    def _get_descendants_queryset(self, include_self, max_depth=None):
+        # see ``_get_ancestors_queryset``
         if include_self:
-            return self._tree_manager.filter(
-                Q(
-                    left__gte=self.left,
-                    left__lte=self.right,
-                    tree_id=self.tree_id,
-                ) | Q(
-                    pk=self.pk,
-                )
+            queryset = self._get_tree_queryset().filter(
+                tree_id=self.tree_id,
+                left__gte=self.left - self._tree_manager._get_interval_tolerance(),
+                left__lte=self.right,
+                level__gte=self.level,
             )
         else:
-            return self._tree_manager.filter(
+            queryset = self._get_tree_queryset().filter(
+                tree_id=self.tree_id,
                 left__gt=self.left,
                 left__lt=self.right,
-                tree_id=self.tree_id,
-            ).exclude(pk=self.pk)
+                level__gt=self.level,
+            )
+        if max_depth is not None:
+            queryset = queryset.filter(level__lte=self.level + max_depth)
+        return queryset
 
     def get_descendant_count(self):
         """
@@ -195,6 +335,45 @@ class NestedIntervalsModel(models.Model):
         """
         return self.get_descendants().count()
 
+    @raise_if_unsaved
+    def iter_subtree(self, chunk_size=1000):
+        """
+        Iterates over this model instance and all of its descendants, in tree order, yielding
+        ``(node, depth, parent_pk)`` tuples, where ``depth`` is relative to this instance
+        (which has a ``parent_pk`` of ``None``).
+
+        Nodes are fetched ``chunk_size`` at a time, each chunk with its own query, so memory use
+        stays flat however big the subtree is, and no database cursor is held open in between.
+        """
+        yield self, 0, None
+
+        stack = [(self.right, self.pk)]
+        for nodes in self._tree_manager._iter_chunks_in_tree_order(self.get_descendants(), chunk_size):
+            for item in _walk_subtree(stack, nodes):
+                yield item
+
+    @raise_if_unsaved
+    def get_cached_ancestors(self, ascending=False, include_self=False):
+        """
+        Returns the same nodes as ``get_ancestors``, as a list, served from the tree cache
+        (see ``nested_intervals.cache``) while the tree hasn't changed.
+        """
+        from .cache import get_tree_cache
+        return get_tree_cache().get_nodes(
+            self.get_ancestors(ascending=ascending, include_self=include_self),
+            self.tree_id, ("ancestors", self.pk, ascending, include_self))
+
+    @raise_if_unsaved
+    def get_cached_descendants(self, include_self=False):
+        """
+        Returns the same nodes as ``get_descendants``, as a list, served from the tree cache
+        (see ``nested_intervals.cache``) while the tree hasn't changed.
+        """
+        from .cache import get_tree_cache
+        return get_tree_cache().get_nodes(
+            self.get_descendants(include_self=include_self),
+            self.tree_id, ("descendants", self.pk, include_self))
+
     @raise_if_unsaved
     def get_leafnodes(self, include_self=False):
         """
@@ -216,7 +395,8 @@ class NestedIntervalsModel(models.Model):
         if self.is_root_node():
             return None
 
-        return self.parent.get_children().filter(left__gt=self.right).filter(*filter_args, **filter_kwargs).first()
+        return self._get_siblings_queryset().filter(
+            left__gt=self.right).filter(*filter_args, **filter_kwargs).first()
 
     @raise_if_unsaved
     def get_previous_sibling(self, *filter_args, **filter_kwargs):
@@ -227,7 +407,8 @@ class NestedIntervalsModel(models.Model):
         if self.is_root_node():
             return None
 
-        return self.parent.get_children().filter(right__lt=self.left).filter(*filter_args, **filter_kwargs).last()
+        return self._get_siblings_queryset().filter(
+            right__lt=self.left).filter(*filter_args, **filter_kwargs).last()
 
     @raise_if_unsaved
     def get_root(self):
@@ -237,7 +418,7 @@ class NestedIntervalsModel(models.Model):
         if self.is_root_node():
             return self
 
-        return self._tree_manager.filter(
+        return self._get_tree_queryset().filter(
             tree_id=self.tree_id,
             level=0,
         ).get()
@@ -255,15 +436,31 @@ class NestedIntervalsModel(models.Model):
         if self.is_root_node():
             if include_self:
                 # Filter on pk for efficiency.
-                return self._tree_manager.filter(pk=self.pk)
+                return self._get_tree_queryset().filter(pk=self.pk)
             else:
-                return self._tree_manager.none()
+                return self._get_tree_queryset().none()
 
-        qs = self.parent.get_children()
+        qs = self._get_siblings_queryset()
         if not include_self:
             qs = qs.exclude(pk=self.pk)
         return qs
 
+    def _get_siblings_queryset(self):
+        # the nodes on this level within the parent's interval, which is read by subqueries rather
+        # than by fetching the parent first
+        parent = self._get_tree_queryset().filter(
+            tree_id=self.tree_id,
+            level=self.level-1,
+            left__lt=self.left,
+            right__gt=self.right,
+        ).order_by()
+        return self._get_tree_queryset().filter(
+            tree_id=self.tree_id,
+            level=self.level,
+            left__gt=Subquery(parent.values("left")[:1]),
+            left__lt=Subquery(parent.values("right")[:1]),
+        )
+
     def get_level(self):
         """
         Returns the level of this node (distance from root)
@@ -289,7 +486,7 @@ class NestedIntervalsModel(models.Model):
         Returns ``True`` if this model instance is a leaf node (it has no
         children), ``False`` otherwise.
         """
-        return not self.get_descendant_count()
+        return not self.get_descendants().exists()
 
     def is_root_node(self):
         """
@@ -328,6 +525,15 @@ class NestedIntervalsModel(models.Model):
             return True
         return other.is_descendant_of(self)
 
+    @raise_if_unsaved
+    def copy_subtree(self, target, position='last-child', field_overrides=None, respace=False):
+        """
+        Convenience method for calling ``NestedIntervalManager.copy_node`` with this model
+        instance. Returns a dict mapping the pks of this node and its descendants to the pks
+        of their copies.
+        """
+        return self._tree_manager.copy_node(self, target, position, field_overrides, respace)
+
     def move_to(self, target, position='first-child'):
         """
         Convenience method for calling ``NestedIntervalManager.move_node`` with this
@@ -335,18 +541,84 @@ class NestedIntervalsModel(models.Model):
         """
         self._tree_manager.move_node(self, target, position)
 
+    def aget_parent(self):
+        """
+        Async counterpart of ``parent``. See ``nested_intervals.aio``.
+        """
+        return _aio().aget_parent(self)
+
+    def aget_ancestors(self, ascending=False, include_self=False):
+        """
+        Async counterpart of ``get_ancestors``, returning a list. See ``nested_intervals.aio``.
+        """
+        return _aio().aget_ancestors(self, ascending, include_self)
+
+    def aget_children(self):
+        """
+        Async counterpart of ``get_children``, returning a list. See ``nested_intervals.aio``.
+        """
+        return _aio().aget_children(self)
+
+    def aget_descendants(self, include_self=False, max_depth=None):
+        """
+        Async counterpart of ``get_descendants``, returning a list. See ``nested_intervals.aio``.
+        """
+        return _aio().aget_descendants(self, include_self, max_depth)
+
+    @raise_if_unsaved
+    def aiter_subtree(self, chunk_size=1000):
+        """
+        Async counterpart of ``iter_subtree``, for use with ``async for``. See
+        ``nested_intervals.aio``.
+        """
+        return _aio().aiter_subtree(self, chunk_size)
+
+    def ainsert_at(self, target, position='first-child', save=False):
+        """
+        Async counterpart of ``insert_at``. See ``nested_intervals.aio``.
+        """
+        return self._tree_manager.ainsert_node(self, target, position, save)
+
+    def amove_to(self, target, position='first-child'):
+        """
+        Async counterpart of ``move_to``. See ``nested_intervals.aio``.
+        """
+        return self._tree_manager.amove_node(self, target, position)
+
     def _is_saved(self, using=None):
         if not self.pk or self.tree_id is None:
             return False
         return True
 
-    @transaction.atomic
+    def _get_tree_database(self, using=None, tree_id=None):
+        # the database the node is saved to: that of its tree (``tree_id``, for a new tree) or,
+        # for a new node, its new parent's
+        if using is not None:
+            return using
+        if tree_id is None:
+            tree_id = self.tree_id
+        if tree_id is None and self._new_parent:
+            tree_id = self._new_parent.tree_id
+        return router.db_for_write(type(self), instance=self, tree_id=tree_id)
+
     def save(self, *args, **kwargs):
+        new_tree_id = None
+        if not kwargs.get("nested_intervals_update_in_progress") and not self._is_saved() and not self._new_parent:
+            # the root of a new tree (see NestedIntervalsManager._new_tree_id)
+            new_tree_id = self._tree_manager._new_tree_id(kwargs.get("using"))
+        using = self._get_tree_database(kwargs.get("using"), new_tree_id)
+        with transaction.atomic(using=using, savepoint=self._tree_manager._get_tree_batch() is None), \
+                reading_from_primary():
+            self._save(new_tree_id, *args, **kwargs)
+
+    def _save(self, new_tree_id, *args, **kwargs):
 
         if not kwargs.pop("nested_intervals_update_in_progress", False):
         
-            if not self._is_saved():
-                self.insert_at(self._new_parent or None, position='last-child')
+            if new_tree_id is not None:
+                self._tree_manager._insert_node(self, None, 'last-child', False, new_tree_id)
+            elif not self._is_saved():
+                self.insert_at(self._new_parent, position='last-child')
             else:
                 if self._new_parent is not False:
                     self._tree_manager._move_node(self, self._new_parent, position='last-child')
@@ -354,10 +626,20 @@ class NestedIntervalsModel(models.Model):
             # clear the _new_parent field now that it's saved
             self._new_parent = False
 
+        if not self._state.adding:
+            self._tree_manager._update_source_aggregates(self, kwargs.get("update_fields"))
+
         # Only update nested_intervals fields if we're told to, or they have been changed.
         # This helps preserve tree integrity when saving on top of a modified tree.
         if not kwargs.get("update_fields", None) and not self._nested_intervals_fields_have_changed:
             kwargs["update_fields"] = self._get_user_field_names()
+        if self._nested_intervals_fields_have_changed:
+            # the node has moved, so any prefetched descendants or ancestors are out of date
+            self.__dict__.pop("_prefetched_descendants", None)
+            self.__dict__.pop("_prefetched_ancestors", None)
+        if self._nested_intervals_fields_have_changed and isinstance(self, OnlineRebalanceMixin):
+            # let any online rebalance in progress know that this node has changed
+            self.shadow_left = self.shadow_right = None
         
         # if all the nested_intervals fields are going to be saved, we can clear the "dirty bit"
         ni_fields = set(["left", "right", "level", "tree_id"])
@@ -371,14 +653,19 @@ class NestedIntervalsModel(models.Model):
         subtree, as opposed to reattaching all the subnodes to its parent node.
 
         ``delete`` will not return anything. """
-        self.get_descendants(include_self=True).delete()
+        using = self._get_tree_database(kwargs.get("using"))
+        with transaction.atomic(using=using, savepoint=self._tree_manager._get_tree_batch() is None), \
+                reading_from_primary():
+            self._tree_manager._detach_subtree_aggregates(self)
+            self.get_descendants(include_self=True).delete()
+            self._tree_manager._bump_tree_version(self.tree_id)
 
     def _get_user_field_names(self):
         """ Returns the list of user defined (i.e. non-nested_intervals internal) field names. """
         field_names = []
-        internal_fields = ("left", "right", "tree_id", "level")
+        internal_fields = ("left", "right", "tree_id", "level", "shadow_left", "shadow_right")
         for field in self._meta.fields:
-            if (field.name not in internal_fields) and (not isinstance(field, AutoField)) and (not field.primary_key):
+            if (field.name not in internal_fields) and (not isinstance(field, (AutoField, SubtreeAggregateField))) and (not field.primary_key):
                 field_names.append(field.name)
         return field_names
 
@@ -390,3 +677,59 @@ class NestedIntervalsModel(models.Model):
             right=node.right))
         for child in node.get_children():
             self.print_tree(child, indent+1)
+
+
+class OnlineRebalanceMixin(models.Model):
+    """
+    Adds the shadow columns needed by ``NestedIntervalsManager.rebalance_tree_online``
+    to a ``NestedIntervalsModel``, e.g. ``class Node(NestedIntervalsModel, OnlineRebalanceMixin)``.
+    Nodes whose intervals change while an online rebalance is running have their shadow columns
+    cleared, so the rebalance knows to try again.
+    """
+
+    shadow_left = models.DecimalField(
+        max_digits=DECIMAL_PLACES+1, decimal_places=DECIMAL_PLACES, null=True, blank=True, editable=False)
+    shadow_right = models.DecimalField(
+        max_digits=DECIMAL_PLACES+1, decimal_places=DECIMAL_PLACES, null=True, blank=True, editable=False)
+
+    class Meta:
+        abstract = True
+
+
+class PendingRebalance(models.Model):
+    """
+    A tree that is waiting to be rebalanced by the ``process_rebalance_queue`` command.
+    See ``nested_intervals.rebalancing.DatabaseQueueRebalanceExecutor``.
+    """
+
+    model = models.CharField(max_length=100)
+    tree_id = models.CharField(max_length=64)
+    created = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        unique_together = ("model", "tree_id")
+
+
+class TreeVersion(models.Model):
+    """
+    The version of a tree, bumped every time the tree's structure changes.
+    See ``NestedIntervalsManager.get_tree_version``.
+    """
+
+    model = models.CharField(max_length=100)
+    tree_id = models.CharField(max_length=64)
+    version = models.BigIntegerField(default=0)
+
+    class Meta:
+        unique_together = ("model", "tree_id")
+
+
+class TreeIdCounter(models.Model):
+    """
+    The last ``tree_id`` handed out for a tree model with an integer ``tree_id`` field (or, with
+    trees spread across several databases, the number of the last one handed out in the
+    database the counter is in). See ``NestedIntervalsManager._new_tree_ids``.
+    """
+
+    model = models.CharField(max_length=100, unique=True)
+    value = models.BigIntegerField(default=0)
@@ -1,8 +1,230 @@
+from __future__ import unicode_literals
+from bisect import bisect_left, bisect_right
+
 from django.db import models
+from django.db.models import Exists, OuterRef
+from django.db.models.query import ModelIterable
+
+TREE_FIELDS = ("left", "right", "level", "tree_id")
+
+
+def _get_prefetch_queryset(model, queryset, nodes):
+    # like prefetch_related, query the database the nodes were read from, unless the given
+    # queryset says otherwise
+    database = nodes[0]._state.db
+    if queryset is None:
+        return model._default_manager.db_manager(database).all()
+    queryset = queryset.using(queryset._db or database)
+    # the tree fields are needed to hand the nodes out, so make sure they're loaded
+    field_names, defer = queryset.query.deferred_loading
+    if defer:
+        return queryset.defer(None).defer(*(set(field_names) - set(TREE_FIELDS)))
+    elif field_names:
+        return queryset.only(*(set(field_names) | set(TREE_FIELDS)))
+    return queryset
+
+
+def prefetch_descendants(nodes, max_depth=None, queryset=None):
+    """
+    Fetches the descendants (down to ``max_depth`` levels below each node, if given) of all of
+    the given ``nodes`` with one query, and caches them on each node, so their
+    ``get_descendants()`` and ``get_children()`` don't need to query the database.
+
+    ``queryset`` can be used to customize the query for the descendants (e.g. with
+    ``select_related``); only the descendants it returns are cached.
+    """
+    nodes = list(nodes)
+    if not nodes:
+        return
+    by_database = _group_by_database(nodes)
+    if len(by_database) > 1:
+        for database_nodes in by_database:
+            prefetch_descendants(database_nodes, max_depth, queryset)
+        return
+    model = type(nodes[0])
+    queryset = _get_prefetch_queryset(model, queryset, nodes)
+
+    # a descendant is any node that has one of ``nodes`` above it in the same tree
+    parents = model._default_manager.filter(
+        pk__in=[node.pk for node in nodes],
+        tree_id=OuterRef("tree_id"),
+        left__lt=OuterRef("left"),
+        right__gt=OuterRef("left"),
+    )
+    if max_depth is not None:
+        parents = parents.filter(level__gte=OuterRef("level") - max_depth)
+    descendants = queryset.annotate(
+        _has_prefetching_parent=Exists(parents.order_by().values("pk")),
+    ).filter(_has_prefetching_parent=True).order_by("tree_id", "left")
+
+    # group the descendants by tree, in order, to bisect on their left values
+    trees = {}
+    for descendant in descendants:
+        lefts, tree_nodes = trees.setdefault(descendant.tree_id, ([], []))
+        lefts.append(descendant.left)
+        tree_nodes.append(descendant)
+
+    for node in nodes:
+        lefts, tree_nodes = trees.get(node.tree_id, ((), ()))
+        found = tree_nodes[bisect_right(lefts, node.left):bisect_left(lefts, node.right)]
+        node._prefetched_descendants = (max_depth, [
+            descendant for descendant in found
+            if descendant.pk != node.pk and (max_depth is None or descendant.level <= node.level + max_depth)
+        ])
+
+
+def prefetch_ancestors(nodes, queryset=None):
+    """
+    Fetches the ancestors of all of the given ``nodes`` with one query, and caches them on
+    each node as ``ancestors_cached`` (a list, root first), which ``get_ancestors()`` is then
+    served from. Ancestors shared by several nodes are the same instance.
+
+    ``queryset`` can be used to customize the query for the ancestors.
+    """
+    nodes = list(nodes)
+    if not nodes:
+        return
+    by_database = _group_by_database(nodes)
+    if len(by_database) > 1:
+        for database_nodes in by_database:
+            prefetch_ancestors(database_nodes, queryset)
+        return
+    model = type(nodes[0])
+    queryset = _get_prefetch_queryset(model, queryset, nodes)
+
+    # an ancestor is any node with one of ``nodes`` below it in the same tree
+    children = model._default_manager.filter(
+        pk__in=[node.pk for node in nodes],
+        tree_id=OuterRef("tree_id"),
+        left__gt=OuterRef("left"),
+        left__lt=OuterRef("right"),
+    )
+    ancestors = queryset.annotate(
+        _has_prefetching_child=Exists(children.order_by().values("pk")),
+    ).filter(_has_prefetching_child=True).order_by("tree_id", "left")
+
+    trees = {}
+    for ancestor in ancestors:
+        trees.setdefault(ancestor.tree_id, []).append(ancestor)
+
+    # walk each tree's ancestors and nodes together, in order of their left values, keeping a
+    # stack of the ancestors that enclose the current position
+    for tree_id, tree_nodes in _group_by_tree(nodes):
+        tree_ancestors = trees.get(tree_id, [])
+        stack = []
+        position = 0
+        for node in sorted(tree_nodes, key=lambda node: node.left):
+            while position < len(tree_ancestors) and tree_ancestors[position].left < node.left:
+                ancestor = tree_ancestors[position]
+                while stack and stack[-1].right < ancestor.left:
+                    stack.pop()
+                stack.append(ancestor)
+                position += 1
+            while stack and stack[-1].right < node.left:
+                stack.pop()
+            node._prefetched_ancestors = [ancestor for ancestor in stack if ancestor.pk != node.pk]
+
+
+def _group_by_database(nodes):
+    databases = {}
+    for node in nodes:
+        databases.setdefault(node._state.db, []).append(node)
+    return list(databases.values())
+
+
+def _group_by_tree(nodes):
+    trees = {}
+    for node in nodes:
+        trees.setdefault(node.tree_id, []).append(node)
+    return trees.items()
 
 
 class NestedIntervalsQuerySet(models.query.QuerySet):
-    
+
+    def __init__(self, *args, **kwargs):
+        super(NestedIntervalsQuerySet, self).__init__(*args, **kwargs)
+        # the arguments to prefetch_descendants/prefetch_ancestors, if they've been asked for
+        self._prefetch_descendants = None
+        self._prefetch_ancestors = None
+        self._tree_prefetch_done = False
+
+    def _clone(self, *args, **kwargs):
+        clone = super(NestedIntervalsQuerySet, self)._clone(*args, **kwargs)
+        clone._prefetch_descendants = self._prefetch_descendants
+        clone._prefetch_ancestors = self._prefetch_ancestors
+        return clone
+
+    def _fetch_all(self):
+        super(NestedIntervalsQuerySet, self)._fetch_all()
+        if not self._tree_prefetch_done:
+            if self._iterable_class is ModelIterable:
+                if self._prefetch_descendants is not None:
+                    prefetch_descendants(self._result_cache, **self._prefetch_descendants)
+                if self._prefetch_ancestors is not None:
+                    prefetch_ancestors(self._result_cache, **self._prefetch_ancestors)
+            self._tree_prefetch_done = True
+
+    def create(self, **kwargs):
+        if self._db is not None or self._hints:
+            return super(NestedIntervalsQuerySet, self).create(**kwargs)
+        # leave the database to the node, which knows which tree it's going into once it's saved
+        # (see nested_intervals.routers.TreeShardRouter)
+        node = self.model(**kwargs)
+        self._for_write = True
+        node.save(force_insert=True)
+        return node
+
+    def prefetch_descendants(self, max_depth=None, queryset=None):
+        """
+        Returns a new ``QuerySet`` that, like ``prefetch_related``, fetches the descendants of
+        all of the nodes it returns with one extra query, so that their ``get_descendants()``
+        and ``get_children()`` are served without further queries. See ``prefetch_descendants``.
+        """
+        clone = self._clone()
+        clone._prefetch_descendants = {"max_depth": max_depth, "queryset": queryset}
+        return clone
+
+    def with_ancestors(self, queryset=None):
+        """
+        Returns a new ``QuerySet`` that fetches the ancestors of all of the nodes it returns
+        with one extra query, and sets each node's ``ancestors_cached`` to its ancestors, root
+        first (also used by ``get_ancestors()``). See ``prefetch_ancestors``.
+        """
+        clone = self._clone()
+        clone._prefetch_ancestors = {"queryset": queryset}
+        return clone
+
+    def get_cached_trees(self, max_depth=None):
+        """
+        Evaluates the ``QuerySet`` and returns its top-level nodes (those without an ancestor
+        in the results), with the descendants of every node cached from the results, so that
+        their ``get_children()`` and ``get_descendants()`` don't query the database.
+
+        The results are expected to hold the whole subtrees of the top-level nodes or, if
+        ``max_depth`` is given, their subtrees down to that many levels below them (e.g. from
+        ``get_descendants(include_self=True, max_depth=...)``); deeper queries for nodes near
+        the bottom go to the database.
+        """
+        nodes = sorted(self, key=lambda node: (str(node.tree_id), node.left))
+        top_nodes = []
+        # the nodes enclosing the current one, with their lists of descendants
+        stack = []
+        for node in nodes:
+            while stack and stack[-1][0].right < node.left:
+                stack.pop()
+            if stack and stack[-1][0].tree_id != node.tree_id:
+                stack = []
+            for ancestor, descendants in stack:
+                descendants.append(node)
+            if not stack:
+                top_nodes.append(node)
+                top_level = node.level
+            depth = None if max_depth is None else max_depth - (node.level - top_level)
+            descendants = []
+            node._prefetched_descendants = (depth, descendants)
+            stack.append((node, descendants))
+        return top_nodes
+
     def get_descendants(self, *args, **kwargs):
         """
         Alias to `nested_intervals.managers.NestedIntervalsManager.get_queryset_descendants`.
@@ -0,0 +1,239 @@
+"""
+Executors for running full tree rebalances outside of the request that triggered them.
+
+When ``NESTED_INTERVALS_DEFERRED_REBALANCE`` is enabled, an insertion that runs out of room
+only re-spaces the smallest subtree it needs to, and asks the configured executor to rebalance
+the whole tree once the surrounding transaction has committed.
+"""
+from __future__ import unicode_literals
+import logging
+import multiprocessing
+import threading
+import time
+from collections import namedtuple
+from multiprocessing.pool import ThreadPool
+
+import django
+from django.apps import apps
+from django.db import IntegrityError, connections, router, transaction
+from django.utils.module_loading import import_string
+from django.utils.six.moves import queue
+
+from .conf import REBALANCE_EXECUTOR, REBALANCE_THREADS
+from .routers import _get_tree_key
+
+logger = logging.getLogger(__name__)
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def get_rebalance_executor():
+    """
+    Returns the (shared) instance of the executor configured by
+    ``NESTED_INTERVALS_REBALANCE_EXECUTOR``.
+    """
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = import_string(REBALANCE_EXECUTOR)()
+        return _executor
+
+
+def schedule_rebalance(model, tree_id):
+    """
+    Hands the tree with the given ``tree_id`` to the rebalance executor once the current
+    transaction has been committed (or straight away, if there is no transaction).
+    """
+    transaction.on_commit(
+        lambda: get_rebalance_executor().submit(model, tree_id),
+        using=router.db_for_write(model, tree_id=tree_id),
+    )
+
+
+def run_rebalance(model, tree_id):
+    """
+    Rebalances a single tree, ignoring trees that have been deleted in the meantime.
+    """
+    try:
+        model.objects.rebalance_tree(tree_id)
+    except model.DoesNotExist:
+        pass
+
+
+class BaseRebalanceExecutor(object):
+    """
+    Base class for rebalance executors. Subclasses need to implement ``submit``.
+    """
+
+    def submit(self, model, tree_id):
+        raise NotImplementedError("Subclasses of BaseRebalanceExecutor must implement submit()")
+
+
+class SynchronousRebalanceExecutor(BaseRebalanceExecutor):
+    """
+    Rebalances the tree immediately, in the calling thread. Mostly useful for tests.
+    """
+
+    def submit(self, model, tree_id):
+        run_rebalance(model, tree_id)
+
+
+class ThreadPoolRebalanceExecutor(BaseRebalanceExecutor):
+    """
+    Rebalances trees on a small pool of in-process daemon threads, each using its own
+    database connection. Trees that are already waiting in the queue aren't queued twice.
+    """
+
+    def __init__(self, max_workers=REBALANCE_THREADS):
+        self.max_workers = max_workers
+        self._queue = queue.Queue()
+        self._pending = set()
+        self._lock = threading.Lock()
+        self._workers = []
+
+    def submit(self, model, tree_id):
+        key = _get_tree_key(model, tree_id)
+        with self._lock:
+            if key in self._pending:
+                return
+            self._pending.add(key)
+            if len(self._workers) < self.max_workers:
+                worker = threading.Thread(target=self._work, name="nested-intervals-rebalance")
+                worker.daemon = True
+                worker.start()
+                self._workers.append(worker)
+        self._queue.put((model, tree_id, key))
+
+    def join(self):
+        """
+        Blocks until all of the submitted rebalances have been run.
+        """
+        self._queue.join()
+
+    def _work(self):
+        while True:
+            model, tree_id, key = self._queue.get()
+            with self._lock:
+                self._pending.discard(key)
+            try:
+                run_rebalance(model, tree_id)
+            except Exception:
+                logger.exception("Failed to rebalance tree %s of %s", tree_id, model._meta.label)
+            finally:
+                for connection in connections.all():
+                    connection.close()
+                self._queue.task_done()
+
+
+class DatabaseQueueRebalanceExecutor(BaseRebalanceExecutor):
+    """
+    Records the trees that need rebalancing in the ``PendingRebalance`` table of the database
+    each tree is in, to be picked up by the ``process_rebalance_queue`` management command
+    (e.g. from a cron job or worker).
+    """
+
+    def submit(self, model, tree_id):
+        from .models import PendingRebalance
+        alias = router.db_for_write(model, tree_id=tree_id)
+        try:
+            with transaction.atomic(using=alias):
+                label, tree_key = _get_tree_key(model, tree_id)
+                PendingRebalance.objects.using(alias).get_or_create(model=label, tree_id=tree_key)
+        except IntegrityError:
+            # someone else queued the same tree at the same time
+            pass
+
+
+def process_pending_rebalances(limit=None, databases=None):
+    """
+    Runs the rebalances queued by ``DatabaseQueueRebalanceExecutor`` in the given
+    ``databases`` (by default, every database that trees are kept in), oldest first in each,
+    and returns the number of trees that were rebalanced.
+    """
+    from .models import PendingRebalance
+
+    processed = 0
+    for alias in databases or _get_tree_databases():
+        queue = PendingRebalance.objects.using(alias)
+        pending_ids = list(queue.order_by("created", "pk").values_list("pk", flat=True))
+        for pending_id in pending_ids:
+            if limit is not None and processed >= limit:
+                return processed
+            with transaction.atomic(using=alias):
+                pending = queue.select_for_update().filter(pk=pending_id).first()
+                if pending is None:
+                    # already handled by another worker
+                    continue
+                run_rebalance(apps.get_model(pending.model), pending.tree_id)
+                pending.delete()
+            processed += 1
+    return processed
+
+
+def _get_tree_databases():
+    from .models import NestedIntervalsModel
+    databases = []
+    for model in apps.get_models():
+        if issubclass(model, NestedIntervalsModel):
+            databases.extend(alias for alias in model.objects.get_databases() if alias not in databases)
+    return databases
+
+
+TreeRebalanceResult = namedtuple("TreeRebalanceResult", ["tree_id", "headroom", "rebalanced", "rows", "duration"])
+
+
+def rebalance_trees_in_pool(model, tree_ids, workers=1, use_processes=False, min_headroom=None, dry_run=False):
+    """
+    Rebalances the given trees across a pool of ``workers`` threads or processes.
+    See ``NestedIntervalsManager.rebalance_trees``.
+    """
+    if not dry_run and connections[router.db_for_write(model)].vendor == "sqlite":
+        # SQLite only allows one writer at a time, so parallel workers would just fail on its lock
+        # (checking the trees' headroom only reads, so that can still be spread across workers)
+        workers = 1
+    # worker threads each get their own connection, which needs closing when they're done with it
+    in_threads = workers > 1 and not use_processes
+    tasks = [(model._meta.label, tree_id, min_headroom, dry_run, in_threads) for tree_id in tree_ids]
+
+    if workers <= 1:
+        return [_rebalance_tree_task(task) for task in tasks]
+
+    if use_processes:
+        # forked processes mustn't share the parent's database connections
+        for connection in connections.all():
+            connection.close()
+        pool = multiprocessing.Pool(workers, initializer=_init_worker_process)
+    else:
+        pool = ThreadPool(workers)
+
+    try:
+        return pool.map(_rebalance_tree_task, tasks, chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def _init_worker_process():
+    if not apps.ready:
+        django.setup()
+
+
+def _rebalance_tree_task(task):
+    label, tree_id, min_headroom, dry_run, close_connections = task
+    model = apps.get_model(label)
+    start = time.time()
+    try:
+        headroom = model.objects.get_tree_headroom(tree_id)
+        rebalance = min_headroom is None or headroom < min_headroom
+        rows = 0
+        if rebalance:
+            if dry_run:
+                rows = model.objects._for_tree(tree_id).filter(tree_id=tree_id).count()
+            else:
+                rows = model.objects.rebalance_tree(tree_id)
+        return TreeRebalanceResult(tree_id, headroom, rebalance, rows, time.time() - start)
+    finally:
+        if close_connections:
+            for connection in connections.all():
+                connection.close()
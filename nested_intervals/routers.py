@@ -0,0 +1,197 @@
+"""
+Tree-aware database routing: structural tree reads to read replicas, and trees to shards.
+
+The querysets behind ``get_descendants()``, ``get_ancestors()``, ``get_children()``,
+``parent`` and the other structural reads of a node carry the router hints ``tree_read=True``
+and ``tree_id``, so any router can tell them apart from other queries. ``TreeReplicaRouter``
+uses them to send those reads to replicas, e.g.::
+
+    DATABASE_ROUTERS = ["nested_intervals.routers.TreeReplicaRouter"]
+    NESTED_INTERVALS_READ_REPLICAS = ["replica1", "replica2"]
+
+Tree reads stay on the primary database (wherever writes to the model are routed) while a tree
+is being changed, so the neighbours an insertion or a move is computed from are up to date,
+and for ``NESTED_INTERVALS_PRIMARY_READ_WINDOW`` seconds after a tree was changed in the same
+thread, so a request reads its own writes in spite of replication lag.
+"""
+from __future__ import unicode_literals
+import random
+import threading
+import time
+import zlib
+from collections import OrderedDict
+from contextlib import contextmanager
+
+from django.db import router
+from django.utils import six
+
+from .conf import PRIMARY_READ_WINDOW, READ_REPLICAS, TREE_SHARDS
+
+# the tree reads pinned to the primary in each thread
+_primary_reads = threading.local()
+
+
+def _get_tree_key(model, tree_id):
+    field = model._meta.get_field("tree_id")
+    # (trees are shared by models whose tree fields live in the same table)
+    return field.model._meta.label_lower, str(field.to_python(tree_id))
+
+
+def _get_written_trees():
+    # when each tree was last written in this thread, least recently written first
+    return _primary_reads.__dict__.setdefault("written", OrderedDict())
+
+
+@contextmanager
+def reading_from_primary():
+    """
+    A context manager that keeps the tree reads made in it (in this thread) on the primary.
+    """
+    _primary_reads.depth = getattr(_primary_reads, "depth", 0) + 1
+    try:
+        yield
+    finally:
+        _primary_reads.depth -= 1
+
+
+def record_tree_write(model, tree_id):
+    """
+    Keeps the reads of the tree with the given ``tree_id`` made in this thread on the primary
+    for the next ``NESTED_INTERVALS_PRIMARY_READ_WINDOW`` seconds.
+    """
+    if PRIMARY_READ_WINDOW:
+        written = _get_written_trees()
+        key = _get_tree_key(model, tree_id)
+        now = time.time()
+        written.pop(key, None)
+        written[key] = now
+        # forget the trees whose window is over (the least recently written ones), so
+        # long-lived threads, such as rebalance workers, don't keep every tree they ever wrote
+        oldest = next(iter(written))
+        while now - written[oldest] >= PRIMARY_READ_WINDOW:
+            del written[oldest]
+            oldest = next(iter(written))
+
+
+def reads_from_primary(model, tree_id):
+    """
+    Returns ``True`` if the reads of the tree with the given ``tree_id`` made in this thread
+    need to go to the primary.
+    """
+    if getattr(_primary_reads, "depth", 0):
+        return True
+    written = _get_written_trees()
+    key = _get_tree_key(model, tree_id)
+    if key not in written:
+        return False
+    if time.time() - written[key] < PRIMARY_READ_WINDOW:
+        return True
+    del written[key]
+    return False
+
+
+class TreeReplicaRouter(object):
+    """
+    A database router that sends the structural reads of trees to one of the database aliases
+    in ``replicas`` (by default, ``NESTED_INTERVALS_READ_REPLICAS``), except where they need to
+    see the latest writes. Other queries are left to the next router.
+
+    Override ``get_replica`` to pick replicas differently, e.g. to keep each tree on one.
+    """
+
+    def __init__(self, replicas=None):
+        self.replicas = list(READ_REPLICAS if replicas is None else replicas)
+
+    def get_replica(self, model, tree_id):
+        """
+        Returns the alias of the replica to read the tree with the given ``tree_id`` from.
+        """
+        return random.choice(self.replicas) if self.replicas else None
+
+    def db_for_read(self, model, **hints):
+        if not hints.get("tree_read"):
+            return None
+        if reads_from_primary(model, hints["tree_id"]):
+            return router.db_for_write(model, tree_id=hints["tree_id"])
+        return self.get_replica(model, hints["tree_id"])
+
+    def db_for_write(self, model, **hints):
+        # nodes read from a replica are still saved to the primary
+        instance = hints.get("instance")
+        if instance is not None and instance._state.db in self.replicas:
+            return router.db_for_write(model, tree_id=getattr(instance, "tree_id", None))
+        return None
+
+    def allow_relation(self, obj1, obj2, **hints):
+        databases = set(self.replicas)
+        databases.add(router.db_for_write(type(obj1)))
+        if obj1._state.db in databases and obj2._state.db in databases:
+            return True
+        return None
+
+
+class TreeShardRouter(object):
+    """
+    A database router that keeps each tree, whole, in one of the database aliases in
+    ``shards`` (by default, ``NESTED_INTERVALS_TREE_SHARDS``), e.g.::
+
+        DATABASE_ROUTERS = ["nested_intervals.routers.TreeShardRouter"]
+        NESTED_INTERVALS_TREE_SHARDS = ["shard1", "shard2"]
+
+    Queries about one tree (and the saving and deleting of its nodes) go to the shard its
+    ``tree_id`` maps to; ``NestedIntervalsManager`` fans forest-wide operations, such as
+    ``iter_root_nodes()`` and ``rebalance_all_trees()``, out to every shard (see
+    ``NestedIntervalsManager.get_databases``). Other queries are left to the next router.
+
+    Integer tree ids are mapped round the shards (``tree_id % len(shards)``), so each shard
+    can hand out the ids of its own trees from a counter of its own (see
+    ``get_tree_id_sequence``); other tree ids are mapped by a hash.
+
+    Override ``get_shard`` to map trees to shards differently, e.g. with a lookup table (and
+    ``get_tree_id_sequence`` to match, for integer tree ids). Nodes can't be moved between
+    trees on different shards.
+    """
+
+    def __init__(self, shards=None):
+        self.shards = list(TREE_SHARDS if shards is None else shards)
+
+    def get_shards(self, model):
+        """
+        Returns the aliases of the databases the trees of ``model`` are spread across.
+        """
+        return list(self.shards)
+
+    def get_shard(self, model, tree_id):
+        """
+        Returns the alias of the database the tree with the given ``tree_id`` is kept in.
+        """
+        tree_id = model._meta.get_field("tree_id").to_python(tree_id)
+        if isinstance(tree_id, six.integer_types):
+            return self.shards[tree_id % len(self.shards)]
+        tree_key = _get_tree_key(model, tree_id)[1]
+        return self.shards[zlib.crc32(tree_key.encode("utf-8")) % len(self.shards)]
+
+    def get_tree_id_sequence(self, model, database):
+        """
+        Returns the ``(stride, offset)`` of the integer tree ids of the trees kept in
+        ``database``: the ids ``n * stride + offset`` are the ones that map to it.
+        """
+        return len(self.shards), self.shards.index(database)
+
+    def _get_tree_id(self, model, hints):
+        if not hasattr(model, "_get_tree_queryset"):
+            return None
+        if "tree_id" in hints:
+            return hints["tree_id"]
+        instance = hints.get("instance")
+        if isinstance(instance, model):
+            return instance.tree_id
+        return None
+
+    def db_for_read(self, model, **hints):
+        tree_id = self._get_tree_id(model, hints)
+        if tree_id is None or not self.shards:
+            return None
+        return self.get_shard(model, tree_id)
+
+    db_for_write = db_for_read
@@ -0,0 +1,160 @@
+"""
+Streaming export and import of whole trees, as JSON lines.
+
+The first line is a header, e.g. ``{"model": "myapp.category", "nodes": 3}``, followed by one
+line per node, in tree order, e.g. ``{"depth": 1, "fields": {"name": "Games"}}``. Only the
+node's own concrete fields are exported (not its primary key, nested intervals fields or
+many-to-many relations), so imported nodes get fresh primary keys, and evenly spaced intervals.
+"""
+from __future__ import unicode_literals
+import json
+from functools import reduce
+from operator import or_
+
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import models, transaction
+from django.db.models import Case, Q, Value, When
+
+from .conf import DECIMAL_PLACES, INTERVAL_UPDATE_BATCH_SIZE
+from .intervals import get_interval_for_insertion_relative_to
+
+
+def _get_exported_fields(model):
+    names = model()._get_user_field_names()
+    return [field for field in model._meta.concrete_fields if field.name in names]
+
+
+def export_tree(model, tree_id, stream, chunk_size=1000):
+    """
+    Writes the tree with the given ``tree_id`` to ``stream`` (a text file-like object),
+    one node per line. Returns the number of nodes written.
+    """
+    root = model.objects.root_node(tree_id)
+    fields = _get_exported_fields(model)
+
+    header = {"model": model._meta.label_lower, "nodes": root.get_descendant_count() + 1}
+    stream.write(json.dumps(header) + "\n")
+
+    count = 0
+    for node, depth, _ in root.iter_subtree(chunk_size=chunk_size):
+        line = {
+            "depth": depth,
+            "fields": dict((field.attname, field.value_from_object(node)) for field in fields),
+        }
+        stream.write(json.dumps(line, cls=DjangoJSONEncoder) + "\n")
+        count += 1
+    return count
+
+
+def import_tree(model, stream, batch_size=500):
+    """
+    Reads a tree written by ``export_tree`` from ``stream`` and creates it as a new tree,
+    with evenly spaced intervals. Nodes are created ``batch_size`` at a time with
+    ``bulk_create``, so memory use doesn't depend on the size of the tree.
+
+    Returns the root node of the new tree.
+    """
+    tree_id = model.objects._new_tree_id()
+    manager = model.objects._for_tree(tree_id)
+    with transaction.atomic(using=manager._get_connection().alias):
+        return _import_tree(manager, model, stream, batch_size, tree_id)
+
+
+def _import_tree(manager, model, stream, batch_size, tree_id):
+    lines = (line for line in stream if line.strip())
+    try:
+        header = json.loads(next(lines))
+        total = int(header["nodes"])
+    except (StopIteration, ValueError, KeyError, TypeError):
+        raise ValueError("The tree export is missing its header line.")
+    if total < 1:
+        raise ValueError("The tree export doesn't contain any nodes.")
+
+    fields = dict((field.attname, field) for field in _get_exported_fields(model))
+    interval = get_interval_for_insertion_relative_to(None, "last-child", count=total)
+    increment = interval["increment"]
+
+    # the nodes waiting to be created, and the (left, right) values of already created nodes
+    # that turned out to have children, whose right values need fixing up
+    nodes = []
+    rights = []
+    # [node, has_children, created] for each of the nodes that haven't been closed yet
+    stack = []
+    position = [0]
+    count = 0
+
+    def next_value():
+        value = interval["left"] + increment * position[0]
+        position[0] += 1
+        return value
+
+    def close():
+        node, has_children, created = stack.pop()
+        right = next_value()
+        # (leaves already have the right value in place)
+        if has_children:
+            if created:
+                rights.append((node.left, right))
+            else:
+                node.right = right
+
+    def flush():
+        manager.bulk_create(nodes)
+        del nodes[:]
+        for entry in stack:
+            entry[2] = True
+        _update_rights(manager, tree_id, rights, increment)
+        del rights[:]
+
+    for line in lines:
+        data = json.loads(line)
+        depth = data["depth"]
+        count += 1
+        if count > total:
+            raise ValueError("The tree export contains more nodes than its header says.")
+        if (count == 1) != (depth == 0) or depth > len(stack):
+            raise ValueError("Invalid depth %s for node %d of the tree export." % (depth, count))
+
+        while len(stack) > depth:
+            close()
+        if stack:
+            stack[-1][1] = True
+
+        node = model(**dict(
+            (name, fields[name].to_python(value)) for name, value in data["fields"].items() if name in fields
+        ))
+        node.tree_id = tree_id
+        node.level = depth
+        node.left = next_value()
+        node.right = node.left + increment
+        nodes.append(node)
+        stack.append([node, False, False])
+
+        if len(nodes) >= batch_size:
+            flush()
+
+    if count != total:
+        raise ValueError("The tree export contains fewer nodes than its header says.")
+
+    while stack:
+        close()
+    flush()
+    manager._create_tree_versions([tree_id])
+    manager.rebuild_subtree_aggregates([tree_id])
+
+    return manager.root_node(tree_id)
+
+
+def _update_rights(manager, tree_id, rights, increment):
+    # nodes are identified by their left value; allow for the rounding some backends do on
+    # decimals (no two lefts in the new tree are closer than one increment)
+    tolerance = increment / 4
+    output_field = models.DecimalField(max_digits=DECIMAL_PLACES+1, decimal_places=DECIMAL_PLACES)
+    for start in range(0, len(rights), INTERVAL_UPDATE_BATCH_SIZE):
+        batch = rights[start:start+INTERVAL_UPDATE_BATCH_SIZE]
+        conditions = [Q(left__range=(left - tolerance, left + tolerance)) for left, _ in batch]
+        manager.filter(reduce(or_, conditions), tree_id=tree_id).update(
+            right=Case(*[
+                When(condition, then=Value(right)) for condition, (_, right) in zip(conditions, batch)
+            ], output_field=output_field),
+        )
@@ -0,0 +1,11 @@
+"""
+Signals sent by nested intervals trees.
+"""
+from __future__ import unicode_literals
+
+from django.dispatch import Signal
+
+# Sent once the transaction that changed a tree has been committed, with the model as the
+# sender, and the ``tree_id`` and new ``version`` of the tree as arguments. Receivers can use
+# it to invalidate whatever they've cached about that one tree.
+tree_changed = Signal()
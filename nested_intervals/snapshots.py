@@ -0,0 +1,220 @@
+"""
+Read-only snapshots of a tree's structure in flat binary files, which any number of worker
+processes can ``mmap`` and query without each holding their own copy of the data.
+
+A snapshot file holds a short JSON header (model, tree id, tree version, node count), followed
+by fixed-width integer columns of the nodes in tree order: pks, left and right ranks (see
+``nested_intervals.index``), levels and parent positions, plus the pks in sorted order (with
+their positions) for looking nodes up by pk.
+"""
+from __future__ import unicode_literals
+import json
+import mmap
+import os
+import struct
+import sys
+from bisect import bisect_left
+
+from django.apps import apps
+
+from .index import TreeQueryMixin, _get_tree_layout, _make_array
+
+MAGIC = b"NITREE01"
+_COLUMNS = ("pks", "lefts", "rights", "levels", "parents", "sorted_pks", "sorted_positions")
+_ITEM_SIZE = 8
+
+
+def _tree_id_to_str(model, tree_id):
+    return str(model._meta.get_field("tree_id").to_python(tree_id))
+
+
+def _get_column(values):
+    # the values as a column of 8-byte integers: an array, or the packed bytes on Pythons without
+    # "q" arrays, whose "l" ones may be narrower (see nested_intervals.index._make_array)
+    column = _make_array("q", values)
+    if getattr(column, "itemsize", None) == _ITEM_SIZE:
+        return column
+    try:
+        return struct.pack(str("=%dq") % len(column), *column)
+    except struct.error:
+        raise ValueError("Only trees with integer primary keys can be written to snapshots.")
+
+
+def write_snapshot(model, tree_id, path):
+    """
+    Writes a snapshot of the tree with the given ``tree_id`` to ``path``. The file is written
+    next to ``path`` first and then moved into place, so readers never see a partial file.
+    The model's primary keys need to be integers.
+    """
+    # read the version first, so changes made while the tree is read leave the snapshot stale
+    version = model.objects.get_tree_version(tree_id)
+    nodes = model._default_manager.db_manager(hints={"tree_id": tree_id}).filter(tree_id=tree_id)
+    rows = nodes.order_by("left").values_list("pk", "left", "right", "level")
+    pks, lefts, rights, levels, parents = _get_tree_layout(rows.iterator())
+    if not pks:
+        raise model.DoesNotExist("There is no tree with tree_id %s." % tree_id)
+
+    columns = [_get_column(column) for column in (pks, lefts, rights, levels, parents)]
+    order = sorted(range(len(pks)), key=pks.__getitem__)
+    columns.append(_get_column([pks[position] for position in order]))
+    columns.append(_get_column(order))
+
+    header = json.dumps({
+        "model": model._meta.label_lower,
+        "tree_id": _tree_id_to_str(model, tree_id),
+        "version": version,
+        "count": len(pks),
+        "byteorder": sys.byteorder,
+    }).encode("utf-8")
+    # pad the header so the columns are aligned
+    header += b" " * (-(len(MAGIC) + 4 + len(header)) % _ITEM_SIZE)
+
+    temp_path = "%s.%d.tmp" % (path, os.getpid())
+    with open(temp_path, "wb") as f:
+        f.write(MAGIC)
+        f.write(struct.pack(str("<I"), len(header)))
+        f.write(header)
+        for column in columns:
+            if isinstance(column, bytes):
+                f.write(column)
+            else:
+                column.tofile(f)
+    if hasattr(os, "replace"):
+        os.replace(temp_path, path)
+    else:
+        os.rename(temp_path, path)
+
+
+class _Column(object):
+    """
+    A read-only sequence of the integers in a column of the mapped file, for Pythons whose
+    ``memoryview`` can't be cast.
+    """
+
+    def __init__(self, buffer, offset, length):
+        self.buffer = buffer
+        self.offset = offset
+        self.length = length
+
+    def __len__(self):
+        return self.length
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(self.length))]
+        if index < 0:
+            index += self.length
+        if not 0 <= index < self.length:
+            raise IndexError("column index out of range")
+        return struct.unpack_from(str("=q"), self.buffer, self.offset + index * _ITEM_SIZE)[0]
+
+
+class TreeSnapshot(TreeQueryMixin):
+    """
+    A tree snapshot written by ``write_snapshot``, mapped read-only into memory. Supports the
+    same queries as ``nested_intervals.index.TreeIndex``, reading straight from the mapped file.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, "rb") as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            self._read_header()
+        except Exception:
+            self.close()
+            raise
+
+    def _read_header(self):
+        if self._mmap[:len(MAGIC)] != MAGIC:
+            raise ValueError("%s is not a tree snapshot." % self.path)
+        offset = len(MAGIC)
+        header_length = struct.unpack_from(str("<I"), self._mmap, offset)[0]
+        offset += 4
+        header = json.loads(self._mmap[offset:offset+header_length].decode("utf-8"))
+        offset += header_length
+        if header["byteorder"] != sys.byteorder:
+            raise ValueError("%s was written on a machine with a different byte order." % self.path)
+
+        self.model_label = header["model"]
+        self.tree_id = header["tree_id"]
+        self.version = header["version"]
+        self.count = header["count"]
+        if len(self._mmap) != offset + len(_COLUMNS) * self.count * _ITEM_SIZE:
+            raise ValueError("%s is truncated." % self.path)
+
+        size = self.count * _ITEM_SIZE
+        self._views = []
+        for name in _COLUMNS:
+            if hasattr(memoryview, "cast"):
+                view = memoryview(self._mmap)[offset:offset+size].cast("q")
+                self._views.append(view)
+            else:
+                view = _Column(self._mmap, offset, self.count)
+            setattr(self, name, view)
+            offset += size
+
+    @property
+    def model(self):
+        return apps.get_model(self.model_label)
+
+    def close(self):
+        """
+        Unmaps the file. The snapshot can't be queried afterwards.
+        """
+        for view in getattr(self, "_views", ()):
+            view.release()
+        self._views = []
+        self._mmap.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def __len__(self):
+        return self.count
+
+    def __contains__(self, pk):
+        position = bisect_left(self.sorted_pks, pk)
+        return position < self.count and self.sorted_pks[position] == pk
+
+    def is_stale(self):
+        """
+        Returns ``True`` if the tree has changed (or been deleted) since the snapshot was written.
+        """
+        return self.model.objects.get_tree_version(self.tree_id) != self.version
+
+    def subtree_end(self, position):
+        # the position just past the last descendant of the node at ``position``
+        return bisect_left(self.lefts, self.rights[position], position + 1)
+
+    def _locate(self, pk):
+        if pk not in self:
+            raise self.model.DoesNotExist("There is no node with pk %r in the snapshot." % (pk,))
+        return self, self.sorted_positions[bisect_left(self.sorted_pks, pk)]
+
+    def root(self):
+        """
+        Returns the pk of the root node of the tree.
+        """
+        return self.pks[0]
+
+
+def load_snapshot(model, tree_id, path):
+    """
+    Opens the snapshot of the tree with the given ``tree_id`` at ``path``, first (re)writing it
+    if it's missing, unreadable or stale.
+    """
+    try:
+        snapshot = TreeSnapshot(path)
+    except (IOError, OSError, ValueError, KeyError):
+        snapshot = None
+    if snapshot is not None:
+        if (snapshot.model_label == model._meta.label_lower and snapshot.tree_id == _tree_id_to_str(model, tree_id)
+                and not snapshot.is_stale()):
+            return snapshot
+        snapshot.close()
+    write_snapshot(model, tree_id, path)
+    return TreeSnapshot(path)
@@ -19,6 +19,10 @@ setup(
     install_requires=[
         'Django>=1.11',
     ],
+    extras_require={
+        'numpy': ['numpy'],
+        'async': ['asgiref'],
+    },
     python_requires=">=2.7, !=3.0.*, !=3.1.*, !=3.2.*, !=3.3.*",
     classifiers=[
         'Development Status :: 5 - Production/Stable',
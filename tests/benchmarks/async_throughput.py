@@ -0,0 +1,117 @@
+"""
+Benchmarks the throughput of concurrent async requests reading from a tree.
+
+Run from the ``tests`` directory, e.g.::
+
+    python benchmarks/async_throughput.py --rows 10000 --requests 2000 --concurrency 1 10 50 --latency 2
+
+Each simulated request picks a random node and reads its parent, ancestors and children,
+and walks its subtree. The requests are run ``--concurrency`` at a time on one event loop,
+once with every tree method wrapped in its own ``sync_to_async`` call, as views had to before,
+and once with the async counterparts from ``nested_intervals.aio``. ``--latency`` adds a delay
+to every query, like the round trip to a database server (SQLite has none, which leaves
+nothing for concurrent requests to overlap but the work done in Python).
+
+Needs Python 3.6+ and asgiref.
+"""
+from __future__ import print_function, unicode_literals
+import argparse
+import asyncio
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path[:0] = [os.path.join(os.path.dirname(__file__), ".."), os.path.join(os.path.dirname(__file__), "..", "..")]
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "myapp.settings")
+
+
+def wrapped_request(sync_to_async, node):
+    async def request():
+        await sync_to_async(lambda: node.parent)()
+        await sync_to_async(lambda: list(node.get_ancestors()))()
+        await sync_to_async(lambda: list(node.get_children()))()
+        await sync_to_async(lambda: list(node.iter_subtree(chunk_size=100)))()
+    return request()
+
+
+async def async_request(node):
+    from nested_intervals.aio import alist
+    await node.aget_parent()
+    await node.aget_ancestors()
+    await node.aget_children()
+    await alist(node.aiter_subtree(chunk_size=100))
+
+
+async def run(make_request, nodes, concurrency):
+    queue = list(nodes)
+
+    async def worker():
+        while queue:
+            await make_request(queue.pop())
+
+    await asyncio.gather(*[worker() for _ in range(concurrency)])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--rows", type=int, default=10000)
+    parser.add_argument("--fanout", type=int, default=20, help="How far back to look for a random parent.")
+    parser.add_argument("--requests", type=int, default=2000)
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 10, 50])
+    parser.add_argument("--latency", type=float, default=0, help="Milliseconds to add to every query.")
+    parser.add_argument("--database", default=None, help="SQLite database file to use (default: a temporary one).")
+    args = parser.parse_args()
+
+    from django.conf import settings
+    database = args.database or os.path.join(tempfile.mkdtemp(), "benchmark.sqlite3")
+    settings.DATABASES["default"]["NAME"] = database
+
+    import django
+    django.setup()
+    from asgiref.sync import sync_to_async
+    from django.core.management import call_command
+    from django.db import transaction
+    from myapp.models import LegacyNode
+
+    call_command("migrate", verbosity=0)
+    LegacyNode.objects.all().delete()
+
+    random.seed(0)
+    placeholder = "00000000-0000-0000-0000-000000000000"
+    with transaction.atomic():
+        LegacyNode.objects.bulk_create([
+            LegacyNode(
+                id=pk, legacy_parent_id=random.randint(max(1, pk - args.fanout), pk - 1) if pk > 1 else None,
+                name="node %d" % pk, left=0, right=0, level=0, tree_id=placeholder,
+            )
+            for pk in range(1, args.rows + 1)
+        ], batch_size=500)
+    LegacyNode.objects.rebuild_from_parent_field("legacy_parent")
+    nodes = list(LegacyNode.objects.all())
+    requests = [random.choice(nodes) for _ in range(args.requests)]
+
+    if args.latency:
+        from django.db.backends.utils import CursorWrapper
+        execute = CursorWrapper._execute
+
+        def slow_execute(self, *execute_args):
+            time.sleep(args.latency / 1000.0)
+            return execute(self, *execute_args)
+
+        CursorWrapper._execute = slow_execute
+
+    for concurrency in args.concurrency:
+        for label, make_request in (
+                ("sync_to_async per call", lambda node: wrapped_request(sync_to_async, node)),
+                ("async tree methods", async_request)):
+            start = time.time()
+            asyncio.run(run(make_request, requests, concurrency))
+            elapsed = time.time() - start
+            print("%-24s concurrency %4d: %.0f requests/s" % (label, concurrency, len(requests) / elapsed))
+    print("Database: %s" % database)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,79 @@
+"""
+Benchmarks the layout engine used for rebalancing, with and without NumPy.
+
+Run from the ``tests`` directory, e.g.::
+
+    python benchmarks/engine.py --nodes 100000 1000000
+
+For each size, a random tree is generated, and the integer layout positions and the decimal
+bounds are computed with each engine, alongside the previous node-by-node Decimal layout.
+"""
+from __future__ import print_function, unicode_literals
+import argparse
+import os
+import random
+import sys
+import time
+from decimal import Decimal
+
+sys.path[:0] = [os.path.join(os.path.dirname(__file__), ".."), os.path.join(os.path.dirname(__file__), "..", "..")]
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "myapp.settings")
+
+
+def random_levels(count, max_depth):
+    rng = random.Random(count)
+    levels = [0]
+    for _ in range(count - 1):
+        levels.append(rng.randint(1, min(levels[-1] + 1, max_depth)))
+    return levels
+
+
+def decimal_layout(levels, left, increment):
+    # the layout as it used to be computed, with Decimal arithmetic at every step
+    bounds = []
+    stack = []
+    position = left
+    for index, level in enumerate(levels):
+        while stack and levels[stack[-1]] >= level:
+            bounds[stack.pop()][1] = position
+            position += increment
+        bounds.append([position, None])
+        stack.append(index)
+        position += increment
+    while stack:
+        bounds[stack.pop()][1] = position
+        position += increment
+    return bounds
+
+
+def timed(function, *args):
+    start = time.time()
+    function(*args)
+    return time.time() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--nodes", type=int, nargs="+", default=[100000, 1000000])
+    parser.add_argument("--max-depth", type=int, default=12)
+    args = parser.parse_args()
+
+    import django
+    django.setup()
+    from nested_intervals import engine
+
+    for count in args.nodes:
+        levels = random_levels(count, args.max_depth)
+        increment = Decimal(1) / (2 * count - 1)
+        print("%d nodes (max depth %d):" % (count, args.max_depth))
+        print("  Decimal layout, node by node:  %.3fs" % timed(decimal_layout, levels, Decimal(0), increment))
+        print("  positions, pure Python:        %.3fs" % timed(engine._get_layout_positions_python, levels))
+        if engine.numpy is not None:
+            array = engine.numpy.array(levels, dtype="int64")
+            print("  positions, NumPy:              %.3fs" % timed(engine._get_layout_positions_numpy, array))
+        print("  bounds (positions + Decimals): %.3fs" % timed(
+            engine.get_evenly_spaced_bounds, levels, Decimal(0), increment))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,78 @@
+"""
+Benchmarks ``rebuild_from_parent_field`` on a synthetic adjacency list table.
+
+Run from the ``tests`` directory, e.g.::
+
+    python benchmarks/rebuild_from_parent_field.py --rows 1000000
+
+The table is created in a throwaway SQLite database (or the database given by ``--database``),
+filled with ``--rows`` nodes whose parents are picked at random from the nodes before them,
+spread across ``--trees`` trees, and then rebuilt.
+"""
+from __future__ import print_function, unicode_literals
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path[:0] = [os.path.join(os.path.dirname(__file__), ".."), os.path.join(os.path.dirname(__file__), "..", "..")]
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "myapp.settings")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--rows", type=int, default=1000000)
+    parser.add_argument("--trees", type=int, default=10)
+    parser.add_argument("--fanout", type=int, default=20, help="How far back to look for a random parent.")
+    parser.add_argument("--batch-size", type=int, default=None)
+    parser.add_argument("--database", default=None, help="SQLite database file to use (default: a temporary one).")
+    args = parser.parse_args()
+
+    from django.conf import settings
+    database = args.database or os.path.join(tempfile.mkdtemp(), "benchmark.sqlite3")
+    settings.DATABASES["default"]["NAME"] = database
+
+    import django
+    django.setup()
+    from django.core.management import call_command
+    from django.db import transaction
+    from myapp.models import LegacyNode
+
+    call_command("migrate", verbosity=0)
+    LegacyNode.objects.all().delete()
+
+    random.seed(0)
+    start = time.time()
+    placeholder = "00000000-0000-0000-0000-000000000000"
+    nodes = []
+    with transaction.atomic():
+        for pk in range(1, args.rows + 1):
+            if pk <= args.trees:
+                parent = None
+            else:
+                parent = random.randint(max(1, pk - args.fanout), pk - 1)
+            nodes.append(LegacyNode(
+                id=pk, legacy_parent_id=parent, name="node %d" % pk,
+                left=0, right=0, level=0, tree_id=placeholder,
+            ))
+            if len(nodes) == 10000:
+                LegacyNode.objects.bulk_create(nodes)
+                nodes = []
+        LegacyNode.objects.bulk_create(nodes)
+    print("Created %d rows in %.1fs" % (args.rows, time.time() - start))
+
+    kwargs = {}
+    if args.batch_size:
+        kwargs["batch_size"] = args.batch_size
+    start = time.time()
+    count = LegacyNode.objects.rebuild_from_parent_field("legacy_parent", **kwargs)
+    elapsed = time.time() - start
+    print("Rebuilt %d nodes in %d trees in %.1fs (%.0f nodes/s)" % (
+        count, LegacyNode.objects.root_nodes().count(), elapsed, count / elapsed))
+    print("Database: %s" % database)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,31 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('myapp', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='OnlineNode',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('left', models.DecimalField(decimal_places=30, max_digits=31)),
+                ('right', models.DecimalField(decimal_places=30, max_digits=31)),
+                ('level', models.PositiveIntegerField()),
+                ('tree_id', models.UUIDField()),
+                ('shadow_left', models.DecimalField(blank=True, decimal_places=30, editable=False, max_digits=31, null=True)),
+                ('shadow_right', models.DecimalField(blank=True, decimal_places=30, editable=False, max_digits=31, null=True)),
+                ('name', models.CharField(max_length=50)),
+            ],
+            options={
+                'ordering': ['left'],
+                'abstract': False,
+            },
+        ),
+    ]
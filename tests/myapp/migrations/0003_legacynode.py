@@ -0,0 +1,31 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('myapp', '0002_onlinenode'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='LegacyNode',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('left', models.DecimalField(decimal_places=30, max_digits=31)),
+                ('right', models.DecimalField(decimal_places=30, max_digits=31)),
+                ('level', models.PositiveIntegerField()),
+                ('tree_id', models.UUIDField()),
+                ('name', models.CharField(max_length=50)),
+                ('legacy_parent', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='myapp.LegacyNode')),
+            ],
+            options={
+                'ordering': ['left'],
+                'abstract': False,
+            },
+        ),
+    ]
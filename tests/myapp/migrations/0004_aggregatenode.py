@@ -0,0 +1,33 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import nested_intervals.fields
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('myapp', '0003_legacynode'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='AggregateNode',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('left', models.DecimalField(decimal_places=30, max_digits=31)),
+                ('right', models.DecimalField(decimal_places=30, max_digits=31)),
+                ('level', models.PositiveIntegerField()),
+                ('tree_id', models.UUIDField()),
+                ('name', models.CharField(max_length=50)),
+                ('items', models.PositiveIntegerField(default=0)),
+                ('descendant_count', nested_intervals.fields.DescendantCountField(default=0, editable=False)),
+                ('total_items', nested_intervals.fields.SubtreeSumField('items', default=0, editable=False)),
+            ],
+            options={
+                'ordering': ['left'],
+                'abstract': False,
+            },
+        ),
+    ]
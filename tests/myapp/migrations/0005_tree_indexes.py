@@ -0,0 +1,218 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('myapp', '0004_aggregatenode'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='aggregatenode',
+            index=models.Index(fields=['tree_id', 'left'], name='myapp_aggre_tree_id_7a096c_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='aggregatenode',
+            index=models.Index(fields=['tree_id', 'level', 'left'], name='myapp_aggre_tree_id_9e1ab7_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='aggregatenode',
+            index=models.Index(fields=['tree_id', 'right'], name='myapp_aggre_tree_id_464d67_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='autonowdatefieldmodel',
+            index=models.Index(fields=['tree_id', 'left'], name='myapp_auton_tree_id_07f243_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='autonowdatefieldmodel',
+            index=models.Index(fields=['tree_id', 'level', 'left'], name='myapp_auton_tree_id_9226c2_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='autonowdatefieldmodel',
+            index=models.Index(fields=['tree_id', 'right'], name='myapp_auton_tree_id_7c2f5d_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='book',
+            index=models.Index(fields=['tree_id', 'left'], name='myapp_book_tree_id_fd50f5_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='book',
+            index=models.Index(fields=['tree_id', 'level', 'left'], name='myapp_book_tree_id_3188e5_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='book',
+            index=models.Index(fields=['tree_id', 'right'], name='myapp_book_tree_id_3d7152_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='category',
+            index=models.Index(fields=['tree_id', 'left'], name='myapp_categ_tree_id_7dcee3_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='category',
+            index=models.Index(fields=['tree_id', 'level', 'left'], name='myapp_categ_tree_id_228455_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='category',
+            index=models.Index(fields=['tree_id', 'right'], name='myapp_categ_tree_id_719f10_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='concretemodel',
+            index=models.Index(fields=['tree_id', 'left'], name='myapp_concr_tree_id_2ac144_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='concretemodel',
+            index=models.Index(fields=['tree_id', 'level', 'left'], name='myapp_concr_tree_id_644931_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='concretemodel',
+            index=models.Index(fields=['tree_id', 'right'], name='myapp_concr_tree_id_176e9e_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='custompkname',
+            index=models.Index(fields=['tree_id', 'left'], name='myapp_custo_tree_id_775299_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='custompkname',
+            index=models.Index(fields=['tree_id', 'level', 'left'], name='myapp_custo_tree_id_689c2e_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='custompkname',
+            index=models.Index(fields=['tree_id', 'right'], name='myapp_custo_tree_id_ba0727_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='genre',
+            index=models.Index(fields=['tree_id', 'left'], name='myapp_genre_tree_id_4d92cf_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='genre',
+            index=models.Index(fields=['tree_id', 'level', 'left'], name='myapp_genre_tree_id_e8f131_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='genre',
+            index=models.Index(fields=['tree_id', 'right'], name='myapp_genre_tree_id_2e8408_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='insert',
+            index=models.Index(fields=['tree_id', 'left'], name='myapp_inser_tree_id_3d3418_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='insert',
+            index=models.Index(fields=['tree_id', 'level', 'left'], name='myapp_inser_tree_id_f270f9_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='insert',
+            index=models.Index(fields=['tree_id', 'right'], name='myapp_inser_tree_id_cb27a7_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='legacynode',
+            index=models.Index(fields=['tree_id', 'left'], name='myapp_legac_tree_id_774bb7_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='legacynode',
+            index=models.Index(fields=['tree_id', 'level', 'left'], name='myapp_legac_tree_id_9a4b1c_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='legacynode',
+            index=models.Index(fields=['tree_id', 'right'], name='myapp_legac_tree_id_0adb25_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='multiorder',
+            index=models.Index(fields=['tree_id', 'left'], name='myapp_multi_tree_id_e9be94_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='multiorder',
+            index=models.Index(fields=['tree_id', 'level', 'left'], name='myapp_multi_tree_id_ca52e9_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='multiorder',
+            index=models.Index(fields=['tree_id', 'right'], name='myapp_multi_tree_id_cc19a3_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='multiplemanagermodel',
+            index=models.Index(fields=['tree_id', 'left'], name='myapp_multi_tree_id_9f40be_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='multiplemanagermodel',
+            index=models.Index(fields=['tree_id', 'level', 'left'], name='myapp_multi_tree_id_568a24_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='multiplemanagermodel',
+            index=models.Index(fields=['tree_id', 'right'], name='myapp_multi_tree_id_cfe5ae_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='multitableinheritancea1',
+            index=models.Index(fields=['tree_id', 'left'], name='myapp_multi_tree_id_eaca93_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='multitableinheritancea1',
+            index=models.Index(fields=['tree_id', 'level', 'left'], name='myapp_multi_tree_id_7e107d_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='multitableinheritancea1',
+            index=models.Index(fields=['tree_id', 'right'], name='myapp_multi_tree_id_b0fea9_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='multitableinheritanceb1',
+            index=models.Index(fields=['tree_id', 'left'], name='myapp_multi_tree_id_089b23_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='multitableinheritanceb1',
+            index=models.Index(fields=['tree_id', 'level', 'left'], name='myapp_multi_tree_id_688554_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='multitableinheritanceb1',
+            index=models.Index(fields=['tree_id', 'right'], name='myapp_multi_tree_id_7a8389_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='onlinenode',
+            index=models.Index(fields=['tree_id', 'left'], name='myapp_onlin_tree_id_dfba7e_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='onlinenode',
+            index=models.Index(fields=['tree_id', 'level', 'left'], name='myapp_onlin_tree_id_6339f9_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='onlinenode',
+            index=models.Index(fields=['tree_id', 'right'], name='myapp_onlin_tree_id_22de30_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='person',
+            index=models.Index(fields=['tree_id', 'left'], name='myapp_perso_tree_id_acc956_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='person',
+            index=models.Index(fields=['tree_id', 'level', 'left'], name='myapp_perso_tree_id_42fbf2_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='person',
+            index=models.Index(fields=['tree_id', 'right'], name='myapp_perso_tree_id_c41c9c_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='tree',
+            index=models.Index(fields=['tree_id', 'left'], name='myapp_tree_tree_id_ca80b1_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='tree',
+            index=models.Index(fields=['tree_id', 'level', 'left'], name='myapp_tree_tree_id_c6eedd_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='tree',
+            index=models.Index(fields=['tree_id', 'right'], name='myapp_tree_tree_id_f1811d_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='uuidnode',
+            index=models.Index(fields=['tree_id', 'left'], name='myapp_uuidn_tree_id_3236f4_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='uuidnode',
+            index=models.Index(fields=['tree_id', 'level', 'left'], name='myapp_uuidn_tree_id_fd0664_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='uuidnode',
+            index=models.Index(fields=['tree_id', 'right'], name='myapp_uuidn_tree_id_a5e028_idx'),
+        ),
+    ]
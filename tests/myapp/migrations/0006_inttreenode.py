@@ -0,0 +1,41 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('myapp', '0005_tree_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='IntTreeNode',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('left', models.DecimalField(decimal_places=30, max_digits=31)),
+                ('right', models.DecimalField(decimal_places=30, max_digits=31)),
+                ('level', models.PositiveIntegerField()),
+                ('tree_id', models.BigIntegerField()),
+                ('name', models.CharField(max_length=50)),
+            ],
+            options={
+                'ordering': ['left'],
+                'abstract': False,
+            },
+        ),
+        migrations.AddIndex(
+            model_name='inttreenode',
+            index=models.Index(fields=['tree_id', 'left'], name='myapp_inttr_tree_id_18714d_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='inttreenode',
+            index=models.Index(fields=['tree_id', 'level', 'left'], name='myapp_inttr_tree_id_6be687_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='inttreenode',
+            index=models.Index(fields=['tree_id', 'right'], name='myapp_inttr_tree_id_fe260f_idx'),
+        ),
+    ]
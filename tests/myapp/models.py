@@ -4,7 +4,8 @@ from django.utils.encoding import python_2_unicode_compatible
 from uuid import uuid4
 
 import nested_intervals
-from nested_intervals.models import NestedIntervalsModel
+from nested_intervals.fields import DescendantCountField, SubtreeSumField
+from nested_intervals.models import NestedIntervalsModel, OnlineRebalanceMixin
 from nested_intervals.managers import NestedIntervalsManager
 from django.db.models.query import QuerySet
 
@@ -217,3 +218,42 @@ class Book(NestedIntervalsModel):
         Category, null=True, blank=True, related_name='books_fk',
         on_delete=models.CASCADE)
     m2m = models.ManyToManyField(Category, blank=True, related_name='books_m2m')
+
+
+@python_2_unicode_compatible
+class OnlineNode(NestedIntervalsModel, OnlineRebalanceMixin):
+    name = models.CharField(max_length=50)
+
+    def __str__(self):
+        return self.name
+
+
+@python_2_unicode_compatible
+class LegacyNode(NestedIntervalsModel):
+    # the adjacency list column of a table being converted to nested intervals
+    legacy_parent = models.ForeignKey(
+        'self', null=True, blank=True, related_name='+', on_delete=models.SET_NULL)
+    name = models.CharField(max_length=50)
+
+    def __str__(self):
+        return self.name
+
+
+@python_2_unicode_compatible
+class AggregateNode(NestedIntervalsModel):
+    name = models.CharField(max_length=50)
+    items = models.PositiveIntegerField(default=0)
+    descendant_count = DescendantCountField()
+    total_items = SubtreeSumField("items")
+
+    def __str__(self):
+        return self.name
+
+
+@python_2_unicode_compatible
+class IntTreeNode(NestedIntervalsModel):
+    tree_id = models.BigIntegerField()
+    name = models.CharField(max_length=50)
+
+    def __str__(self):
+        return self.name
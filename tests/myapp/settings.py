@@ -10,7 +10,16 @@ DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
         'NAME': 'db.sqlite3'
-    }
+    },
+    # for the tests of spreading trees across databases
+    'shard1': {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': 'shard1.sqlite3'
+    },
+    'shard2': {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': 'shard2.sqlite3'
+    },
 }
 
 INSTALLED_APPS = (
@@ -1,6 +1,7 @@
 # -*- coding: utf-8 -*-
 from __future__ import unicode_literals
 
+import datetime
 import io
 import mock
 import os
@@ -8,28 +9,56 @@ import re
 import string
 import sys
 import tempfile
+import time
 import unittest
+from array import array
+from contextlib import contextmanager
+from multiprocessing.pool import ThreadPool
 
 
 from django.contrib.auth.models import Group, User
-from django.db.models import Q
+from django.core.management import call_command
+from django.conf import settings
+from django.db import connection, models, router, transaction
+from django.db.models import F, Q, Value
+from django.db.models.functions import Concat
 from django.db.models.query_utils import DeferredAttribute
 from django.apps import apps
 from django.template import Template, TemplateSyntaxError, Context
 from django.test import RequestFactory, TestCase, TransactionTestCase
+from django.test.utils import CaptureQueriesContext, isolate_apps
+from django.utils import timezone
 from django.utils.six import string_types, PY3, b, assertRaisesRegex
 from django.contrib.admin.views.main import ChangeList
 from django.contrib.admin import ModelAdmin, site
 
-from nested_intervals.exceptions import InvalidMove
-from nested_intervals.models import NestedIntervalsModel
+from nested_intervals import cache, engine, managers, routers
+from nested_intervals.exceptions import IntervalTooSmall, InvalidMove, RebalanceConflict
+from nested_intervals.models import NestedIntervalsModel, PendingRebalance, TreeIdCounter, TreeVersion
+from nested_intervals.index import TreeIndex
+from nested_intervals.lookups import Ancestors, Descendants
 from nested_intervals.managers import NestedIntervalsManager
+from nested_intervals.querysets import prefetch_ancestors, prefetch_descendants
+from nested_intervals.rebalancing import (
+    DatabaseQueueRebalanceExecutor, ThreadPoolRebalanceExecutor, schedule_rebalance,
+)
+from nested_intervals.routers import TreeReplicaRouter, TreeShardRouter
+from nested_intervals.serialization import export_tree, import_tree
+from nested_intervals.signals import tree_changed
+from nested_intervals.snapshots import TreeSnapshot, load_snapshot, write_snapshot
+
+try:
+    import asyncio
+    from asgiref.sync import async_to_sync, sync_to_async
+    from nested_intervals import aio
+except (ImportError, SyntaxError):
+    aio = None
 
 from myapp.models import (
     Category, Item, Genre, CustomPKName, SingleProxyModel, DoubleProxyModel,
     ConcreteModel, AutoNowDateFieldModel, Person,
     CustomTreeQueryset, CustomNestedIntervalsManager, Book, UUIDNode, Student,
-    MultipleManagerModel)
+    MultipleManagerModel, OnlineNode, LegacyNode, AggregateNode, IntTreeNode)
 
 def print_tree(node, indent=0):
     print("{indent}{name} ({left}, {right})".format(indent="\t"*indent, name=getattr(node, "name", node.id), left=node.left, right=node.right))
@@ -63,6 +92,31 @@ def tree_details(text):
     return leading_whitespace_re.sub('', text.rstrip())
 
 
+@contextmanager
+def pretend_intervals_too_small(times=1):
+    """
+    SQLite can't store intervals tight enough to run out of room, so pretend the next ``times``
+    insertions did.
+    """
+    real_get_interval = managers.get_interval_for_insertion_relative_to
+    results = [IntervalTooSmall() for _ in range(times)]
+
+    def get_interval(*args, **kwargs):
+        if results:
+            raise results.pop()
+        return real_get_interval(*args, **kwargs)
+
+    with mock.patch("nested_intervals.managers.get_interval_for_insertion_relative_to", get_interval):
+        yield
+
+
+def array_without_q(typecode, *args):
+    # like array(), on Python 2, which has no "q" arrays
+    if typecode == "q":
+        raise ValueError("bad typecode (must be c, b, B, u, h, H, i, I, l, L, f or d)")
+    return array(typecode, *args)
+
+
 class TreeTestCase(TransactionTestCase):
 
     def assertTreeEqual(self, tree1, tree2):
@@ -802,3 +856,1317 @@ class DirectParentAssignment(TreeTestCase):
         n2 = Category.objects.create()
         n1.parent_id = n2.id
         n1.save()
+
+
+class RebalanceTestCase(TreeTestCase):
+    fixtures = ['genres.json']
+
+    def _crowd(self):
+        # leave no room at all between "Platformer" and "Shootemup"
+        platformer = Genre.objects.get(id=2)
+        Genre.objects.filter(id=6).update(left=platformer.right)
+        return platformer
+
+    def _assert_evenly_spaced(self):
+        # the fixture is evenly spaced, with 8 nodes in the first tree
+        self.assertAlmostEqual(float(Genre.objects.get(id=6).left), 9 / 15.0)
+
+    @mock.patch("nested_intervals.managers.schedule_rebalance")
+    @mock.patch("nested_intervals.managers.DEFERRED_REBALANCE", True)
+    def test_deferred_rebalance_respaces_locally(self, schedule_mock):
+        platformer = Genre.objects.get(id=2)
+        rpg_bounds = list(Genre.objects.filter(tree_id=Genre.objects.get(id=9).tree_id).values_list("left", "right"))
+
+        with mock.patch.object(NestedIntervalsManager, "rebalance_tree") as rebalance_mock, \
+                pretend_intervals_too_small():
+            beat_em_up = Genre(name="Beat 'em up")
+            beat_em_up.insert_at(platformer, "right", save=True)
+            self.assertFalse(rebalance_mock.called)
+
+        schedule_mock.assert_called_once_with(Genre, platformer.tree_id)
+        self.assertTreeEqual(Genre.objects.all(), """
+            1 - 0
+            2 1 1
+            3 2 2
+            4 2 2
+            5 2 2
+            12 1 1
+            6 1 1
+            7 6 2
+            8 6 2
+            9 - 0
+            10 9 1
+            11 9 1
+        """)
+        # the subtree under "Action" was evenly spaced again before inserting
+        self.assertAlmostEqual(float(Genre.objects.get(id=12).left), 8 / 15.0 + 1 / 45.0)
+        # and the other tree wasn't touched
+        self.assertEqual(
+            list(Genre.objects.filter(tree_id=Genre.objects.get(id=9).tree_id).values_list("left", "right")),
+            rpg_bounds)
+
+    def test_database_queue_executor(self):
+        platformer = self._crowd()
+        DatabaseQueueRebalanceExecutor().submit(Genre, platformer.tree_id)
+        DatabaseQueueRebalanceExecutor().submit(Genre, platformer.tree_id)
+        self.assertEqual(PendingRebalance.objects.count(), 1)
+
+        call_command("process_rebalance_queue", stdout=io.StringIO())
+
+        self.assertEqual(PendingRebalance.objects.count(), 0)
+        self._assert_evenly_spaced()
+
+    def test_thread_pool_executor(self):
+        platformer = self._crowd()
+        executor = ThreadPoolRebalanceExecutor()
+        executor.submit(Genre, platformer.tree_id)
+        executor.join()
+        self._assert_evenly_spaced()
+
+    def test_rebalance_trees_below_headroom(self):
+        platformer = self._crowd()
+        rpg = Genre.objects.get(id=9)
+        self.assertEqual(Genre.objects.get_tree_headroom(platformer.tree_id), 0)
+        self.assertEqual(Genre.objects.get_tree_headroom(rpg.tree_id), 29)
+
+        results = Genre.objects.rebalance_trees(workers=2, min_headroom=10)
+
+        self.assertEqual(
+            [(result.tree_id, result.rebalanced, result.rows) for result in results],
+            [(platformer.tree_id, True, 8), (rpg.tree_id, False, 0)])
+        self._assert_evenly_spaced()
+
+    def test_rebalance_trees_dry_run_in_pool(self):
+        platformer = self._crowd()
+        rpg = Genre.objects.get(id=9)
+
+        with mock.patch("nested_intervals.rebalancing.ThreadPool", wraps=ThreadPool) as pool_mock:
+            results = Genre.objects.rebalance_trees([platformer.tree_id, rpg.tree_id], workers=2, min_headroom=10, dry_run=True)
+
+        # (only reading, so spread across the workers even on SQLite)
+        pool_mock.assert_called_once_with(2)
+        self.assertEqual(
+            [(result.tree_id, result.headroom, result.rebalanced, result.rows) for result in results],
+            [(platformer.tree_id, 0, True, 8), (rpg.tree_id, 29, False, 0)])
+        self.assertEqual(Genre.objects.get_tree_headroom(platformer.tree_id), 0)
+
+    def test_rebalance_trees_command_dry_run(self):
+        self._crowd()
+        out = io.StringIO()
+
+        call_command("rebalance_trees", "myapp.Genre", "--dry-run", "--min-headroom=10", stdout=out)
+
+        self.assertIn("would rebalance\trows=8", out.getvalue())
+        self.assertIn("1 of 2 tree(s) would rebalance, 8 row(s)", out.getvalue())
+        self.assertEqual(Genre.objects.get_tree_headroom(Genre.objects.get(id=1).tree_id), 0)
+
+
+class OnlineRebalanceTestCase(TreeTestCase):
+
+    def setUp(self):
+        self.root = OnlineNode.objects.create(name="root")
+        a = OnlineNode.objects.create(name="a", parent=self.root)
+        OnlineNode.objects.create(name="a1", parent=a)
+        OnlineNode.objects.create(name="a2", parent=a)
+        OnlineNode.objects.create(name="b", parent=self.root)
+        self.tree = get_tree_details(OnlineNode.objects.all())
+
+    def test_rebalance_tree_online(self):
+        count = OnlineNode.objects.rebalance_tree_online(self.root.tree_id, batch_size=2)
+
+        self.assertEqual(count, 5)
+        self.assertTreeEqual(OnlineNode.objects.all(), self.tree)
+        self.assertEqual(
+            [(round(node.left * 9, 6), round(node.right * 9, 6)) for node in OnlineNode.objects.all()],
+            [(0, 9), (1, 6), (2, 3), (4, 5), (7, 8)])
+        self.assertFalse(OnlineNode.objects.filter(shadow_left__isnull=False).exists())
+
+    def test_rebalance_tree_online_retries_after_changes(self):
+        write_shadow_intervals = OnlineNode.objects._write_shadow_intervals
+        writes = []
+
+        def write_and_change_tree(tree_id, batch_size):
+            write_shadow_intervals(tree_id, batch_size)
+            writes.append(tree_id)
+            if len(writes) == 1:
+                # a node gets added in the middle of the first pass
+                OnlineNode.objects.create(name="c", parent=self.root)
+
+        with mock.patch.object(OnlineNode.objects, "_write_shadow_intervals", write_and_change_tree):
+            self.assertEqual(OnlineNode.objects.rebalance_tree_online(self.root.tree_id, batch_size=2), 6)
+        self.assertEqual(len(writes), 2)
+
+        with mock.patch.object(OnlineNode.objects, "_swap_shadow_intervals", return_value=None):
+            with self.assertRaises(RebalanceConflict):
+                OnlineNode.objects.rebalance_tree_online(self.root.tree_id)
+
+    def test_swap_skips_nodes_without_shadow_intervals(self):
+        OnlineNode.objects._write_shadow_intervals(self.root.tree_id, 2)
+        OnlineNode.objects.create(name="c", parent=self.root)
+
+        self.assertIsNone(OnlineNode.objects._swap_shadow_intervals(self.root.tree_id))
+        # the swap is rolled back whole, and the new node keeps its interval
+        self.assertFalse(OnlineNode.objects.filter(left__isnull=True).exists())
+        self.assertEqual(OnlineNode.objects.filter(shadow_left__isnull=False).count(), 5)
+        self.assertTreeEqual(OnlineNode.objects.all(), self.tree + "\n%d %d 1" % (OnlineNode.objects.get(name="c").pk, self.root.pk))
+
+
+class IterSubtreeTestCase(TreeTestCase):
+    fixtures = ['genres.json']
+
+    def test_iter_subtree(self):
+        action = Genre.objects.get(id=1)
+        for chunk_size in (1, 3, 1000):
+            self.assertEqual(
+                [(node.pk, depth, parent_pk) for node, depth, parent_pk in action.iter_subtree(chunk_size=chunk_size)],
+                [(1, 0, None), (2, 1, 1), (3, 2, 2), (4, 2, 2), (5, 2, 2), (6, 1, 1), (7, 2, 6), (8, 2, 6)])
+
+        shmup = Genre.objects.get(id=6)
+        with self.assertNumQueries(2):
+            self.assertEqual(
+                [(node.pk, depth, parent_pk) for node, depth, parent_pk in shmup.iter_subtree(chunk_size=2)],
+                [(6, 0, None), (7, 1, 6), (8, 1, 6)])
+
+    def test_chunks_with_tied_left_values(self):
+        # e.g. rounded by SQLite: ties are broken by level and then pk
+        Genre.objects.filter(pk__in=[3, 4, 5]).update(left=Genre.objects.get(id=3).left)
+        for fields in ((), ("right",)):
+            chunks = Genre.objects._iter_chunks_in_tree_order(Genre.objects.filter(pk__in=[3, 4, 5]), 1, *fields)
+            self.assertEqual([chunk[0][0] if fields else chunk[0].pk for chunk in chunks], [3, 4, 5])
+
+
+class TreeExportTestCase(TreeTestCase):
+    fixtures = ['categories.json']
+
+    def _get_names_and_levels(self, root):
+        return [(node.name, node.level) for node in root.get_descendants(include_self=True)]
+
+    def test_export_and_import_tree(self):
+        root = Category.objects.get(id=1)
+        expected = self._get_names_and_levels(root)
+        stream = io.StringIO()
+
+        self.assertEqual(export_tree(Category, root.tree_id, stream), 10)
+        root.delete()
+        stream.seek(0)
+        new_root = import_tree(Category, stream, batch_size=3)
+
+        self.assertNotEqual(new_root.tree_id, root.tree_id)
+        self.assertEqual(self._get_names_and_levels(new_root), expected)
+        # the nodes are evenly spaced, with 10 nodes
+        self.assertEqual(
+            [(round(node.left * 19, 6), round(node.right * 19, 6)) for node in new_root.get_children()],
+            [(1, 6), (7, 12), (13, 18)])
+
+    def test_export_and_import_tree_commands(self):
+        root = Category.objects.get(id=1)
+        expected = self._get_names_and_levels(root)
+
+        with tempfile.NamedTemporaryFile(suffix=".jsonl") as temp:
+            call_command("export_tree", "myapp.Category", str(root.tree_id), output=temp.name)
+            root.delete()
+            call_command("import_tree", "myapp.Category", input=temp.name, stdout=io.StringIO())
+
+        self.assertEqual(self._get_names_and_levels(Category.objects.root_nodes().get()), expected)
+
+    def test_import_tree_with_bad_depths(self):
+        stream = io.StringIO('{"nodes": 2}\n{"depth": 0, "fields": {}}\n{"depth": 2, "fields": {}}\n')
+        with self.assertRaises(ValueError):
+            import_tree(Category, stream)
+        self.assertFalse(Category.objects.filter(level=0).exclude(id=1).exists())
+
+
+class RebuildFromParentFieldTestCase(TreeTestCase):
+
+    def _create_legacy_nodes(self, parents):
+        # from (name, parent name) pairs; as far as the nested intervals fields go, each of
+        # the nodes starts out as a separate tree
+        nodes = {}
+        for name, parent in parents:
+            nodes[name] = LegacyNode.objects.create(name=name, legacy_parent=nodes.get(parent))
+        return nodes
+
+    def _get_tree(self, root):
+        return [(node.name, node.level, node.parent.name if node.parent else None)
+                for node in root.get_descendants(include_self=True)]
+
+    def test_rebuild_from_parent_field(self):
+        self._create_legacy_nodes([
+            ("a", None), ("a1", "a"), ("a2", "a"), ("a1x", "a1"), ("a1y", "a1"), ("b", None), ("b1", "b"),
+        ])
+
+        self.assertEqual(LegacyNode.objects.rebuild_from_parent_field("legacy_parent", batch_size=2), 7)
+
+        a, b = LegacyNode.objects.root_nodes().order_by("name")
+        self.assertNotEqual(a.tree_id, b.tree_id)
+        self.assertEqual(self._get_tree(a), [
+            ("a", 0, None), ("a1", 1, "a"), ("a1x", 2, "a1"), ("a1y", 2, "a1"), ("a2", 1, "a"),
+        ])
+        self.assertEqual(self._get_tree(b), [("b", 0, None), ("b1", 1, "b")])
+        # evenly spaced, with 5 nodes in the tree
+        self.assertEqual(
+            [(round(node.left * 9, 6), round(node.right * 9, 6)) for node in a.get_descendants(include_self=True)],
+            [(0, 9), (1, 6), (2, 3), (4, 5), (7, 8)])
+
+        # and the rebuilt trees can be used as normal
+        LegacyNode.objects.create(name="a3", parent=a, legacy_parent=a)
+        self.assertEqual([node.name for node in a.get_children()], ["a1", "a2", "a3"])
+
+    def test_rebuild_orders_siblings(self):
+        self._create_legacy_nodes([("root", None), ("z", "root"), ("y", "root")])
+
+        call_command("rebuild_from_parent_field", "myapp.LegacyNode", "legacy_parent", order_by=["name"], stdout=io.StringIO())
+
+        root = LegacyNode.objects.root_nodes().get()
+        self.assertEqual([node.name for node in root.get_children()], ["y", "z"])
+
+    def test_rebuild_with_cycle(self):
+        nodes = self._create_legacy_nodes([("root", None), ("x", None), ("y", "x")])
+        LegacyNode.objects.filter(pk=nodes["x"].pk).update(legacy_parent=nodes["y"])
+
+        with self.assertRaises(ValueError):
+            LegacyNode.objects.rebuild_from_parent_field("legacy_parent")
+        # nothing was written
+        self.assertEqual(LegacyNode.objects.get(pk=nodes["root"].pk).tree_id, nodes["root"].tree_id)
+
+
+class TreeIndexTestCase(TreeTestCase):
+    fixtures = ['genres.json']
+
+    def assertIndexMatchesDatabase(self, index):
+        pks = lambda queryset: [node.pk for node in queryset]
+        nodes = list(Genre.objects.all())
+        self.assertEqual(len(index), len(nodes))
+        for node in nodes:
+            self.assertEqual(index.descendants(node.pk), pks(node.get_descendants()))
+            self.assertEqual(index.descendant_count(node.pk), node.get_descendant_count())
+            self.assertEqual(index.ancestors(node.pk), pks(node.get_ancestors()))
+            self.assertEqual(index.ancestors(node.pk, ascending=True, include_self=True),
+                             pks(node.get_ancestors(ascending=True, include_self=True)))
+            self.assertEqual(index.children(node.pk), pks(node.get_children()))
+            self.assertEqual(index.parent(node.pk), node.parent.pk if node.parent else None)
+            self.assertEqual(index.level(node.pk), node.level)
+            for other in nodes:
+                self.assertEqual(index.is_descendant_of(node.pk, other.pk), node.is_descendant_of(other))
+
+    def test_tree_index(self):
+        with self.assertNumQueries(3):
+            index = TreeIndex(Genre)
+        self.assertIndexMatchesDatabase(index)
+        self.assertEqual(index.root(Genre.objects.get(id=5).tree_id), 1)
+        self.assertTrue(index.is_descendant_of(5, 5, include_self=True))
+        self.assertTrue(index.is_ancestor_of(1, 5))
+        with self.assertRaises(Genre.DoesNotExist):
+            index.parent(100)
+        self.assertIn(5, index)
+        self.assertNotIn(100, index)
+        self.assertNotIn("5", index)
+        self.assertEqual(index.tree_id(5), Genre.objects.get(id=5).tree_id)
+
+    def test_tree_index_without_q_arrays(self):
+        with mock.patch("nested_intervals.index.array", array_without_q):
+            index = TreeIndex(Genre)
+        self.assertIndexMatchesDatabase(index)
+
+    def test_tree_index_refresh(self):
+        index = TreeIndex(Genre)
+        action, rpg = Genre.objects.get(id=1), Genre.objects.get(id=9)
+
+        # nothing has changed
+        with self.assertNumQueries(2):
+            self.assertEqual(index.refresh(), [])
+
+        Genre.objects.get(id=6).move_to(Genre.objects.get(id=2))
+        self.assertEqual(index.refresh(), [action.tree_id])
+        self.assertIndexMatchesDatabase(index)
+
+        Genre.objects.create(name="Roguelike", parent=rpg)
+        self.assertTrue(index.refresh_tree(rpg.tree_id))
+        self.assertFalse(index.refresh_tree(action.tree_id))
+        self.assertIndexMatchesDatabase(index)
+
+        rpg.delete()
+        self.assertEqual(index.refresh(), [])
+        self.assertEqual(index.get_tree_ids(), [action.tree_id])
+        self.assertIndexMatchesDatabase(index)
+
+
+class TreeSnapshotTestCase(TreeTestCase):
+    fixtures = ['genres.json']
+
+    def setUp(self):
+        self.path = os.path.join(tempfile.mkdtemp(), "genres.tree")
+        self.addCleanup(lambda: os.path.exists(self.path) and os.remove(self.path))
+
+    def test_snapshot(self):
+        action = Genre.objects.get(id=1)
+        write_snapshot(Genre, action.tree_id, self.path)
+
+        with TreeSnapshot(self.path) as snapshot:
+            self.assertEqual(len(snapshot), 8)
+            self.assertEqual(snapshot.root(), 1)
+            self.assertFalse(snapshot.is_stale())
+            for node in action.get_descendants(include_self=True):
+                self.assertEqual(snapshot.descendants(node.pk), [n.pk for n in node.get_descendants()])
+                self.assertEqual(snapshot.ancestors(node.pk), [n.pk for n in node.get_ancestors()])
+                self.assertEqual(snapshot.children(node.pk), [n.pk for n in node.get_children()])
+                self.assertEqual(snapshot.parent(node.pk), node.parent.pk if node.parent else None)
+                self.assertEqual(snapshot.level(node.pk), node.level)
+            self.assertTrue(snapshot.is_descendant_of(7, 6))
+            self.assertFalse(snapshot.is_descendant_of(6, 7))
+            self.assertNotIn(9, snapshot)
+            with self.assertRaises(Genre.DoesNotExist):
+                snapshot.parent(9)
+
+    def test_snapshot_without_q_arrays(self):
+        action = Genre.objects.get(id=1)
+        write_snapshot(Genre, action.tree_id, self.path)
+        with open(self.path, "rb") as f:
+            expected = f.read()
+        os.remove(self.path)
+
+        for narrow_longs in (False, True):
+            def array_without_q_or_wide_longs(typecode, *args):
+                # (with "l" arrays too narrow to write, on some platforms)
+                if typecode == "l" and narrow_longs:
+                    return array(str("i"), *args)
+                return array_without_q(typecode, *args)
+
+            with mock.patch("nested_intervals.index.array", array_without_q_or_wide_longs):
+                write_snapshot(Genre, action.tree_id, self.path)
+            with open(self.path, "rb") as f:
+                self.assertEqual(f.read(), expected)
+
+    def test_stale_snapshot_is_rewritten(self):
+        action = Genre.objects.get(id=1)
+        snapshot = load_snapshot(Genre, action.tree_id, self.path)
+        self.assertEqual(snapshot.children(1), [2, 6])
+        snapshot.close()
+
+        Genre.objects.get(id=6).move_to(Genre.objects.get(id=2))
+        with TreeSnapshot(self.path) as snapshot:
+            self.assertTrue(snapshot.is_stale())
+
+        with load_snapshot(Genre, action.tree_id, self.path) as snapshot:
+            self.assertFalse(snapshot.is_stale())
+            self.assertEqual(snapshot.children(1), [2])
+            self.assertEqual(snapshot.parent(6), 2)
+
+
+class VectorizedLayoutTestCase(TreeTestCase):
+
+    def _random_levels(self, count):
+        import random
+        rng = random.Random(count)
+        levels = [0]
+        for _ in range(count - 1):
+            levels.append(rng.randint(1, levels[-1] + 1))
+        return levels
+
+    def _to_lists(self, positions):
+        return [list(getattr(p, "tolist", lambda: p)()) for p in positions]
+
+    def test_layout_positions(self):
+        # 0 (1 (2, 3), 4 (5))
+        levels = [0, 1, 2, 2, 1, 2]
+        expected = [[0, 1, 2, 4, 7, 8], [11, 6, 3, 5, 10, 9]]
+        self.assertEqual(self._to_lists(engine._get_layout_positions_python(levels)), expected)
+        # runs of siblings (and their descendants) work as well
+        self.assertEqual(
+            self._to_lists(engine._get_layout_positions_python([3, 4, 3])), [[0, 1, 4], [3, 2, 5]])
+
+    @unittest.skipUnless(engine.numpy is not None, "NumPy isn't installed")
+    def test_numpy_layout_matches_python_layout(self):
+        for levels in ([], [0], [0, 1, 2, 2, 1, 2], [3, 4, 3], self._random_levels(5000)):
+            self.assertEqual(
+                self._to_lists(engine._get_layout_positions_numpy(engine.numpy.array(levels, dtype="int64"))),
+                self._to_lists(engine._get_layout_positions_python(levels)))
+
+    def test_rebalance_tree_without_numpy(self):
+        with mock.patch.object(engine, "numpy", None):
+            root = Genre.objects.create(name="Root")
+            for name in ("A", "B"):
+                child = Genre.objects.create(name=name, parent=root)
+                Genre.objects.create(name=name + "1", parent=child)
+            self.assertEqual(Genre.objects.rebalance_tree(root.tree_id), 5)
+        self.assertEqual(
+            [(round(node.left * 9, 6), round(node.right * 9, 6)) for node in root.get_descendants(include_self=True)],
+            [(0, 9), (1, 4), (2, 3), (5, 8), (6, 7)])
+
+
+class TreeVersionTestCase(TreeTestCase):
+    fixtures = ['genres.json']
+
+    def setUp(self):
+        self.changes = []
+        receiver = lambda sender, tree_id, version, **kwargs: self.changes.append((sender, tree_id, version))
+        tree_changed.connect(receiver, weak=False)
+        self.addCleanup(tree_changed.disconnect, receiver)
+
+    def test_tree_version(self):
+        action, rpg = Genre.objects.get(id=1), Genre.objects.get(id=9)
+        self.assertEqual(Genre.objects.get_tree_version(action.tree_id), 0)
+
+        Genre.objects.create(name="Metroidvania", parent=Genre.objects.get(id=2))
+        self.assertEqual(Genre.objects.get_tree_version(action.tree_id), 1)
+        self.assertEqual(Genre.objects.get_tree_version(str(action.tree_id)), 1)
+        self.assertEqual(self.changes, [(Genre, action.tree_id, 1)])
+
+        # moving between trees changes both of them
+        Genre.objects.get(id=6).move_to(rpg)
+        self.assertEqual(Genre.objects.get_tree_versions([action.tree_id, rpg.tree_id]),
+                         {action.tree_id: 2, rpg.tree_id: 1})
+
+        Genre.objects.rebalance_tree(rpg.tree_id)
+        Genre.objects.get(id=11).delete()
+        self.assertEqual(Genre.objects.get_tree_version(rpg.tree_id), 3)
+        # other models' trees are versioned separately
+        self.assertEqual(Category.objects.get_tree_version(rpg.tree_id), 0)
+
+    def test_tree_changed_is_sent_on_commit(self):
+        action = Genre.objects.get(id=1)
+        with transaction.atomic():
+            Genre.objects.get(id=8).move_to(Genre.objects.get(id=2))
+            self.assertEqual(self.changes, [])
+        self.assertEqual(self.changes, [(Genre, action.tree_id, 1)])
+
+        try:
+            with transaction.atomic():
+                Genre.objects.create(name="Metroidvania", parent=action)
+                raise ValueError
+        except ValueError:
+            pass
+        self.assertEqual(Genre.objects.get_tree_version(action.tree_id), 1)
+        self.assertEqual(len(self.changes), 1)
+
+    def test_proxy_models_share_tree_versions(self):
+        fruit = ConcreteModel.objects.create(name="Fruit")
+        tree_cache = cache.TreeCache(alias="default")
+        with mock.patch.object(cache, "_tree_cache", tree_cache):
+            self.assertEqual(fruit.get_cached_descendants(), [])
+
+            SingleProxyModel.objects.create(name="Apple", parent=SingleProxyModel.objects.get(pk=fruit.pk))
+            self.assertEqual(ConcreteModel.objects.get_tree_version(fruit.tree_id), 2)
+            self.assertEqual(DoubleProxyModel.objects.get_tree_version(fruit.tree_id), 2)
+            self.assertEqual([node.name for node in fruit.get_cached_descendants()], ["Apple"])
+
+
+class TreeCacheTestCase(TreeTestCase):
+    fixtures = ['genres.json']
+
+    def setUp(self):
+        cache.caches["default"].clear()
+        self.tree_cache = cache.TreeCache(alias="default", local_size=2, max_nodes=5)
+        patcher = mock.patch.object(cache, "_tree_cache", self.tree_cache)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_cached_ancestors_and_descendants(self):
+        platformer_3d = Genre.objects.get(id=4)
+        expected = list(platformer_3d.get_ancestors())
+
+        self.assertEqual(platformer_3d.get_cached_ancestors(), expected)
+        with self.assertNumQueries(0):
+            self.assertEqual(platformer_3d.get_cached_ancestors(), expected)
+            self.assertEqual([node.name for node in platformer_3d.get_cached_ancestors()], ["Action", "Platformer"])
+        self.assertEqual(self.tree_cache.stats, {"hits": 2, "local_hits": 2, "misses": 1})
+
+        # a change to the tree makes the old entries unreachable
+        Genre.objects.get(id=2).move_to(Genre.objects.get(id=6))
+        platformer_3d.refresh_from_db()
+        self.assertEqual(platformer_3d.get_cached_ancestors(ascending=True), list(platformer_3d.get_ancestors(ascending=True)))
+        self.assertEqual(self.tree_cache.stats["misses"], 2)
+
+    def test_local_tree_versions(self):
+        # without a shared cache, the versions of the trees are remembered for a while
+        tree_cache = cache.TreeCache(alias=None, version_timeout=10)
+        platformer_3d = Genre.objects.get(id=4)
+        with mock.patch.object(cache, "_tree_cache", tree_cache), mock.patch("time.time", return_value=1000) as time_mock:
+            platformer_3d.get_cached_ancestors()
+            with self.assertNumQueries(0):
+                for _ in range(3):
+                    self.assertEqual([node.name for node in platformer_3d.get_cached_ancestors()], ["Action", "Platformer"])
+
+            # changes made by this process are seen straight away
+            Genre.objects.get(id=2).move_to(Genre.objects.get(id=6))
+            platformer_3d.refresh_from_db()
+            self.assertEqual([node.name for node in platformer_3d.get_cached_ancestors()], ["Action", "Shootemup", "Platformer"])
+
+            # those made by other processes once the version is no longer trusted
+            Genre.objects.filter(id=2).update(name="Jump 'n' run")
+            TreeVersion.objects.filter(tree_id=str(platformer_3d.tree_id)).update(version=F("version") + 1)
+            self.assertEqual([node.name for node in platformer_3d.get_cached_ancestors()], ["Action", "Shootemup", "Platformer"])
+            time_mock.return_value = 1010
+            self.assertEqual([node.name for node in platformer_3d.get_cached_ancestors()], ["Action", "Shootemup", "Jump 'n' run"])
+
+    def test_cache_tiers_and_limits(self):
+        shmup, rpg, action = Genre.objects.get(id=6), Genre.objects.get(id=9), Genre.objects.get(id=1)
+        shmup.get_cached_descendants()
+        rpg.get_cached_descendants()
+        shmup.get_cached_descendants(include_self=True)
+        # evicted from the local tier, but still in the shared cache
+        self.assertEqual(shmup.get_cached_descendants(), list(shmup.get_descendants()))
+        self.assertEqual(self.tree_cache.stats, {"hits": 1, "local_hits": 0, "misses": 3})
+
+        # too big to be cached
+        self.assertEqual(action.get_cached_descendants(), list(action.get_descendants()))
+        self.assertEqual(action.get_cached_descendants(), list(action.get_descendants()))
+        self.assertEqual(self.tree_cache.stats["misses"], 5)
+
+
+class PrefetchDescendantsTestCase(TreeTestCase):
+    fixtures = ['categories.json']
+
+    def test_prefetch_descendants(self):
+        expected = dict(
+            (node.pk, ([d.pk for d in node.get_descendants()], [c.pk for c in node.get_children()]))
+            for node in Category.objects.all())
+
+        with self.assertNumQueries(2):
+            nodes = list(Category.objects.filter(level__lte=1).prefetch_descendants())
+            for node in nodes:
+                self.assertEqual([d.pk for d in node.get_descendants()], expected[node.pk][0])
+                self.assertEqual([c.pk for c in node.get_children()], expected[node.pk][1])
+                self.assertEqual(node.get_descendant_count(), len(expected[node.pk][0]))
+            self.assertEqual([d.pk for d in nodes[0].get_descendants(include_self=True)][0], nodes[0].pk)
+
+        # further filtering goes back to the database
+        with self.assertNumQueries(1):
+            self.assertEqual(len(nodes[0].get_descendants().filter(name="Xbox 360")), 1)
+
+    def test_prefetch_descendants_with_max_depth_and_queryset(self):
+        root = Category.objects.get(id=1)
+        children, descendants = list(root.get_children()), list(root.get_descendants())
+        with self.assertNumQueries(2):
+            node = Category.objects.filter(pk=root.pk).prefetch_descendants(
+                max_depth=1, queryset=Category.objects.only("name"))[0]
+            self.assertEqual(list(node.get_children()), children)
+            self.assertEqual([child.name for child in node.get_children()], ["Nintendo Wii", "Xbox 360", "PlayStation 3"])
+        # the full subtree wasn't fetched, so it comes from the database
+        with self.assertNumQueries(1):
+            self.assertEqual(list(node.get_descendants()), descendants)
+
+
+class WithAncestorsTestCase(TreeTestCase):
+    fixtures = ['categories.json']
+
+    def test_with_ancestors(self):
+        expected = dict((node.pk, [a.pk for a in node.get_ancestors()]) for node in Category.objects.all())
+
+        with self.assertNumQueries(2):
+            nodes = list(Category.objects.filter(level=2).with_ancestors())
+            for node in nodes:
+                self.assertEqual([a.pk for a in node.ancestors_cached], expected[node.pk])
+                self.assertEqual([a.pk for a in node.get_ancestors()], expected[node.pk])
+                self.assertEqual([a.pk for a in node.get_ancestors(ascending=True, include_self=True)],
+                                 [node.pk] + expected[node.pk][::-1])
+            # shared ancestors are loaded once
+            self.assertIs(nodes[0].ancestors_cached[0], nodes[-1].ancestors_cached[0])
+            self.assertIs(nodes[0].ancestors_cached[1], nodes[1].ancestors_cached[1])
+
+    def test_with_ancestors_of_nested_nodes(self):
+        with self.assertNumQueries(2):
+            nodes = list(Category.objects.all().with_ancestors(queryset=Category.objects.only("name")))
+            self.assertEqual(nodes[0].ancestors_cached, [])
+            self.assertEqual([a.name for a in nodes[2].ancestors_cached], ["PC & Video Games", "Nintendo Wii"])
+            self.assertEqual([a.name for a in nodes[5].ancestors_cached], ["PC & Video Games", "Xbox 360"])
+
+    def test_ancestors_cached_without_prefetching(self):
+        node = Category.objects.get(id=3)
+        with self.assertNumQueries(1):
+            self.assertEqual([a.pk for a in node.ancestors_cached], [1, 2])
+            self.assertEqual([a.pk for a in node.ancestors_cached], [1, 2])
+
+
+class DepthLimitedDescendantsTestCase(TreeTestCase):
+    fixtures = ['categories.json']
+
+    def test_get_descendants_with_max_depth(self):
+        root = Category.objects.get(id=1)
+        self.assertEqual([node.pk for node in root.get_descendants(max_depth=1)], [2, 5, 8])
+        self.assertEqual([node.pk for node in root.get_descendants(include_self=True, max_depth=1)], [1, 2, 5, 8])
+        self.assertEqual(list(root.get_descendants(max_depth=2)), list(root.get_descendants()))
+        self.assertEqual(list(Category.objects.get(id=2).get_descendants(max_depth=0)), [])
+        self.assertEqual(
+            sorted(Category.objects.filter(pk__in=[2, 5]).get_descendants(max_depth=1).values_list("pk", flat=True)),
+            [3, 4, 6, 7])
+
+    def test_prefetch_descendants_with_max_depth(self):
+        with self.assertNumQueries(2):
+            root = Category.objects.filter(pk=1).prefetch_descendants(max_depth=1)[0]
+            self.assertEqual([node.pk for node in root.get_descendants(max_depth=1)], [2, 5, 8])
+        with self.assertNumQueries(1):
+            self.assertEqual(len(root.get_descendants(max_depth=2)), 9)
+
+    def test_get_cached_trees(self):
+        with self.assertNumQueries(1):
+            roots = Category.objects.all().get_cached_trees()
+            self.assertEqual([root.pk for root in roots], [1])
+            self.assertEqual([child.pk for child in roots[0].get_children()], [2, 5, 8])
+            self.assertEqual([node.pk for node in roots[0].get_children()[0].get_children()], [3, 4])
+            self.assertEqual(len(roots[0].get_descendants(max_depth=2)), 9)
+
+    def test_get_cached_trees_with_max_depth(self):
+        with self.assertNumQueries(2):
+            top = Category.objects.get(id=1).get_descendants(include_self=True, max_depth=1).get_cached_trees(max_depth=1)
+            self.assertEqual([child.pk for child in top[0].get_children()], [2, 5, 8])
+        # the grandchildren weren't loaded, so they're fetched from the database
+        with self.assertNumQueries(1):
+            self.assertEqual([node.pk for node in top[0].get_children()[0].get_children()], [3, 4])
+
+
+class SubtreeLookupsTestCase(TreeTestCase):
+    fixtures = ['categories.json']
+
+    def setUp(self):
+        for category in Category.objects.all():
+            category.category_uuid = "uuid-%d" % category.pk
+            category.save()
+            Item.objects.create(name="item %d" % category.pk, category_pk=category, category_fk=category)
+
+    def test_descendant_of(self):
+        node = Category.objects.get(id=2)
+        with self.assertNumQueries(1):
+            self.assertEqual(
+                list(Item.objects.filter(category_pk__descendant_of=node).values_list("name", flat=True)),
+                ["item 3", "item 4"])
+        self.assertEqual(
+            list(Item.objects.filter(category_fk__descendant_of=node).values_list("name", flat=True)),
+            ["item 3", "item 4"])
+        self.assertEqual(Item.objects.filter(category_pk__descendant_of=Category.objects.get(id=1)).count(), 9)
+
+    def test_ancestor_of(self):
+        node = Category.objects.get(id=7)
+        self.assertEqual(
+            list(Item.objects.filter(category_pk__ancestor_of=node).order_by("pk").values_list("name", flat=True)),
+            ["item 1", "item 5"])
+        self.assertEqual(
+            list(Item.objects.filter(category_fk__ancestor_of=node).order_by("pk").values_list("name", flat=True)),
+            ["item 1", "item 5"])
+        with self.assertRaises(ValueError):
+            Item.objects.filter(category_pk__ancestor_of=Item.objects.get(name="item 1"))
+
+    def test_expressions(self):
+        node = Category.objects.get(id=1)
+        self.assertEqual(
+            list(Item.objects.filter(category_pk__in=Descendants(node, include_self=True, max_depth=1))
+                 .order_by("pk").values_list("name", flat=True)),
+            ["item 1", "item 2", "item 5", "item 8"])
+        self.assertEqual(
+            list(Category.objects.filter(pk__in=Ancestors(Category.objects.get(id=4), include_self=True))
+                 .values_list("pk", flat=True)),
+            [1, 2, 4])
+
+
+class RelatedCountTestCase(TreeTestCase):
+    fixtures = ['categories.json']
+
+    def setUp(self):
+        for pk, count in [(3, 2), (4, 1), (5, 1), (7, 3)]:
+            category = Category.objects.get(pk=pk)
+            for i in range(count):
+                Item.objects.create(name="item %d.%d" % (pk, i), category_pk=category)
+
+    def test_add_related_count(self):
+        with self.assertNumQueries(1):
+            counts = dict(
+                (category.pk, category.item_count) for category in
+                Category.objects.add_related_count(Category.objects.all(), Item, "category_pk", "item_count"))
+        self.assertEqual(counts, {1: 7, 2: 3, 3: 2, 4: 1, 5: 4, 6: 0, 7: 3, 8: 0, 9: 0, 10: 0})
+
+    def test_add_related_count_not_cumulative(self):
+        queryset = Category.objects.add_related_count(
+            Category.objects.filter(level__lte=1), Item, "category_pk", "item_count", cumulative=False)
+        self.assertEqual([(category.pk, category.item_count) for category in queryset],
+                         [(1, 0), (2, 0), (5, 1), (8, 0)])
+
+
+class SubtreeAggregateTestCase(TreeTestCase):
+
+    def setUp(self):
+        self.root = AggregateNode.objects.create(name="root", items=1)
+        self.a = AggregateNode.objects.create(name="a", items=2, parent=self.root)
+        self.b = AggregateNode.objects.create(name="b", items=3, parent=self.a)
+        self.c = AggregateNode.objects.create(name="c", items=4, parent=self.root)
+
+    def _aggregates(self):
+        return dict((node.name, (node.descendant_count, node.total_items)) for node in AggregateNode.objects.all())
+
+    def test_insert(self):
+        self.assertEqual(self._aggregates(), {"root": (3, 10), "a": (1, 5), "b": (0, 3), "c": (0, 4)})
+        AggregateNode.objects.insert_node(AggregateNode(name="d", items=5), self.b, position="left", save=True)
+        self.assertEqual(self._aggregates(), {"root": (4, 15), "a": (2, 10), "b": (0, 3), "c": (0, 4), "d": (0, 5)})
+
+    def test_move(self):
+        self.a.move_to(self.c, position="last-child")
+        self.assertEqual(self._aggregates(), {"root": (3, 10), "c": (2, 9), "a": (1, 5), "b": (0, 3)})
+        AggregateNode.objects.get(name="a").move_to(None)
+        self.assertEqual(self._aggregates(), {"root": (1, 5), "c": (0, 4), "a": (1, 5), "b": (0, 3)})
+
+    def test_save_and_delete(self):
+        self.b.items = 13
+        self.b.save()
+        self.assertEqual(self._aggregates(), {"root": (3, 20), "a": (1, 15), "b": (0, 13), "c": (0, 4)})
+        self.assertEqual(self.b.total_items, 13)
+        # a stale instance doesn't clobber the aggregates when saved
+        self.a.name = "A"
+        self.a.save()
+        self.assertEqual(self._aggregates(), {"root": (3, 20), "A": (1, 15), "b": (0, 13), "c": (0, 4)})
+        self.a.delete()
+        self.assertEqual(self._aggregates(), {"root": (1, 5), "c": (0, 4)})
+
+    def test_rebuild_subtree_aggregates(self):
+        AggregateNode.objects.update(descendant_count=0, total_items=0)
+        self.assertEqual(AggregateNode.objects.rebuild_subtree_aggregates(), 4)
+        self.assertEqual(self._aggregates(), {"root": (3, 10), "a": (1, 5), "b": (0, 3), "c": (0, 4)})
+
+
+@unittest.skipUnless(connection.vendor == "sqlite", "EXPLAIN QUERY PLAN is SQLite specific")
+class QueryPlanTestCase(TreeTestCase):
+    fixtures = ['categories.json']
+
+    def assertSearchesIndex(self, queryset, constraint=""):
+        sql, params = queryset.query.get_compiler(queryset.db).as_sql()
+        with connection.cursor() as cursor:
+            cursor.execute("EXPLAIN QUERY PLAN " + sql, params)
+            details = [row[-1] for row in cursor.fetchall()]
+        self.assertTrue([detail for detail in details if detail.startswith("SEARCH") and constraint in detail], details)
+        self.assertEqual([detail for detail in details if detail.startswith("SCAN")], [], details)
+
+    def test_query_plans(self):
+        node = Category.objects.get(id=5)
+        for queryset in [
+                node.get_ancestors(),
+                node.get_ancestors(ascending=True, include_self=True),
+                node.get_descendants(),
+                node.get_descendants(include_self=True),
+                node.get_descendants(max_depth=1),
+                node.get_children(),
+                node.get_family(),
+                node.get_siblings(),
+                node._get_siblings_queryset().filter(left__gt=node.right),
+                Category.objects.filter(pk__in=Descendants(node))]:
+            self.assertSearchesIndex(queryset)
+
+    def test_chunk_query_plans(self):
+        # each chunk of a tree starts from the end of the previous one in the index
+        node = Category.objects.get(id=5)
+        tree = Category.objects.filter(tree_id=node.tree_id)
+        for queryset in [
+                Category.objects._get_chunk_queryset(tree, 2, node),
+                Category.objects._get_chunk_queryset(tree, 2, (node.pk, node.left), "level")]:
+            self.assertSearchesIndex(queryset, "left>?")
+
+    def test_tree_indexes(self):
+        self.assertEqual(
+            [tuple(index.fields) for index in Category._meta.indexes],
+            [("tree_id", "left"), ("tree_id", "level", "left"), ("tree_id", "right")])
+
+        @isolate_apps("myapp")
+        def define_models():
+            class IndexedNode(NestedIntervalsModel):
+                tree_indexes = [("tree_id", "left")]
+
+                class Meta:
+                    app_label = "myapp"
+                    indexes = [models.Index(fields=["tree_id", "left"], name="indexed_node_left")]
+
+            class UnindexedNode(NestedIntervalsModel):
+                tree_indexes = ()
+
+                class Meta:
+                    app_label = "myapp"
+
+            return IndexedNode, UnindexedNode
+
+        indexed, unindexed = define_models()
+        self.assertEqual([index.name for index in indexed._meta.indexes], ["indexed_node_left"])
+        self.assertEqual(unindexed._meta.indexes, [])
+
+    def test_range_queries(self):
+        node = Category.objects.get(id=5)
+        self.assertEqual([n.pk for n in node.get_family()], [1, 5, 6, 7])
+        self.assertEqual([n.pk for n in node.get_ancestors(include_self=True)], [1, 5])
+        self.assertEqual([n.pk for n in node.get_descendants(include_self=True)], [5, 6, 7])
+        self.assertEqual([n.pk for n in node.get_siblings(include_self=True)], [2, 5, 8])
+        with self.assertNumQueries(2):
+            self.assertEqual(node.get_next_sibling().pk, 8)
+            self.assertEqual(node.get_previous_sibling().pk, 2)
+
+
+class IntegerTreeIdTestCase(TreeTestCase):
+
+    def test_sequential_tree_ids(self):
+        first = IntTreeNode.objects.create(name="first")
+        second = IntTreeNode.objects.create(name="second")
+        child = IntTreeNode.objects.create(name="child", parent=first)
+        self.assertEqual((first.tree_id, second.tree_id, child.tree_id), (1, 2, 1))
+        self.assertEqual(list(first.get_descendants()), [child])
+
+        child.move_to(None)
+        self.assertEqual(IntTreeNode.objects.get(name="child").tree_id, 3)
+        self.assertEqual(list(IntTreeNode.objects.root_nodes().values_list("tree_id", flat=True)), [1, 2, 3])
+        self.assertEqual(IntTreeNode.objects._new_tree_ids(2), [4, 5])
+
+    def test_counter_carries_on_from_existing_trees(self):
+        IntTreeNode.objects.create(name="first")
+        IntTreeNode.objects.update(tree_id=41)
+        TreeIdCounter.objects.all().delete()
+        self.assertEqual(IntTreeNode.objects.create(name="second").tree_id, 42)
+
+
+class TreeBatchTestCase(TreeTestCase):
+    fixtures = ['genres.json']
+
+    def test_tree_batch(self):
+        platformer = Genre.objects.get(id=2)
+        tree_id = platformer.tree_id
+        Genre.objects._create_tree_versions([tree_id])
+        version = Genre.objects.get_tree_version(tree_id)
+
+        real_rebalance_tree = NestedIntervalsManager.rebalance_tree
+        rebalanced = []
+
+        def rebalance_tree(manager, tree_id):
+            rebalanced.append(tree_id)
+            return real_rebalance_tree(manager, tree_id)
+
+        changes = []
+
+        def receiver(sender, tree_id, version, **kwargs):
+            changes.append((tree_id, version))
+
+        tree_changed.connect(receiver, sender=Genre)
+        try:
+            with mock.patch.object(NestedIntervalsManager, "rebalance_tree", rebalance_tree), \
+                    pretend_intervals_too_small(), CaptureQueriesContext(connection) as queries:
+                with Genre.objects.tree_batch():
+                    Genre(name="Beat 'em up").insert_at(platformer, "right", save=True)
+                    Genre.objects.create(name="Metroidvania", parent=Genre.objects.get(id=2))
+                    Genre.objects.get(id=5).move_to(Genre.objects.get(id=6), "last-child")
+                    self.assertEqual(rebalanced, [])
+        finally:
+            tree_changed.disconnect(receiver, sender=Genre)
+
+        self.assertEqual(rebalanced, [tree_id])
+        self.assertEqual(Genre.objects.get_tree_version(tree_id), version + 1)
+        self.assertEqual(changes, [(tree_id, version + 1)])
+        self.assertEqual([query["sql"] for query in queries if "SAVEPOINT" in query["sql"]], [])
+        self.assertTreeEqual(Genre.objects.all(), """
+            1 - 0
+            2 1 1
+            3 2 2
+            4 2 2
+            %(metroidvania)s 2 2
+            %(beat_em_up)s 1 1
+            6 1 1
+            7 6 2
+            8 6 2
+            5 6 2
+            9 - 0
+            10 9 1
+            11 9 1
+        """ % {
+            "beat_em_up": Genre.objects.get(name="Beat 'em up").pk,
+            "metroidvania": Genre.objects.get(name="Metroidvania").pk,
+        })
+
+    def test_tree_batch_neighbours(self):
+        platformer, shmup = Genre.objects.get(id=2), Genre.objects.get(id=6)
+        with Genre.objects.tree_batch():
+            # the children of "Platformer" are read once, and the nodes inserted among them are
+            # added to the batch's view of them
+            with self.assertNumQueries(1 + 7):
+                first = Genre.objects.create(name="First", parent=platformer)
+                Genre.objects.create(name="Second", parent=platformer)
+                Genre(name="Before first").insert_at(first, "left", save=True)
+                Genre(name="After first").insert_at(first, "right", save=True)
+                Genre(name="Very first").insert_at(platformer, "first-child", save=True)
+                # as are the children of new nodes (which have none)
+                Genre.objects.create(name="Below first", parent=first)
+                Genre(name="Before below first").insert_at(first, "first-child", save=True)
+            # other changes to the tree have it read again
+            Genre.objects.get(id=5).move_to(shmup, "last-child")
+            with self.assertNumQueries(2):
+                Genre.objects.create(name="Last", parent=platformer)
+        self.assertTreeEqual(Genre.objects.all(), """
+            1 - 0
+            2 1 1
+            %(very_first)s 2 2
+            3 2 2
+            4 2 2
+            %(before_first)s 2 2
+            %(first)s 2 2
+            %(before_below_first)s %(first)s 3
+            %(below_first)s %(first)s 3
+            %(after_first)s 2 2
+            %(second)s 2 2
+            %(last)s 2 2
+            6 1 1
+            7 6 2
+            8 6 2
+            5 6 2
+            9 - 0
+            10 9 1
+            11 9 1
+        """ % dict(
+            (name.lower().replace(" ", "_"), Genre.objects.get(name=name).pk)
+            for name in ("Very first", "Before first", "First", "Before below first", "Below first",
+                         "After first", "Second", "Last")
+        ))
+
+    def test_tree_batch_rolls_back(self):
+        version = Genre.objects.get_tree_version(Genre.objects.get(id=1).tree_id)
+        with self.assertRaises(ValueError):
+            with Genre.objects.tree_batch():
+                Genre.objects.create(name="Metroidvania", parent=Genre.objects.get(id=2))
+                raise ValueError()
+        self.assertFalse(Genre.objects.filter(name="Metroidvania").exists())
+        self.assertEqual(Genre.objects.get_tree_version(Genre.objects.get(id=1).tree_id), version)
+
+
+def run_async(awaitable):
+    # awaits ``awaitable`` on an event loop, as an async view would, with the sync_to_async
+    # calls it makes coming back to this thread (and its database connection)
+    return async_to_sync(asyncio.wait_for)(awaitable, None)
+
+
+@unittest.skipIf(aio is None, "needs Python 3.6+ and asgiref")
+class TreeAsyncTestCase(TreeTestCase):
+    fixtures = ['genres.json']
+
+    def test_async_reads(self):
+        platformer = Genre.objects.get(id=2)
+        self.assertEqual(run_async(platformer.aget_parent()), Genre.objects.get(id=1))
+        self.assertEqual(run_async(platformer.aget_children()), list(platformer.get_children()))
+        self.assertEqual(
+            run_async(platformer.aget_descendants(include_self=True)),
+            list(platformer.get_descendants(include_self=True)))
+        self.assertEqual(
+            run_async(Genre.objects.get(id=3).aget_ancestors(ascending=True)),
+            [platformer, Genre.objects.get(id=1)])
+
+        # nothing is left to fetch when the descendants are prefetched
+        action = Genre.objects.prefetch_descendants().get(id=1)
+        with mock.patch("nested_intervals.aio.sync_to_async") as sync_to_async_mock:
+            self.assertEqual(run_async(action.aget_descendants()), list(action.get_descendants()))
+        self.assertFalse(sync_to_async_mock.called)
+
+        # the chunks of a subtree are read on threads of their own, rather than the sync thread
+        action = Genre.objects.get(id=1)
+        with mock.patch("nested_intervals.aio.sync_to_async", wraps=sync_to_async) as sync_to_async_mock:
+            self.assertEqual(
+                [(node.pk, depth, parent_pk) for node, depth, parent_pk in
+                 run_async(aio.alist(action.aiter_subtree(chunk_size=3)))],
+                [(1, 0, None), (2, 1, 1), (3, 2, 2), (4, 2, 2), (5, 2, 2), (6, 1, 1), (7, 2, 6), (8, 2, 6)])
+        self.assertEqual(sync_to_async_mock.call_count, 4)
+        self.assertEqual(sync_to_async_mock.call_args[1], {"thread_sensitive": False})
+
+        # (leaving the subtree early leaves no read behind)
+        async def first_nodes(count):
+            nodes = []
+            async for node, depth, parent_pk in action.aiter_subtree(chunk_size=3):
+                nodes.append(node.pk)
+                if len(nodes) == count:
+                    break
+            return nodes
+
+        self.assertEqual(run_async(first_nodes(2)), [1, 2])
+
+    def test_async_writes(self):
+        platformer = Genre.objects.get(id=2)
+        run_async(Genre(name="Metroidvania").ainsert_at(platformer, "last-child", save=True))
+        run_async(Genre.objects.get(id=5).amove_to(Genre.objects.get(id=6), "last-child"))
+        self.assertEqual(run_async(Genre.objects.arebalance_tree(platformer.tree_id)), 9)
+        self.assertTreeEqual(Genre.objects.all(), """
+            1 - 0
+            2 1 1
+            3 2 2
+            4 2 2
+            %(metroidvania)s 2 2
+            6 1 1
+            7 6 2
+            8 6 2
+            5 6 2
+            9 - 0
+            10 9 1
+            11 9 1
+        """ % {"metroidvania": Genre.objects.get(name="Metroidvania").pk})
+
+
+@unittest.skipUnless("shard1" in settings.DATABASES, "needs a second database to act as a replica")
+class TreeReplicaRoutingTestCase(TreeTestCase):
+    # "shard1" stands in for a replica that lags behind: it has the fixture, and never anything
+    # written after it
+    databases = set(["default", "shard1"])
+    fixtures = ['genres.json']
+
+    def setUp(self):
+        routers._get_written_trees().clear()
+
+    def test_tree_reads_go_to_replicas(self):
+        tree_router = TreeReplicaRouter(replicas=["shard1"])
+        with self.settings(DATABASE_ROUTERS=[tree_router]):
+            root = Genre.objects.get(id=1)
+            self.assertEqual(root.get_descendants().db, "shard1")
+            self.assertEqual(root.get_ancestors().db, "shard1")
+            self.assertEqual(root._get_parent_queryset().db, "shard1")
+            self.assertEqual(Genre.objects.filter(id=2).db, "default")
+
+            # nodes read from a replica are saved to the primary
+            platformer = root.get_children()[0]
+            self.assertEqual(platformer._state.db, "shard1")
+            self.assertEqual(tree_router.db_for_write(Genre, instance=platformer), "default")
+
+            # the neighbours of an insertion or a move are read from the primary, even when
+            # making room for it has changed the tree (so the replica's intervals are stale)
+            with mock.patch("nested_intervals.routers.PRIMARY_READ_WINDOW", 0):
+                Genre.objects.create(name="Beat 'em up", parent=Genre.objects.get(id=1))
+                with pretend_intervals_too_small():
+                    Genre(name="Metroidvania").insert_at(platformer, "last-child", save=True)
+            beat_em_up, metroidvania = Genre.objects.get(name="Beat 'em up"), Genre.objects.get(name="Metroidvania")
+            with routers.reading_from_primary():
+                self.assertTreeEqual(Genre.objects.all(), """
+                    1 - 0
+                    2 1 1
+                    3 2 2
+                    4 2 2
+                    5 2 2
+                    %d 2 2
+                    6 1 1
+                    7 6 2
+                    8 6 2
+                    %d 1 1
+                    9 - 0
+                    10 9 1
+                    11 9 1
+                """ % (metroidvania.pk, beat_em_up.pk))
+            with mock.patch("nested_intervals.routers.PRIMARY_READ_WINDOW", 0), pretend_intervals_too_small():
+                Genre.objects.get(id=5).move_to(root.get_children()[1], "last-child")
+            with routers.reading_from_primary():
+                self.assertEqual([node.pk for node in Genre.objects.get(id=6).get_children()], [7, 8, 5])
+                self.assertEqual([node.pk for node in Genre.objects.get(id=2).get_children()], [3, 4, metroidvania.pk])
+            self.assertEqual(Genre.objects.using("shard1").count(), 11)
+
+            # a changed tree is read from the primary for a while
+            Genre.objects.get(id=4).move_to(Genre.objects.get(id=6), "last-child")
+            self.assertEqual(platformer.get_descendants().db, "default")
+            self.assertEqual(Genre.objects.get(id=10).get_ancestors().db, "shard1")
+            with mock.patch("nested_intervals.routers.time.time", return_value=time.time() + 60):
+                self.assertEqual(platformer.get_descendants().db, "shard1")
+
+    def test_expired_tree_writes_are_forgotten(self):
+        now = time.time()
+        with mock.patch("nested_intervals.routers.time.time", return_value=now):
+            routers.record_tree_write(Genre, 1)
+            routers.record_tree_write(Genre, 2)
+        with mock.patch("nested_intervals.routers.time.time", return_value=now + 60):
+            routers.record_tree_write(Genre, 3)
+        self.assertEqual(list(routers._get_written_trees()), [routers._get_tree_key(Genre, 3)])
+
+
+@unittest.skipUnless(set(["shard1", "shard2"]) <= set(settings.DATABASES), "needs the shard databases")
+class TreeShardingTestCase(TreeTestCase):
+    databases = set(["default", "shard1", "shard2"])
+
+    def test_sharded_trees(self):
+        with self.settings(DATABASE_ROUTERS=[TreeShardRouter(shards=["shard1", "shard2"])]):
+            # (new trees go to random shards)
+            with mock.patch("nested_intervals.managers.random.choice", side_effect=["shard2", "shard2", "shard2", "shard1"]):
+                roots = [IntTreeNode.objects.create(name="root %d" % i) for i in range(4)]
+            for root in roots:
+                child = IntTreeNode.objects.create(name="child", parent=root)
+                IntTreeNode.objects.create(name="grandchild", parent=child)
+
+            # each tree is kept whole in one of the shards
+            shards = [router.db_for_write(IntTreeNode, tree_id=root.tree_id) for root in roots]
+            self.assertEqual(shards, ["shard2", "shard2", "shard2", "shard1"])
+            # integer ids are counted per shard, round the shards
+            self.assertEqual([root.tree_id for root in roots], [3, 5, 7, 2])
+            for root, shard in zip(roots, shards):
+                self.assertEqual(IntTreeNode.objects.using(shard).filter(tree_id=root.tree_id).count(), 3)
+                self.assertEqual([node.name for node in root.get_descendants()], ["child", "grandchild"])
+                self.assertEqual(IntTreeNode.objects.get_tree_version(root.tree_id), 3)
+            self.assertFalse(IntTreeNode.objects.using("default").exists())
+
+            # forest-wide operations fan out to every shard
+            self.assertEqual(sorted(root.tree_id for root in IntTreeNode.objects.iter_root_nodes()), [2, 3, 5, 7])
+            self.assertEqual(IntTreeNode.objects.db_manager("shard2").root_nodes().count(), 3)
+            IntTreeNode.objects.rebalance_all_trees()
+            self.assertEqual(IntTreeNode.objects.get_tree_versions(), {2: 4, 3: 4, 5: 4, 7: 4})
+
+            # a subtree made into a tree of its own stays in its shard
+            child = roots[0].get_children().get()
+            child.move_to(None)
+            self.assertEqual(child.tree_id, 9)
+            self.assertEqual(router.db_for_write(IntTreeNode, tree_id=child.tree_id), "shard2")
+            self.assertEqual(child.get_descendant_count(), 1)
+            self.assertEqual(IntTreeNode.objects.root_node(child.tree_id), child)
+
+            with self.assertRaises(InvalidMove):
+                roots[3].get_children().get().move_to(roots[1])
+
+            roots[3].delete()
+            self.assertFalse(IntTreeNode.objects.using("shard1").exists())
+            self.assertEqual(sorted(root.tree_id for root in IntTreeNode.objects.iter_root_nodes()), [3, 5, 7, 9])
+
+    def test_new_tree_rolled_back_on_its_shard(self):
+        with self.settings(DATABASE_ROUTERS=[TreeShardRouter(shards=["shard1", "shard2"])]):
+            # the transaction creating a new tree is on the shard the tree goes to
+            def receiver(**kwargs):
+                raise RuntimeError
+
+            models.signals.post_save.connect(receiver, sender=IntTreeNode)
+            try:
+                with self.assertRaises(RuntimeError):
+                    IntTreeNode.objects.create(name="root")
+                with self.assertRaises(RuntimeError):
+                    IntTreeNode(name="root").save()
+            finally:
+                models.signals.post_save.disconnect(receiver, sender=IntTreeNode)
+            for alias in ("default", "shard1", "shard2"):
+                self.assertFalse(IntTreeNode.objects.using(alias).exists())
+
+    def test_rebalance_queue_on_shards(self):
+        with self.settings(DATABASE_ROUTERS=[TreeShardRouter(shards=["shard1", "shard2"])]):
+            with mock.patch("nested_intervals.managers.random.choice", return_value="shard2"):
+                root = IntTreeNode.objects.create(name="root")
+            IntTreeNode.objects.create(name="child", parent=root)
+
+            # rebalances are handed over once the transaction on the tree's shard commits
+            with mock.patch("nested_intervals.rebalancing.get_rebalance_executor") as executor_mock:
+                with transaction.atomic(using="shard2"):
+                    schedule_rebalance(IntTreeNode, root.tree_id)
+                    self.assertFalse(executor_mock.called)
+                executor_mock.return_value.submit.assert_called_once_with(IntTreeNode, root.tree_id)
+
+            # and queued next to the tree
+            DatabaseQueueRebalanceExecutor().submit(IntTreeNode, root.tree_id)
+            self.assertEqual(PendingRebalance.objects.using("shard2").count(), 1)
+            call_command("process_rebalance_queue", stdout=io.StringIO())
+            self.assertFalse(PendingRebalance.objects.using("shard2").exists())
+            self.assertEqual(IntTreeNode.objects.get_tree_version(root.tree_id), 3)
+
+    def test_index_on_shards(self):
+        with self.settings(DATABASE_ROUTERS=[TreeShardRouter(shards=["shard1", "shard2"])]):
+            with mock.patch("nested_intervals.managers.random.choice", side_effect=["shard1", "shard2"]):
+                roots = [IntTreeNode.objects.create(pk=1 + i, name="root %d" % i) for i in range(2)]
+            # (the index needs pks that are unique across the shards)
+            children = [IntTreeNode.objects.create(pk=3 + i, name="child", parent=root) for i, root in enumerate(roots)]
+
+            index = TreeIndex(IntTreeNode)
+            self.assertEqual(len(index), 4)
+            self.assertEqual(sorted(index.get_tree_ids()), sorted(root.tree_id for root in roots))
+            for root, child in zip(roots, children):
+                self.assertEqual(index.children(root.pk), [child.pk])
+
+            IntTreeNode.objects.create(pk=5, name="grandchild", parent=children[1])
+            self.assertEqual(index.refresh(), [roots[1].tree_id])
+            self.assertEqual(index.descendant_count(roots[1].pk), 2)
+            self.assertEqual(len(TreeIndex(IntTreeNode, tree_ids=[roots[1].tree_id])), 3)
+
+    def test_prefetch_descendants_on_shards(self):
+        with self.settings(DATABASE_ROUTERS=[TreeShardRouter(shards=["shard1", "shard2"])]):
+            with mock.patch("nested_intervals.managers.random.choice", side_effect=["shard1", "shard2"]):
+                roots = [IntTreeNode.objects.create(name="root %d" % i) for i in range(2)]
+            for root in roots:
+                child = IntTreeNode.objects.create(name="child", parent=root)
+                IntTreeNode.objects.create(name="grandchild", parent=child)
+
+            # the descendants are fetched from the shard the nodes were read from
+            root = IntTreeNode.objects.using("shard2").filter(level=0).prefetch_descendants().get()
+            with self.assertNumQueries(0, using="shard2"):
+                self.assertEqual([node.name for node in root.get_descendants()], ["child", "grandchild"])
+            # nodes from several shards are prefetched from each of them
+            roots = list(IntTreeNode.objects.iter_root_nodes())
+            prefetch_descendants(roots)
+            for root in roots:
+                self.assertEqual([node.name for node in root._prefetched_descendants[1]], ["child", "grandchild"])
+
+    def test_prefetch_ancestors_on_shards(self):
+        with self.settings(DATABASE_ROUTERS=[TreeShardRouter(shards=["shard1", "shard2"])]):
+            with mock.patch("nested_intervals.managers.random.choice", side_effect=["shard1", "shard2"]):
+                roots = [IntTreeNode.objects.create(name="root %d" % i) for i in range(2)]
+            for root in roots:
+                child = IntTreeNode.objects.create(name="child", parent=root)
+                IntTreeNode.objects.create(name="grandchild", parent=child)
+
+            node = IntTreeNode.objects.using("shard2").filter(level=2).with_ancestors().get()
+            self.assertEqual([ancestor.name for ancestor in node.ancestors_cached], ["root 1", "child"])
+            # nodes from several shards are prefetched from each of them
+            nodes = [IntTreeNode.objects.using(shard).get(level=2) for shard in ("shard1", "shard2")]
+            prefetch_ancestors(nodes)
+            self.assertEqual(
+                [[ancestor.name for ancestor in node.ancestors_cached] for node in nodes],
+                [["root 0", "child"], ["root 1", "child"]],
+            )
+
+
+class TreeSubtreeCopyTestCase(TreeTestCase):
+    fixtures = ['genres.json']
+
+    def test_copy_subtree(self):
+        with CaptureQueriesContext(connection) as queries:
+            pk_map = Genre.objects.get(id=2).copy_subtree(
+                Genre.objects.get(id=9), field_overrides={"name": Concat(F("name"), Value(" (copy)"))})
+
+        # the copies are made with one INSERT ... SELECT
+        self.assertEqual(len([query for query in queries if query["sql"].startswith('INSERT INTO "myapp_genre"')]), 1)
+        first = pk_map[2]
+        self.assertEqual(pk_map, {2: first, 3: first + 1, 4: first + 2, 5: first + 3})
+        self.assertEqual(Genre.objects.get(id=pk_map[3]).name, "2D Platformer (copy)")
+        self.assertTreeEqual(Genre.objects.all(), """
+            1 - 0
+            2 1 1
+            3 2 2
+            4 2 2
+            5 2 2
+            6 1 1
+            7 6 2
+            8 6 2
+            9 - 0
+            10 9 1
+            11 9 1
+            %d 9 1
+            %d %d 2
+            %d %d 2
+            %d %d 2
+        """ % (first, first + 1, first, first + 2, first, first + 3, first))
+
+    def test_copy_subtree_auto_now_fields(self):
+        root = AutoNowDateFieldModel.objects.create()
+        AutoNowDateFieldModel.objects.create(parent=root)
+        AutoNowDateFieldModel.objects.update(now=datetime.datetime(2000, 1, 1))
+        start = timezone.now().replace(microsecond=0)
+
+        # the copies are stamped with the current time, however they're made
+        for respace in (False, True):
+            pk_map = AutoNowDateFieldModel.objects.get(pk=root.pk).copy_subtree(None, respace=respace)
+            for copy in AutoNowDateFieldModel.objects.filter(pk__in=pk_map.values()):
+                self.assertGreaterEqual(copy.now, start)
+
+    def test_copy_subtree_to_new_tree(self):
+        action = Genre.objects.get(id=1)
+        pk_map = action.copy_subtree(None, field_overrides={"name": lambda node: node.name + " 2"}, respace=True)
+        copy = Genre.objects.get(pk=pk_map[1])
+
+        self.assertNotEqual(copy.tree_id, action.tree_id)
+        self.assertEqual(copy.name, "Action 2")
+        self.assertEqual(
+            [node.pk for node in copy.get_descendants()],
+            [pk_map[node.pk] for node in action.get_descendants()])
+        # the copies are laid out evenly spaced afresh, here the same as the freshly loaded fixture
+        self.assertEqual(
+            list(copy.get_descendants(include_self=True).values_list("left", "right", "level")),
+            list(action.get_descendants(include_self=True).values_list("left", "right", "level")))
+
+    def test_copy_subtree_aggregates(self):
+        root = AggregateNode.objects.create(name="root", items=1)
+        a = AggregateNode.objects.create(name="a", items=2, parent=root)
+        AggregateNode.objects.create(name="b", items=3, parent=a)
+        c = AggregateNode.objects.create(name="c", items=4, parent=root)
+
+        a.copy_subtree(c)
+        self.assertEqual(
+            [(node.name, node.level, node.descendant_count, node.total_items) for node in AggregateNode.objects.all()],
+            [("root", 0, 5, 15), ("a", 1, 1, 5), ("b", 2, 0, 3), ("c", 1, 2, 9), ("a", 2, 1, 5), ("b", 3, 0, 3)])